@@ -0,0 +1,418 @@
+"""
+Benchmark for xsc.
+
+Generates data files similar to the ones in the ``test`` folder with any number of rows,
+converts them using various templates and measures rows per second, output bytes per second
+and peak memory. Results can be stored as JSON and compared with a previous run to detect
+regressions, for example::
+
+  $ python benchmark_xsc.py --rows 1000,100000 --output baseline.json
+  ... (change xsc) ...
+  $ python benchmark_xsc.py --rows 1000,100000 --baseline baseline.json
+"""
+# Copyright (C) 2011-2012 Thomas Aglassinger
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+import cutplace.version
+
+import xsc
+
+_log = logging.getLogger('xsc.benchmark')
+
+_TestFolderPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+
+# Row counts to benchmark by default.
+DefaultRowCounts = (1000, 10000)
+
+# Percentage by which a result may be worse than the baseline before it counts as regression.
+DefaultTolerance = 10.0
+
+# Number of periods per notification for EDM data.
+_PeriodsPerNotification = 20
+
+# Number of loans per customer for loan data.
+_LoansPerCustomer = 3
+
+_Surnames = (u'Doe', u'Miller', u'Webster', u'Gruber', u'Huber', u'Wagner', u'M\u00fcller', u'Steiner')
+_Firstnames = (u'John', u'Jane', u'Mike', u'Anna', u'Lukas', u'Sophie', u'J\u00fcrgen', u'Eva')
+
+def _testFilePath(name):
+    return os.path.join(_TestFolderPath, name)
+
+def writeCustomers(targetCsvPath, rowCount, seed=0):
+    """
+    Write ``rowCount`` customers like ``test/customers.csv`` to ``targetCsvPath``.
+    """
+    assert targetCsvPath is not None
+    assert rowCount >= 0
+    randomizer = random.Random(seed)
+    with open(targetCsvPath, 'wb') as targetCsvFile:
+        targetCsvFile.write('id,surname,firstname,dateOfBirth\n')
+        for rowIndex in xrange(rowCount):
+            targetCsvFile.write((u'%d,%s,%s,%04d-%02d-%02d\n' % (
+                rowIndex + 1, randomizer.choice(_Surnames), randomizer.choice(_Firstnames),
+                randomizer.randint(1920, 2000), randomizer.randint(1, 12), randomizer.randint(1, 28)
+            )).encode('utf-8'))
+
+def writeLoans(targetCsvPath, rowCount, seed=0):
+    """
+    Write ``rowCount`` loans like ``test/loans.csv`` sorted by ``customer_id`` to
+    ``targetCsvPath``.
+    """
+    assert targetCsvPath is not None
+    assert rowCount >= 0
+    randomizer = random.Random(seed)
+    with open(targetCsvPath, 'wb') as targetCsvFile:
+        targetCsvFile.write('id,customer_id,balance,rate\n')
+        for rowIndex in xrange(rowCount):
+            targetCsvFile.write('%d,%d,%d.%02d,%s\n' % (
+                rowIndex + 1, rowIndex // _LoansPerCustomer + 1, randomizer.randint(100, 100000),
+                randomizer.randint(0, 99), randomizer.choice(('5.5', '7.5', '8.25', '9.75'))
+            ))
+
+def _obligatedPartyId(notificationIndex):
+    return 9008390000000 + notificationIndex
+
+def writeEdmBalance(targetNotificationCsvPath, targetPeriodCsvPath, rowCount, seed=0):
+    """
+    Write EDM balance data like ``test/edmBalanceNotification.csv`` and
+    ``test/edmBalancePeriod.csv`` with ``rowCount`` periods, each notification having
+    `_PeriodsPerNotification` of them.
+    """
+    assert targetNotificationCsvPath is not None
+    assert targetPeriodCsvPath is not None
+    assert rowCount >= 0
+    randomizer = random.Random(seed)
+    notificationCount = max(1, rowCount // _PeriodsPerNotification)
+    with open(targetNotificationCsvPath, 'wb') as targetCsvFile:
+        targetCsvFile.write('Konstante: 9008390100400;Meldepflichtiger;Konstante: 2010-01-01;Konstante: 2010-12-31\n')
+        targetCsvFile.write('SpecifiedNotification_TypeCode;ObligatedParty_ID;CoveredPeriod_StartDate;CoveredPeriod_EndDate\n')
+        for notificationIndex in xrange(notificationCount):
+            targetCsvFile.write('9008390100400;%d;2010-01-01;2010-12-31\n' % _obligatedPartyId(notificationIndex))
+    with open(targetPeriodCsvPath, 'wb') as targetCsvFile:
+        targetCsvFile.write(
+            'Bewegungsart (9997);Abfalluebergeber;Abfalluebernehmer;Abfallart;'
+            'Konstante:9008390100004 - gerechnet;Menge;Konstante: KGM\n'
+        )
+        targetCsvFile.write(
+            'WasteMaterialMovement_TypeCode;HandOverParty_ID;TakeOverParty_ID;MovedMaterial_ClassificationCode;'
+            'MassMeasurement_QuantificationTypeCode;MassMeasureMent_DetermindedMeasure;unitCode\n'
+        )
+        for _ in xrange(rowCount):
+            targetCsvFile.write('9008390101544;%08d;%d;%d;9008390100004;%d;KGM\n' % (
+                randomizer.randint(1, 99999999), _obligatedPartyId(randomizer.randint(0, notificationCount - 1)),
+                randomizer.choice((9008390016121, 9008390016138, 9008390016145)), randomizer.randint(1, 5000)
+            ))
+
+class _Scenario(object):
+    """
+    A benchmark converting ``templateName`` from the test folder or, if it is ``None``, only
+    loading the data. ``dataNames`` are the names of data sources in the order
+    `_GeneratedData.paths()` returns them for ``dataKind``.
+    """
+    def __init__(self, name, description, dataKind, dataNames, templateName=None):
+        self.name = name
+        self.description = description
+        self.dataKind = dataKind
+        self.dataNames = dataNames
+        self.templateName = templateName
+
+_CustomersDataKind = 'customers'
+_LoansDataKind = 'loans'
+_EdmBalanceDataKind = 'edmBalance'
+
+_Scenarios = (
+    _Scenario('load', 'read and validate EDM periods', _EdmBalanceDataKind, ('edmNotification', 'edmPeriod')),
+    _Scenario('join', 'join EDM periods to notifications', _EdmBalanceDataKind, ('edmNotification', 'edmPeriod'),
+        'edmBalanceJoin.xsc'),
+    _Scenario('group', 'group loans by customer', _LoansDataKind, ('loans',), 'loanGroups.xsc'),
+    _Scenario('static', 'customers with mostly constant output', _CustomersDataKind, ('customers',),
+        'benchmarkStatic.xsc'),
+    _Scenario('expressions', 'customers with mostly computed output', _CustomersDataKind, ('customers',),
+        'benchmarkExpressions.xsc'),
+)
+
+ScenarioNames = tuple(scenario.name for scenario in _Scenarios)
+
+def _scenario(name):
+    for scenario in _Scenarios:
+        if scenario.name == name:
+            return scenario
+    raise ValueError('scenario must be one of %s but is: %r' % (', '.join(ScenarioNames), name))
+
+class _GeneratedData(object):
+    """
+    Data files generated in ``folderPath``. Files already generated by a previous run are
+    reused. Each file is written to a temporary file first and renamed once it is complete,
+    so files of a run that was interrupted are generated again.
+    """
+    def __init__(self, folderPath):
+        assert folderPath is not None
+        self.folderPath = folderPath
+
+    def paths(self, dataKind, rowCount):
+        """
+        List of ``(dataFilePath, cidFilePath)`` for data of kind ``dataKind`` with
+        ``rowCount`` rows.
+        """
+        def path(name):
+            return os.path.join(self.folderPath, '%s_%d.csv' % (name, rowCount))
+
+        if dataKind == _CustomersDataKind:
+            result = [(path('customers'), None)]
+            writeData = writeCustomers
+        elif dataKind == _LoansDataKind:
+            result = [(path('loans'), None)]
+            writeData = writeLoans
+        elif dataKind == _EdmBalanceDataKind:
+            result = [
+                (path('edmBalanceNotification'), _testFilePath('cid_edmBalanceNotification.xls')),
+                (path('edmBalancePeriod'), _testFilePath('cid_edmBalancePeriod.xls')),
+            ]
+            writeData = writeEdmBalance
+        else:
+            assert False, 'dataKind=%r' % dataKind
+        dataFilePaths = [dataFilePath for dataFilePath, _ in result]
+        if not all(os.path.exists(dataFilePath) for dataFilePath in dataFilePaths):
+            temporaryPaths = [dataFilePath + '.tmp' for dataFilePath in dataFilePaths]
+            writeData(*(temporaryPaths + [rowCount]))
+            for temporaryPath, dataFilePath in zip(temporaryPaths, dataFilePaths):
+                if os.name == 'nt': # pragma: no cover
+                    if os.path.exists(dataFilePath):
+                        os.remove(dataFilePath)
+                os.rename(temporaryPath, dataFilePath)
+        return result
+
+def _measuredScenario(scenarioName, rowCount, dataPaths, targetXmlFilePath, engine, writer, jobs):
+    """
+    Dictionary with measurements of ``scenarioName``.
+    """
+    scenario = _scenario(scenarioName)
+    startTime = timeit.default_timer()
+    if scenario.templateName is None:
+        for dataName, (dataFilePath, cidFilePath) in zip(scenario.dataNames, dataPaths):
+            source = xsc.DataSource(dataName)
+            source.setInterface(xsc._readInterface(dataFilePath, cidFilePath, 'utf-8'))
+            source.setData(dataFilePath)
+        outputByteCount = 0
+    else:
+        template = xsc.XscTemplate(_testFilePath(scenario.templateName))
+        xsc.convert(
+            template, dict(zip(scenario.dataNames, dataPaths)), targetXmlFilePath, engine=engine, jobs=jobs,
+            writer=writer
+        )
+        outputByteCount = os.path.getsize(targetXmlFilePath)
+    duration = max(timeit.default_timer() - startTime, 1e-6)
+    return {
+        'scenario': scenarioName,
+        'rows': rowCount,
+        'seconds': duration,
+        'rowsPerSecond': rowCount / duration,
+        'outputBytes': outputByteCount,
+        'outputBytesPerSecond': outputByteCount / duration,
+        'peakRss': xsc._peakRss(),
+    }
+
+def _measuredScenarioInFreshProcess(arguments):
+    """
+    Like `_measuredScenario()` but in a process of its own, so the peak memory only
+    reflects the scenario.
+    """
+    if hasattr(os, 'fork'):
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(_measuredScenario, arguments)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else: # pragma: no cover
+        result = _measuredScenario(*arguments)
+    return result
+
+def resultKey(scenarioName, rowCount):
+    return '%s/%d' % (scenarioName, rowCount)
+
+def benchmark(rowCounts=DefaultRowCounts, scenarioNames=ScenarioNames, dataFolderPath=None, engine=xsc.EngineCompiled,
+        writer=xsc.WriterNative, jobs=1):
+    """
+    Dictionary describing the environment and containing the measurements of each scenario
+    in ``scenarioNames`` for each number of rows in ``rowCounts``. Generated data are
+    stored in ``dataFolderPath`` so later runs can use them again, or in a temporary folder
+    that is removed afterwards.
+    """
+    assert rowCounts
+    assert scenarioNames
+    isTemporaryDataFolder = dataFolderPath is None
+    if isTemporaryDataFolder:
+        dataFolderPath = tempfile.mkdtemp(prefix='xsc_benchmark_')
+    elif not os.path.exists(dataFolderPath):
+        os.makedirs(dataFolderPath)
+    try:
+        generatedData = _GeneratedData(dataFolderPath)
+        targetXmlFilePath = os.path.join(dataFolderPath, 'benchmark.xml')
+        results = {}
+        for rowCount in rowCounts:
+            for scenarioName in scenarioNames:
+                scenario = _scenario(scenarioName)
+                _log.info(u'benchmark %s with %d rows: %s', scenarioName, rowCount, scenario.description)
+                dataPaths = generatedData.paths(scenario.dataKind, rowCount)
+                results[resultKey(scenarioName, rowCount)] = _measuredScenarioInFreshProcess(
+                    (scenarioName, rowCount, dataPaths, targetXmlFilePath, engine, writer, jobs)
+                )
+    finally:
+        if isTemporaryDataFolder:
+            shutil.rmtree(dataFolderPath)
+    return {
+        'xsc': xsc.__version__,
+        'cutplace': cutplace.version.VERSION_NUMBER,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': engine,
+        'writer': writer,
+        'jobs': jobs,
+        'results': results,
+    }
+
+def regressions(benchmarkResult, baselineResult, tolerance=DefaultTolerance):
+    """
+    List of messages describing measurements in ``benchmarkResult`` that are more than
+    ``tolerance`` percent worse than in ``baselineResult``: rows per second being lower or
+    peak memory being higher. Measurements missing in the baseline are ignored.
+    """
+    assert benchmarkResult is not None
+    assert baselineResult is not None
+    assert tolerance >= 0
+    result = []
+    factor = tolerance / 100.0
+    baselineResults = baselineResult['results']
+    for key, measurements in sorted(benchmarkResult['results'].items()):
+        baselineMeasurements = baselineResults.get(key)
+        if baselineMeasurements is not None:
+            rowsPerSecond = measurements['rowsPerSecond']
+            baselineRowsPerSecond = baselineMeasurements['rowsPerSecond']
+            if rowsPerSecond < baselineRowsPerSecond * (1.0 - factor):
+                result.append(u'%s: rows per second dropped from %.0f to %.0f' % (key, baselineRowsPerSecond, rowsPerSecond))
+            peakRss = measurements.get('peakRss')
+            baselinePeakRss = baselineMeasurements.get('peakRss')
+            if (peakRss is not None) and (baselinePeakRss is not None) and (peakRss > baselinePeakRss * (1.0 + factor)):
+                result.append(u'%s: peak memory grew from %.1f MB to %.1f MB' % (
+                    key, baselinePeakRss / 1048576.0, peakRss / 1048576.0
+                ))
+    return result
+
+def reportLines(benchmarkResult):
+    """
+    Lines of a human readable report on ``benchmarkResult``.
+    """
+    assert benchmarkResult is not None
+    result = [u'%-12s %10s %10s %12s %12s %10s' % (u'scenario', u'rows', u'seconds', u'rows/s', u'output MB/s', u'peak MB')]
+    for measurements in sorted(benchmarkResult['results'].values(), key=lambda item: (item['rows'], item['scenario'])):
+        peakRss = measurements['peakRss']
+        result.append(u'%-12s %10d %10.2f %12.0f %12.2f %10s' % (
+            measurements['scenario'], measurements['rows'], measurements['seconds'], measurements['rowsPerSecond'],
+            measurements['outputBytesPerSecond'] / 1048576.0, u'%.1f' % (peakRss / 1048576.0) if peakRss is not None else u'-'
+        ))
+    return result
+
+def _parsedOptions(arguments):
+    usage = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage=usage, description='measure the performance of xsc', version=xsc.__version__)
+    parser.add_option('--rows', dest='rowCounts', metavar='NUMBERS', default=','.join(str(rowCount) for rowCount in DefaultRowCounts),
+        help='comma separated numbers of data rows to benchmark with, for example 1000,1000000 (default: %default)')
+    parser.add_option('--scenarios', dest='scenarioNames', metavar='NAMES', default=','.join(ScenarioNames),
+        help='comma separated names of scenarios to benchmark (default: %default)')
+    parser.add_option('--data', dest='dataFolderPath', metavar='FOLDER',
+        help='folder where to keep generated data for later runs (default: temporary folder)')
+    parser.add_option('--engine', dest='engine', type='choice', choices=list(xsc._Engines), default=xsc.EngineCompiled,
+        help='engine to render templates: %s (default: %%default)' % ', '.join(xsc._Engines))
+    parser.add_option('--writer', dest='writer', type='choice', choices=list(xsc._Writers), default=xsc.WriterNative,
+        help='writer to produce the XML output with: %s (default: %%default)' % ', '.join(xsc._Writers))
+    parser.add_option('-j', '--jobs', dest='jobs', metavar='NUMBER', type='int', default=1,
+        help='number of processes to render rows of outermost loops with (default: %default)')
+    parser.add_option('-o', '--output', dest='outputJsonPath', metavar='FILE',
+        help='JSON file where to store the results, for example to use them as baseline later')
+    parser.add_option('--baseline', dest='baselineJsonPath', metavar='FILE',
+        help='JSON file with results of a previous run to compare with')
+    parser.add_option('--tolerance', dest='tolerance', metavar='PERCENT', type='float', default=DefaultTolerance,
+        help='percentage by which results may be worse than the baseline (default: %default)')
+
+    options, others = parser.parse_args(arguments)
+    if others:
+        parser.error('unexpected arguments must be removed: %s' % ' '.join(others))
+    try:
+        options.rowCounts = [int(rowCount) for rowCount in options.rowCounts.split(',')]
+    except ValueError:
+        parser.error('--rows must be a comma separated list of numbers but is: %s' % options.rowCounts)
+    if any(rowCount < 1 for rowCount in options.rowCounts):
+        parser.error('--rows must be at least 1: %s' % options.rowCounts)
+    options.scenarioNames = [name.strip() for name in options.scenarioNames.split(',')]
+    for scenarioName in options.scenarioNames:
+        if scenarioName not in ScenarioNames:
+            parser.error('--scenarios must be some of %s but contains: %s' % (', '.join(ScenarioNames), scenarioName))
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1 but is: %d' % options.jobs)
+    if options.tolerance < 0:
+        parser.error('--tolerance must be at least 0 but is: %s' % options.tolerance)
+    return options
+
+def main(arguments=None):
+    """
+    Main function for command line call returning an exit code, which is 1 if results are
+    worse than the baseline.
+    """
+    if arguments is None:
+        arguments = sys.argv
+    options = _parsedOptions(arguments[1:])
+    benchmarkResult = benchmark(
+        options.rowCounts, options.scenarioNames, options.dataFolderPath, options.engine, options.writer, options.jobs
+    )
+    for reportLine in reportLines(benchmarkResult):
+        _log.info(u'%s', reportLine)
+    if options.outputJsonPath is not None:
+        _log.info(u'write results to "%s"', options.outputJsonPath)
+        with open(options.outputJsonPath, 'wb') as outputJsonFile:
+            json.dump(benchmarkResult, outputJsonFile, indent=2, sort_keys=True)
+    exitCode = 0
+    if options.baselineJsonPath is not None:
+        with open(options.baselineJsonPath, 'rb') as baselineJsonFile:
+            baselineResult = json.load(baselineJsonFile)
+        regressionMessages = regressions(benchmarkResult, baselineResult, options.tolerance)
+        if regressionMessages:
+            _log.error(u'found %d regressions compared to "%s":', len(regressionMessages), options.baselineJsonPath)
+            for regressionMessage in regressionMessages:
+                _log.error(u'  %s', regressionMessage)
+            exitCode = 1
+        else:
+            _log.info(u'found no regressions compared to "%s"', options.baselineJsonPath)
+    return exitCode
+
+if __name__ == '__main__': # pragma: no cover
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('cutplace').setLevel(logging.WARNING)
+    sys.exit(main())
@@ -64,7 +64,7 @@ try:
     setup(
         name="xsc",
         version=xsc.__version__,
-        py_modules=["xsc"],
+        py_modules=["xsc", "xsc_client", "xsc_server"],
         description=xsc._Description,
         install_requires=[
             "coverage>=3.2",
@@ -72,9 +72,15 @@ try:
             "loxun>=1.2",
             "nose>=1.0"
         ],
+        extras_require={
+            "xz": ["backports.lzma"]
+        },
         entry_points = {
             'console_scripts': [
-                'xsc = xsc:mainWithExit'
+                'xsc = xsc:mainWithExit',
+                'xsc-batch = xsc:batchMainWithExit',
+                'xsc-client = xsc_client:mainWithExit',
+                'xsc-server = xsc_server:serverMainWithExit'
             ],
         },
         test_suite = "nose.collector",
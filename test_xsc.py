@@ -16,23 +16,54 @@ Test for xsc.
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import xsc
+import xsc_client
+import xsc_server
+import benchmark_xsc
+import bz2
+import cutplace.interface
+import decimal
+import gzip
+import json
 import logging
+import loxun
 import os.path
+import pickle
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
 import unittest
+import xml.dom.minidom
+import xml.sax.saxutils
 
 def _testFilePath(name):
     return os.path.join('test', name)
 
+_BatchManifestPath = _testFilePath('batch.manifest')
+_BrokenExpressionXscPath = _testFilePath('brokenExpression.xsc')
+_BrokenSyntaxXscPath = _testFilePath('brokenSyntax.xsc')
 _CommentXscPath = _testFilePath('comment.xsc')
 _CustomersXscPath = _testFilePath('customers.xsc')
 _EdmBalanceXscPath = _testFilePath('edmBalance.xsc')
+_EdmBalanceJoinXscPath = _testFilePath('edmBalanceJoin.xsc')
 _EmptyXscPath = _testFilePath('empty.xsc')
 _ImportXscPath = _testFilePath('import.xsc')
+_LoanGroupsXscPath = _testFilePath('loanGroups.xsc')
+_LoanTotalsXscPath = _testFilePath('loanTotals.xsc')
 _MissingEndForXscPath = _testFilePath('brokenMissingEndFor.xsc')
 _MissingEndIfXscPath = _testFilePath('brokenMissingEndIf.xsc')
 _NamespaceXscPath = _testFilePath('namespace.xsc')
+_OlderCustomersXscPath = _testFilePath('olderCustomers.xsc')
 _PythonXscPath = _testFilePath('python.xsc')
 
+class _Interface(object):
+    """
+    Minimal stand in for a cutplace interface.
+    """
+    def __init__(self, fieldNames):
+        self.fieldNames = fieldNames
+
 class _ExpectedFileTest(unittest.TestCase):
     def assertFileMatches(self, actualFilePath):
         assert actualFilePath is not None
@@ -50,6 +81,49 @@ class _ExpectedFileTest(unittest.TestCase):
                     self.assertEqual(actualLine.rstrip('\n\r'), expectedLine.rstrip('\n\r'), 'file "%s", line %d:\n  a:%r\n  e:%r' % (actualFilePath, lineNumber, actualLine, expectedLine))
                     lineNumber += 1
 
+class _CollectingLogHandler(logging.Handler):
+    """
+    Handler collecting messages of the ``xsc`` logger with level INFO and above while used
+    in a ``with`` statement.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self._log = logging.getLogger('xsc')
+        self._oldLevel = None
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def __enter__(self):
+        self._oldLevel = self._log.level
+        self._log.addHandler(self)
+        self._log.setLevel(logging.INFO)
+        return self
+
+    def __exit__(self, errorType, error, traceback):
+        self._log.removeHandler(self)
+        self._log.setLevel(self._oldLevel)
+
+class _TempFolderTest(_ExpectedFileTest):
+    """
+    Test with a temporary folder that is removed afterwards.
+    """
+    def setUp(self):
+        self._tempFolderPath = tempfile.mkdtemp(prefix='xsc_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self._tempFolderPath)
+
+    def _template(self, content, name='test.xsc'):
+        """
+        `xsc.XscTemplate` read from a file in the temporary folder containing ``content``.
+        """
+        xscFilePath = os.path.join(self._tempFolderPath, name)
+        with open(xscFilePath, 'wb') as xscFile:
+            xscFile.write(content)
+        return xsc.XscTemplate(xscFilePath)
+
 class CheckPythonNameTest(unittest.TestCase):
     def testCanProcessValidName(self):
         xsc._checkPythonName('test', 'some_name')
@@ -112,6 +186,1433 @@ class TextTemplateTest(unittest.TestCase):
             ('text', u' and he likes it')
         ])
 
+class CodeWriterTest(unittest.TestCase):
+    def testCanIsolateExpressionWithComment(self):
+        code = xsc._CodeWriter()
+        code.line(u'x = %s' % code.expression(u'1 # some comment'))
+        code.line(u'y = x + %s' % code.expression(u'2'))
+        namespace = {}
+        exec code.source in namespace
+        self.assertEqual(namespace['y'], 3)
+        self.assertEqual(code.lineToExpressionMap, {1: u'1 # some comment', 3: u'2'})
+
+    def testCanReuseConstant(self):
+        code = xsc._CodeWriter()
+        someName = code.constant(unicode, 'Unicode')
+        self.assertEqual(code.constant(unicode, 'Unicode'), someName)
+        self.assertEqual(code.constants, [(someName, unicode)])
+
+class XscCompiledTemplateTest(_TempFolderTest):
+    def _testCanConvertCustomers(self, engine):
+        template = xsc.XscTemplate(_CustomersXscPath)
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        xsc.convert(template, {'customers': (_testFilePath('customers.csv'), None)}, targetXmlFilePath, engine=engine)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanConvertCustomersWithCompiledEngine(self):
+        self._testCanConvertCustomers(xsc.EngineCompiled)
+
+    def testCanConvertCustomersWithInterpretedEngine(self):
+        self._testCanConvertCustomers(xsc.EngineInterpreted)
+
+    def testCanCompileToPythonFunction(self):
+        template = xsc.XscTemplate(_CustomersXscPath)
+        source = template.compiled.source
+        self.assertTrue(source.startswith('def _xscRender(_xml, _sources'), source)
+        self.assertTrue(u'customers.surname' in source, source)
+
+    def _testFailsOnBrokenExpression(self, engine):
+        template = xsc.XscTemplate(_BrokenExpressionXscPath)
+        targetXmlFilePath = os.path.join('test', 'brokenExpression.xml')
+        try:
+            xsc.convert(template, {'customers': (_testFilePath('customers.csv'), None)}, targetXmlFilePath, engine=engine)
+            self.fail('XscValueError must be raised') # pragma: no cover
+        except xsc.XscValueError, error:
+            self.assertTrue('customers.noSuchColumn' in unicode(error), unicode(error))
+            self.assertTrue('noSuchColumn' in unicode(error), unicode(error))
+
+    def testFailsOnBrokenExpressionWithCompiledEngine(self):
+        self._testFailsOnBrokenExpression(xsc.EngineCompiled)
+
+    def testFailsOnBrokenExpressionWithInterpretedEngine(self):
+        self._testFailsOnBrokenExpression(xsc.EngineInterpreted)
+
+    def testFailsOnBrokenSyntax(self):
+        self.assertRaises(xsc.XscSyntaxError, xsc.XscTemplate, _BrokenSyntaxXscPath)
+
+    def testFailsOnBrokenConditionWithLocation(self):
+        try:
+            self._template('<c>\n  <?xsc for c?><?xsc if c.a ==?><x/><?xsc end if?><?xsc end for?>\n</c>')
+            self.fail('XscSyntaxError must be raised') # pragma: no cover
+        except xsc.XscSyntaxError, error:
+            self.assertTrue(unicode(error).startswith(u'2:'), unicode(error))
+
+class StaticNodeTest(unittest.TestCase):
+    def _staticNodes(self, xscNode):
+        result = []
+        for childNode in xscNode.childNodes or []:
+            if isinstance(childNode, xsc.StaticNode):
+                result.append(childNode)
+            else:
+                result.extend(self._staticNodes(childNode))
+        return result
+
+    def testCanFoldStaticSubtrees(self):
+        template = xsc.XscTemplate(_EdmBalanceXscPath)
+        staticData = [staticNode.data for staticNode in self._staticNodes(template.content)]
+        specifiedLocationData = [data for data in staticData if u'<SpecifiedLocation>' in data]
+        self.assertEqual(len(specifiedLocationData), 1, staticData)
+        self.assertTrue(u'<CountryID>040</CountryID>' in specifiedLocationData[0])
+
+    def testCanFoldWholeDocument(self):
+        template = xsc.XscTemplate(_CommentXscPath)
+        self.assertEqual(len(template.content.childNodes), 1)
+        staticNode = template.content.childNodes[0]
+        self.assertTrue(isinstance(staticNode, xsc.StaticNode))
+        self.assertEqual(staticNode.encodedData, '<text/>')
+
+    def testCanEncodeLikeXmlWriter(self):
+        elementNode = xsc.ElementNode(u'some:tag', [(u'b', u'<2>'), (u'a', u'1')])
+        elementNode.addChild(xsc.TextNode(u'\u00fcber & more'))
+        elementNode.addChild(xsc.CommentNode(u'note'))
+        elementNode.addChild(xsc.ElementNode(u'empty', []))
+        self.assertEqual(
+            xsc.StaticNode([elementNode]).encodedData,
+            '<some:tag a="1" b="&lt;2&gt;">\xc3\xbcber &amp; more<!-- note --><empty/></some:tag>'
+        )
+
+    def testCannotFoldDynamicText(self):
+        self.assertFalse(xsc.TextNode(u'${1}').isStatic)
+        elementNode = xsc.ElementNode(u'some', [(u'a', u'${1}')])
+        self.assertFalse(elementNode.isStatic)
+
+class NativeXmlWriterTest(_ExpectedFileTest):
+    _TrickyValues = [u'', u'plain', u'\u00fcber', u'<&>', u'say "hi"', u"it's", u'"both\'', u'a\nb\r\tc', 17, 'b\xc3\xbcro']
+
+    def _writtenXml(self, writer, xscNode, namespace):
+        output = StringIO.StringIO()
+        with xsc._newXmlWriter(writer, output) as xmlWriter:
+            xscNode.write(xmlWriter, {}, namespace)
+        return output.getvalue()
+
+    def testCanQuoteLikeLoxun(self):
+        for value in NativeXmlWriterTest._TrickyValues:
+            unicodeValue = value.decode('utf-8') if isinstance(value, str) else unicode(value)
+            self.assertEqual(xsc._quotedAttributeValue(value), xml.sax.saxutils.quoteattr(unicodeValue).encode('utf-8'))
+            self.assertEqual(xsc._escapedText(value), xml.sax.saxutils.escape(unicodeValue).encode('utf-8'))
+
+    def testCanWriteLikeLoxun(self):
+        elementNode = xsc.ElementNode(u'x:some', [
+            (u'xmlns:x', u'http://example.com/${name}'), (u'b', u'${value}'), (u'a', u'1'), (u'c', u'<${value}>')
+        ])
+        elementNode.addChild(xsc.TextNode(u'${value}'))
+        elementNode.addChild(xsc.ElementNode(u'empty', [(u'value', u'${value}')]))
+        elementNode.addChild(xsc.ElementNode(u'emptyText', []))
+        elementNode.childNodes[-1].addChild(xsc.TextNode(u'${""}'))
+        # Expressions must not result in non ASCII strings, so skip the UTF-8 encoded one.
+        for value in NativeXmlWriterTest._TrickyValues[:-1]:
+            namespace = {'name': u'n', 'value': value}
+            self.assertEqual(
+                self._writtenXml(xsc.WriterNative, elementNode, namespace),
+                self._writtenXml(xsc.WriterLoxun, elementNode, namespace)
+            )
+
+    def _testCanConvertWithWriter(self, engine, writer):
+        template = xsc.XscTemplate(_NamespaceXscPath)
+        targetXmlFilePath = os.path.join('test', 'namespace.xml')
+        xsc.convert(
+            template, {'customers': (_testFilePath('customers.csv'), None)}, targetXmlFilePath, engine=engine, writer=writer
+        )
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanConvertWithNativeWriter(self):
+        self._testCanConvertWithWriter(xsc.EngineCompiled, xsc.WriterNative)
+        self._testCanConvertWithWriter(xsc.EngineInterpreted, xsc.WriterNative)
+
+    def testCanConvertWithLoxunWriter(self):
+        self._testCanConvertWithWriter(xsc.EngineCompiled, xsc.WriterLoxun)
+        self._testCanConvertWithWriter(xsc.EngineInterpreted, xsc.WriterLoxun)
+
+    def testFailsOnBrokenComment(self):
+        self.assertRaises(loxun.XmlError, self._writtenXml, xsc.WriterNative, xsc.CommentNode(u'a--b'), {})
+
+class StreamedDataSourceTest(_ExpectedFileTest):
+    def testCanDetectSinglePassSources(self):
+        self.assertEqual(xsc.XscTemplate(_CustomersXscPath).singlePassSourceNames, set(['customers']))
+        # edmNotification is read twice and edmPeriod once for each edmNotification.
+        self.assertEqual(xsc.XscTemplate(_EdmBalanceXscPath).singlePassSourceNames, set())
+
+    def _customersConverter(self, isStreamed):
+        result = xsc.Converter(xsc.XscTemplate(_CustomersXscPath), isStreamed=isStreamed)
+        with open(_testFilePath('customers.csv'), 'rb') as dataFile:
+            interface = cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding='utf-8', header=1)
+        result.setInterface('customers', interface)
+        result.setData('customers', _testFilePath('customers.csv'))
+        return result
+
+    def testCanLoadSinglePassSourceByDefault(self):
+        converter = self._customersConverter(False)
+        self.assertFalse(converter.source('customers').isStreamed)
+        self.assertEqual(len(list(converter.dataFor('customers'))), 3)
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        converter.write(targetXmlFilePath)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanStreamSinglePassSource(self):
+        converter = self._customersConverter(True)
+        self.assertTrue(converter.source('customers').isStreamed)
+        self.assertEqual(converter.dataFor('customers'), None)
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        converter.write(targetXmlFilePath)
+        self.assertFileMatches(targetXmlFilePath)
+        self.assertEqual(converter.source('customers').rowCount, 3)
+
+    def testCanWriteStreamedSourceTwice(self):
+        converter = self._customersConverter(True)
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        for _ in range(2):
+            converter.write(targetXmlFilePath)
+            self.assertFileMatches(targetXmlFilePath)
+            self.assertEqual(converter.source('customers').rowCount, 3)
+
+    def testFailsOnStreamingTwice(self):
+        source = xsc.DataSource('customers')
+        source.setData(_testFilePath('customers.csv'), isStreamed=True)
+        self.assertEqual(source.data, None)
+        source.rows()
+        self.assertRaises(xsc.XscError, source.rows)
+
+class ColumnarRowsTest(unittest.TestCase):
+    def _columnarRows(self, rows):
+        result = xsc._ColumnarRows(len(rows[0]))
+        for row in rows:
+            result.append(row)
+        result.packDiverseColumns()
+        return result
+
+    def testCanAccessRows(self):
+        rows = [[u'1', u'a'], [u'2', u'b'], [u'3', u'a']]
+        columnarRows = self._columnarRows(rows)
+        self.assertEqual(len(columnarRows), 3)
+        self.assertEqual(list(columnarRows), rows)
+        self.assertEqual(columnarRows[1][0], u'2')
+        self.assertEqual(columnarRows[-1][1], u'a')
+        self.assertEqual(len(columnarRows[0]), 2)
+        self.assertRaises(IndexError, columnarRows.__getitem__, 3)
+
+    def testCanPackDiverseColumns(self):
+        rows = [[unicode(rowIndex), u'\u20ac%d' % (rowIndex % 3)] for rowIndex in range(2000)]
+        columnarRows = self._columnarRows(rows)
+        self.assertTrue(isinstance(columnarRows._columns[0], xsc._PackedColumn))
+        self.assertTrue(isinstance(columnarRows._columns[1], xsc._DictionaryColumn))
+        self.assertEqual(list(columnarRows), rows)
+
+    def testCanGrowDictionaryCodes(self):
+        column = xsc._DictionaryColumn()
+        for value in range(300):
+            column.append(value)
+        self.assertEqual(column._codes.typecode, 'H')
+        self.assertEqual([column[rowIndex] for rowIndex in range(300)], range(300))
+
+    def testCanGrowDictionaryCodesBeyondLargestLimit(self):
+        originalCodeTypes = xsc._DictionaryColumn._CodeTypes
+        xsc._DictionaryColumn._CodeTypes = (('B', 2), ('H', 4), ('i', 8), ('l', None))
+        try:
+            column = xsc._DictionaryColumn()
+            for value in range(20):
+                column.append(value)
+            self.assertEqual(column._codes.typecode, 'l')
+            self.assertEqual([column[rowIndex] for rowIndex in range(20)], range(20))
+            unpickledColumn = pickle.loads(pickle.dumps(column, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual([unpickledColumn[rowIndex] for rowIndex in range(20)], range(20))
+        finally:
+            xsc._DictionaryColumn._CodeTypes = originalCodeTypes
+
+    def testCanPickleColumnarRows(self):
+        rows = [[unicode(rowIndex), u'\u20ac%d' % (rowIndex % 3)] for rowIndex in range(2000)]
+        columnarRows = self._columnarRows(rows)
+        self.assertEqual(list(pickle.loads(pickle.dumps(columnarRows, pickle.HIGHEST_PROTOCOL))), rows)
+
+    def testCanIndexColumnarSource(self):
+        source = xsc.DataSource('customers')
+        with open(_testFilePath('customers.csv'), 'rb') as dataFile:
+            source.setInterface(cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding='utf-8', header=1))
+        source.setData(_testFilePath('customers.csv'))
+        self.assertTrue(isinstance(source.data, xsc._ColumnarRows))
+        self.assertEqual(source.rowCount, 3)
+        firstRow = source.data[0]
+        self.assertEqual(source.rowsWhere(source.interface.fieldNames[0], firstRow[0]), [firstRow])
+        self.assertEqual(source.rowsWhere(source.interface.fieldNames[0], u'no such value'), ())
+
+class CompressedDataTest(_TempFolderTest):
+    def testCanDetectCompression(self):
+        self.assertEqual(xsc._dataCompression(_testFilePath('customers.csv')), None)
+        self.assertEqual(xsc._dataCompression(_testFilePath('customers.csv.gz')), 'gzip')
+        self.assertEqual(xsc._dataCompression(_testFilePath('customers.csv.bz2')), 'bzip2')
+        self.assertEqual(xsc._dataCompression(_testFilePath('customers.csv.xz')), 'xz')
+
+    def testCanDetectUncompressedDataStartingWithBzip2Magic(self):
+        dataFilePath = os.path.join(self._tempFolderPath, 'bzh.csv')
+        with open(dataFilePath, 'wb') as dataFile:
+            dataFile.write('BZh,1AY&SY\nBZh9,1AY&SY\n')
+        self.assertEqual(xsc._dataCompression(dataFilePath), None)
+        with open(dataFilePath, 'wb') as dataFile:
+            dataFile.write(bz2.compress(''))
+        self.assertEqual(xsc._dataCompression(dataFilePath), 'bzip2')
+
+    def _testCanConvertCompressedData(self, dataFileName):
+        template = xsc.XscTemplate(_CustomersXscPath)
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        xsc.convert(template, {'customers': (_testFilePath(dataFileName), None)}, targetXmlFilePath)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanConvertGzipData(self):
+        self._testCanConvertCompressedData('customers.csv.gz')
+
+    def testCanConvertBzip2Data(self):
+        self._testCanConvertCompressedData('customers.csv.bz2')
+
+    def testCanConvertXzData(self):
+        if xsc.lzma is None:
+            self.assertRaises(xsc.XscError, self._testCanConvertCompressedData, 'customers.csv.xz')
+        else:
+            self._testCanConvertCompressedData('customers.csv.xz')
+
+    def testCanLoadCompressedData(self):
+        source = xsc.DataSource('customers')
+        with open(_testFilePath('customers.csv'), 'rb') as dataFile:
+            source.setInterface(cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding='utf-8', header=1))
+        source.setData(_testFilePath('customers.csv.gz'))
+        self.assertEqual(source.rowCount, 3)
+
+class CompressedOutputTest(_TempFolderTest):
+    def _convertedCustomers(self, target, compression=None):
+        converter = xsc.Converter(xsc.XscTemplate(_CustomersXscPath))
+        converter.setInterface('customers', xsc._readInterface(_testFilePath('customers.csv'), None, 'utf-8'))
+        converter.setData('customers', _testFilePath('customers.csv'))
+        converter.write(target, compression=compression)
+
+    def _expectedCustomersXml(self):
+        with open(os.path.join('test', 'expected', 'customers.xml'), 'rb') as expectedFile:
+            return expectedFile.read()
+
+    def _testCanCompressBySuffix(self, suffix, openCompressed):
+        targetXmlFilePath = os.path.join(self._tempFolderPath, 'customers.xml' + suffix)
+        self._convertedCustomers(targetXmlFilePath)
+        compressedFile = openCompressed(targetXmlFilePath)
+        try:
+            self.assertEqual(compressedFile.read(), self._expectedCustomersXml())
+        finally:
+            compressedFile.close()
+
+    def testCanCompressGzipBySuffix(self):
+        self._testCanCompressBySuffix('.gz', gzip.open)
+
+    def testCanCompressBzip2BySuffix(self):
+        self._testCanCompressBySuffix('.bz2', bz2.BZ2File)
+
+    def testCanCompressXzBySuffix(self):
+        if xsc.lzma is None:
+            self.assertRaises(xsc.XscError, self._testCanCompressBySuffix, '.xz', None)
+        else:
+            self._testCanCompressBySuffix('.xz', xsc.lzma.LZMAFile)
+
+    def testCanWriteToFile(self):
+        output = StringIO.StringIO()
+        self._convertedCustomers(output)
+        self.assertEqual(output.getvalue(), self._expectedCustomersXml())
+
+    def testCanCompressFile(self):
+        output = StringIO.StringIO()
+        self._convertedCustomers(output, xsc.CompressionGzip)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(output.getvalue())).read(), self._expectedCustomersXml())
+
+    def testCanWriteToStandardOutput(self):
+        standardOutput = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            exitCode, _ = xsc.main(['test', '--output', '-', _CustomersXscPath, 'customers:%s' % _testFilePath('customers.csv')])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = standardOutput
+        self.assertEqual(exitCode, 0)
+        self.assertEqual(output, self._expectedCustomersXml())
+
+class SniffTest(_TempFolderTest):
+    def _growingDataPath(self, rowCount):
+        # Data where later rows have longer values than earlier ones.
+        result = os.path.join(self._tempFolderPath, 'growing.csv')
+        with open(result, 'wb') as dataFile:
+            dataFile.write('id,name\n')
+            for rowIndex in range(rowCount):
+                dataFile.write('%d,%s\n' % (rowIndex, 'x' * (rowIndex + 1)))
+        return result
+
+    def testCanSniffSample(self):
+        customersPath = _testFilePath('customers.csv')
+        sample, isCompleteSample = xsc._sniffSample(customersPath, 1, 2, 0)
+        self.assertEqual(sample.count('\n'), 3)
+        self.assertFalse(isCompleteSample)
+        sample, isCompleteSample = xsc._sniffSample(customersPath, 1, 0, 1)
+        self.assertEqual(sample.count('\n'), 2)
+        self.assertFalse(isCompleteSample)
+        with open(customersPath, 'rb') as customersFile:
+            self.assertEqual(xsc._sniffSample(customersPath, 1, 0, 0), (customersFile.read(), True))
+
+    def testCanSniffSampleWithValuesSpanningLines(self):
+        dataPath = os.path.join(self._tempFolderPath, 'notes.csv')
+        with open(dataPath, 'wb') as dataFile:
+            dataFile.write('id,note\n1,"some ""quoted""\nlines"\n2,x\n')
+        self.assertEqual(xsc._sniffSample(dataPath, 1, 1, 0), ('id,note\n1,"some ""quoted""\nlines"\n', False))
+        self.assertEqual(xsc._sniffSample(dataPath, 1, 0, 20), ('id,note\n1,"some ""quoted""\nlines"\n', False))
+
+    def testCanValidateRowsBeyondSample(self):
+        dataPath = self._growingDataPath(100)
+        with _CollectingLogHandler() as logHandler:
+            interface = xsc._readInterface(dataPath, None, 'utf-8', sniffLineCount=10)
+        self.assertTrue(any(u'accept any text' in message for message in logHandler.messages), logHandler.messages)
+        with _CollectingLogHandler() as logHandler:
+            xsc._readInterface(dataPath, None, 'utf-8', sniffLineCount=0)
+        self.assertFalse(any(u'accept any text' in message for message in logHandler.messages), logHandler.messages)
+        source = xsc.DataSource('growing')
+        source.setInterface(interface)
+        source.setData(dataPath)
+        self.assertEqual(source.rowCount, 100)
+        self.assertEqual(source.data[99][1], u'x' * 100)
+
+    def testCanUseCachedSniffedInterface(self):
+        dataPath = self._growingDataPath(20)
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        interface = xsc._readInterface(dataPath, None, 'utf-8', sniffLineCount=10, dataCache=dataCache)
+        oldCreateCidRows = xsc.cutplace.sniff.createCidRows
+        def brokenCreateCidRows(*arguments, **keywords):
+            raise AssertionError('interface must be taken from cache')
+        xsc.cutplace.sniff.createCidRows = brokenCreateCidRows
+        try:
+            cachedInterface = xsc._readInterface(dataPath, None, 'utf-8', sniffLineCount=10, dataCache=dataCache)
+        finally:
+            xsc.cutplace.sniff.createCidRows = oldCreateCidRows
+        self.assertEqual(cachedInterface.fieldNames, interface.fieldNames)
+        self.assertEqual(xsc._interfaceFingerprint(cachedInterface), xsc._interfaceFingerprint(interface))
+
+    def testFailsOnBrokenSniffLines(self):
+        self.assertRaises(SystemExit, xsc._parsedOptions, ['--sniff-lines', '-1', _CustomersXscPath])
+
+class DataCacheTest(_TempFolderTest):
+    def _cacheFileNames(self):
+        return [name for name in os.listdir(self._tempFolderPath) if name.endswith('.rows')]
+
+    def testCanStoreAndLoadRows(self):
+        rows = xsc._ColumnarRows(2)
+        for rowIndex in range(3000):
+            rows.append([unicode(rowIndex), u'\u20ac%d' % (rowIndex % 3)])
+        rows.packDiverseColumns()
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        key = (1, 2.0, 'some hash')
+        self.assertEqual(dataCache.rows(key), None)
+        dataCache.storeRows(key, rows)
+        cachedRows = dataCache.rows(key)
+        self.assertEqual(len(cachedRows), 3000)
+        self.assertEqual(list(cachedRows), list(rows))
+        self.assertTrue(isinstance(cachedRows._columns[0]._data, xsc._MappedData))
+
+    def testIgnoresBrokenCacheFile(self):
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        key = (1, 2.0, 'some hash')
+        with open(dataCache._cachePath(key), 'wb') as brokenCacheFile:
+            brokenCacheFile.write(xsc._DataCache._Magic + 'broken')
+        self.assertEqual(dataCache.rows(key), None)
+
+    def testIgnoresCacheFileWithOtherKeyWithoutMappingIt(self):
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        rows = xsc._ColumnarRows(1)
+        rows.append([u'a'])
+        dataCache.storeRows((1, 2.0, 'some hash'), rows)
+        otherKey = (1, 2.0, 'other hash')
+        shutil.copy(dataCache._cachePath((1, 2.0, 'some hash')), dataCache._cachePath(otherKey))
+        oldMmap = xsc.mmap.mmap
+        def brokenMmap(*arguments, **keywords):
+            raise AssertionError('cache file with other key must not be mapped')
+        xsc.mmap.mmap = brokenMmap
+        try:
+            self.assertEqual(dataCache.rows(otherKey), None)
+        finally:
+            xsc.mmap.mmap = oldMmap
+        self.assertEqual([list(row) for row in dataCache.rows((1, 2.0, 'some hash'))], [[u'a']])
+
+    def _edmBalanceConverter(self):
+        converter = xsc.Converter(xsc.XscTemplate(_EdmBalanceXscPath), self._tempFolderPath)
+        for name, dataFileName, cidFileName in (
+            ('edmNotification', 'edmBalanceNotification.csv', 'cid_edmBalanceNotification.xls'),
+            ('edmPeriod', 'edmBalancePeriod.csv', 'cid_edmBalancePeriod.xls')
+        ):
+            interface = cutplace.interface.InterfaceControlDocument()
+            interface.read(_testFilePath(cidFileName))
+            converter.setInterface(name, interface)
+            converter.setData(name, _testFilePath(dataFileName))
+        return converter
+
+    def testCanConvertWithCachedRows(self):
+        uncachedRows = list(self._edmBalanceConverter().dataFor('edmPeriod'))
+        self.assertEqual(len(self._cacheFileNames()), 2)
+        converter = self._edmBalanceConverter()
+        self.assertEqual(list(converter.dataFor('edmPeriod')), uncachedRows)
+        targetXmlFilePath = os.path.join('test', 'edmBalance.xml')
+        converter.write(targetXmlFilePath)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanSkipCachingStreamedRows(self):
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        for _ in range(2):
+            exitCode, _ = xsc.main([
+                'test', '--cache', self._tempFolderPath, _CustomersXscPath, 'customers:%s' % _testFilePath('customers.csv')
+            ])
+            self.assertEqual(exitCode, 0)
+            self.assertFileMatches(targetXmlFilePath)
+            self.assertEqual(len(self._cacheFileNames()), 0)
+
+    def testCanDetectChangedInterface(self):
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        with open(_testFilePath('customers.csv'), 'rb') as dataFile:
+            interface = cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding='utf-8', header=1)
+        with open(_testFilePath('customers.csv'), 'rb') as dataFile:
+            otherInterface = cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding='iso-8859-15', header=1)
+        self.assertEqual(
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface),
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface)
+        )
+        self.assertNotEqual(
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface),
+            dataCache.rowsKey(_testFilePath('customers.csv'), otherInterface)
+        )
+
+    def testCanCacheCompiledTemplate(self):
+        for _ in range(2):
+            template = xsc.XscTemplate(_EdmBalanceXscPath, self._tempFolderPath)
+            self.assertEqual(len([name for name in os.listdir(self._tempFolderPath) if name.endswith('.xsct')]), 1)
+            self.assertEqual(template.singlePassSourceNames, set())
+            self.assertTrue(template.parallelLoops[0] in template.content.childNodes[-1].childNodes)
+            for engine in xsc._Engines:
+                converter = xsc.Converter(template)
+                for name, dataFileName, cidFileName in (
+                    ('edmNotification', 'edmBalanceNotification.csv', 'cid_edmBalanceNotification.xls'),
+                    ('edmPeriod', 'edmBalancePeriod.csv', 'cid_edmBalancePeriod.xls')
+                ):
+                    converter.setInterface(name, xsc._readInterface(_testFilePath(dataFileName), _testFilePath(cidFileName), 'utf-8'))
+                    converter.setData(name, _testFilePath(dataFileName))
+                targetXmlFilePath = os.path.join('test', 'edmBalance.xml')
+                converter.write(targetXmlFilePath, engine)
+                self.assertFileMatches(targetXmlFilePath)
+
+    def testCanCacheTemplateWithPythonCodeAndImports(self):
+        for xscPath in (_PythonXscPath, _ImportXscPath):
+            xsc.XscTemplate(xscPath, self._tempFolderPath)
+            template = xsc.XscTemplate(xscPath, self._tempFolderPath)
+            targetXmlFilePath = os.path.splitext(xscPath)[0] + '.xml'
+            xsc.convert(template, {}, targetXmlFilePath)
+            self.assertFileMatches(targetXmlFilePath)
+        self.assertEqual(template.importedModules.keys(), ['errno'])
+
+    def testIgnoresBrokenTemplateCacheFile(self):
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        key = dataCache.templateKey(_CustomersXscPath)
+        with open(dataCache._cachePath(key, '.xsct'), 'wb') as brokenCacheFile:
+            brokenCacheFile.write(xsc._DataCache._TemplateMagic + 'broken')
+        self.assertEqual(dataCache.templateState(key), None)
+        template = xsc.XscTemplate(_CustomersXscPath, self._tempFolderPath)
+        self.assertEqual(template.singlePassSourceNames, set(['customers']))
+
+class ConcurrentLoadingTest(_ExpectedFileTest):
+    def _edmBalanceConverter(self, notificationCidFileName='cid_edmBalanceNotification.xls'):
+        result = xsc.Converter(xsc.XscTemplate(_EdmBalanceXscPath))
+        for name, cidFileName in (('edmNotification', notificationCidFileName), ('edmPeriod', 'cid_edmBalancePeriod.xls')):
+            interface = cutplace.interface.InterfaceControlDocument()
+            interface.read(_testFilePath(cidFileName))
+            result.setInterface(name, interface)
+        return result
+
+    def _edmBalanceNameToDataFilePathMap(self):
+        return {
+            'edmNotification': _testFilePath('edmBalanceNotification.csv'),
+            'edmPeriod': _testFilePath('edmBalancePeriod.csv'),
+        }
+
+    def testCanLoadConcurrently(self):
+        converter = self._edmBalanceConverter()
+        converter.setAllData(self._edmBalanceNameToDataFilePathMap(), 2)
+        self.assertEqual(converter.source('edmPeriod').rowCount, 40)
+        self.assertEqual(converter.source('edmPeriod').dataFilePath, _testFilePath('edmBalancePeriod.csv'))
+        targetXmlFilePath = os.path.join('test', 'edmBalance.xml')
+        converter.write(targetXmlFilePath)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testFailsOnBrokenDataSource(self):
+        # Validating notifications with the interface for periods fails.
+        converter = self._edmBalanceConverter('cid_edmBalancePeriod.xls')
+        try:
+            converter.setAllData(self._edmBalanceNameToDataFilePathMap(), 2)
+            self.fail('XscError must be raised') # pragma: no cover
+        except xsc.XscError, error:
+            self.assertTrue('1 of 2 data sources' in unicode(error), unicode(error))
+            self.assertTrue("'edmNotification'" in unicode(error), unicode(error))
+
+    def testCanReadInterfacesConcurrently(self):
+        nameToInterfaceMap = xsc._readInterfacesConcurrently({
+            'customers': (_testFilePath('customers.csv'), None),
+            'edmPeriod': (_testFilePath('edmBalancePeriod.csv'), _testFilePath('cid_edmBalancePeriod.xls')),
+        }, 'utf-8', xsc.DefaultSniffLineCount, 0, None, 2)
+        self.assertEqual(nameToInterfaceMap['customers'].fieldNames, [u'id', u'surname', u'firstname', u'dateOfBirth'])
+        self.assertEqual(len(nameToInterfaceMap['edmPeriod'].fieldNames), 7)
+
+    def testCanPickleInterfaceRows(self):
+        # Interfaces cannot be pickled, so processes must pass rows instead.
+        for dataFileName, cidFileName in (('customers.csv', None), ('edmBalancePeriod.csv', 'cid_edmBalancePeriod.xls')):
+            cidFilePath = _testFilePath(cidFileName) if cidFileName is not None else None
+            interfaceRows, errorMessage = xsc._readInterfaceRowsOrError(
+                'test', _testFilePath(dataFileName), cidFilePath, 'utf-8', xsc.DefaultSniffLineCount, 0, None
+            )
+            self.assertEqual(errorMessage, None)
+            self.assertEqual(pickle.loads(pickle.dumps(interfaceRows)), interfaceRows)
+
+    def testFailsOnBrokenInterface(self):
+        self.assertRaises(xsc.XscError, xsc._readInterfacesConcurrently, {
+            'customers': (_testFilePath('customers.csv'), None),
+            'missing': (_testFilePath('noSuchData.csv'), None),
+        }, 'utf-8', xsc.DefaultSniffLineCount, 0, None, 2)
+
+class JoinTest(_ExpectedFileTest):
+    def _edmBalanceSourceNameToPathMap(self):
+        return {
+            'edmNotification': (_testFilePath('edmBalanceNotification.csv'), _testFilePath('cid_edmBalanceNotification.xls')),
+            'edmPeriod': (_testFilePath('edmBalancePeriod.csv'), _testFilePath('cid_edmBalancePeriod.xls'))
+        }
+
+    def _testCanJoin(self, engine):
+        template = xsc.XscTemplate(_EdmBalanceJoinXscPath)
+        targetXmlFilePath = os.path.join('test', 'edmBalanceJoin.xml')
+        xsc.convert(template, self._edmBalanceSourceNameToPathMap(), targetXmlFilePath, engine=engine)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanJoinWithCompiledEngine(self):
+        self._testCanJoin(xsc.EngineCompiled)
+
+    def testCanJoinWithInterpretedEngine(self):
+        self._testCanJoin(xsc.EngineInterpreted)
+
+    def testCanParseWhere(self):
+        template = xsc.XscTemplate(_EdmBalanceJoinXscPath)
+        forNodes = [xscNode for xscNode in template.content.childNodes[-1].childNodes if isinstance(xscNode, xsc.XscForNode)]
+        innerForNode = [xscNode for xscNode in forNodes[-1].childNodes if isinstance(xscNode, xsc.XscForNode)][0]
+        self.assertEqual(innerForNode.rider, u'edmPeriod')
+        self.assertEqual(innerForNode.keyColumn, u'TakeOverParty_ID')
+        self.assertEqual(innerForNode.keyExpression, u'edmNotification.ObligatedParty_ID')
+
+    def testCanIndexDataSource(self):
+        source = xsc.DataSource('customers')
+        source.interface = _Interface(['id', 'surname'])
+        source.data = [[u'1', u'Doe'], [u'2', u'Miller'], [u'3', u'Doe']]
+        self.assertEqual(source.rowsWhere('surname', u'Doe'), [[u'1', u'Doe'], [u'3', u'Doe']])
+        self.assertEqual(source.rowsWhere('surname', u'Webster'), ())
+        self.assertRaises(xsc.XscValueError, source.index, 'noSuchColumn')
+
+class GroupTest(_ExpectedFileTest):
+    def _testCanGroup(self, engine):
+        template = xsc.XscTemplate(_LoanGroupsXscPath)
+        targetXmlFilePath = os.path.join('test', 'loanGroups.xml')
+        xsc.convert(template, {'loans': (_testFilePath('loans.csv'), None)}, targetXmlFilePath, engine=engine)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanGroupWithCompiledEngine(self):
+        self._testCanGroup(xsc.EngineCompiled)
+
+    def testCanGroupWithInterpretedEngine(self):
+        self._testCanGroup(xsc.EngineInterpreted)
+
+    def testCanStreamGroupedSource(self):
+        self.assertEqual(xsc.XscTemplate(_LoanGroupsXscPath).singlePassSourceNames, set(['loans']))
+
+    def _groupedSource(self, keys):
+        result = xsc.DataSource('loans')
+        result.setInterface(_Interface(['id', 'customer_id']))
+        result.setRows([[unicode(rowIndex), key] for rowIndex, key in enumerate(keys)])
+        return result
+
+    def testCanGroupRows(self):
+        source = self._groupedSource([u'a', u'a', u'b', u'c', u'c'])
+        groupedIds = [[row[0] for row in groupSource.rows()] for groupSource in source.groups('customer_id')]
+        self.assertEqual(groupedIds, [[u'0', u'1'], [u'2'], [u'3', u'4']])
+
+    def testFailsOnUnsortedRows(self):
+        source = self._groupedSource([u'a', u'b', u'a'])
+        self.assertRaises(xsc.XscValueError, list, source.groups('customer_id'))
+
+class AggregateTest(_TempFolderTest):
+    def _testCanComputeAggregates(self, engine):
+        targetXmlFilePath = os.path.join('test', 'loanTotals.xml')
+        xsc.convert(
+            xsc.XscTemplate(_LoanTotalsXscPath), {
+                'customers': (_testFilePath('customers.csv'), None),
+                'loans': (_testFilePath('loans.csv'), None),
+            }, targetXmlFilePath, engine=engine
+        )
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanComputeAggregatesWithCompiledEngine(self):
+        self._testCanComputeAggregates(xsc.EngineCompiled)
+
+    def testCanComputeAggregatesWithInterpretedEngine(self):
+        self._testCanComputeAggregates(xsc.EngineInterpreted)
+
+    def testCanStreamAggregatedSource(self):
+        self.assertEqual(xsc.XscTemplate(_LoanTotalsXscPath).singlePassSourceNames, set(['customers', 'loans']))
+
+    def testCanComputeAllFunctions(self):
+        source = xsc.DataSource('loans')
+        source.setInterface(_Interface(['customer_id', 'balance']))
+        source.setRows([[u'1', u'2.5'], [u'1', u''], [u'2', u'4'], [u'1', u'0.5']])
+        aggregates = [
+            xsc.XscAggregate('%sByCustomer' % function, function, 'loans', 'balance', 'customer_id')
+            for function in xsc.XscAggregate.Functions
+        ]
+        aggregates.append(xsc.XscAggregate('rowCount', 'count', 'loans'))
+        values = xsc._aggregateValues(source, aggregates)
+        self.assertEqual(values['avgByCustomer'], {u'1': decimal.Decimal('1.5'), u'2': decimal.Decimal('4')})
+        self.assertEqual(values['countByCustomer'], {u'1': 2, u'2': 1})
+        self.assertEqual(values['maxByCustomer'][u'1'], decimal.Decimal('2.5'))
+        self.assertEqual(values['minByCustomer'][u'1'], decimal.Decimal('0.5'))
+        self.assertEqual(values['sumByCustomer'][u'2'], decimal.Decimal('4'))
+        self.assertEqual(values['sumByCustomer'][u'3'], 0)
+        self.assertEqual(values['avgByCustomer'][u'3'], None)
+        self.assertEqual(values['rowCount'], 4)
+
+    def testFailsOnNonNumericValue(self):
+        source = xsc.DataSource('customers')
+        source.setInterface(_Interface(['id', 'surname']))
+        source.setRows([[u'1', u'Doe']])
+        self.assertRaises(
+            xsc.XscValueError, xsc._aggregateValues, source, [xsc.XscAggregate('total', 'sum', 'customers', 'surname')]
+        )
+
+    def testFailsOnUnknownFunction(self):
+        self.assertRaises(xsc.XscSyntaxError, self._template, '<?xsc let total = median(loans.balance)?><loans/>')
+
+    def testFailsOnMissingColumn(self):
+        self.assertRaises(xsc.XscSyntaxError, self._template, '<?xsc let total = sum(loans)?><loans/>')
+
+    def testFailsOnLetInLoop(self):
+        self.assertRaises(xsc.XscSyntaxError, self._template,
+            '<loans><?xsc for loans?><?xsc let total = count(loans)?><?xsc end for?></loans>'
+        )
+
+    def testFailsOnDuplicateName(self):
+        self.assertRaises(xsc.XscSyntaxError, self._template,
+            '<?xsc let total = count(loans)?><?xsc let total = sum(loans.balance)?><loans/>'
+        )
+
+class RowConditionTest(_TempFolderTest):
+    def _sourceConditions(self, content):
+        return self._template(content).sourceConditions
+
+    def _testCanSkipRows(self, engine):
+        targetXmlFilePath = os.path.join('test', 'olderCustomers.xml')
+        xsc.convert(
+            xsc.XscTemplate(_OlderCustomersXscPath), {'customers': (_testFilePath('customers.csv'), None)},
+            targetXmlFilePath, engine=engine
+        )
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanSkipRowsWithCompiledEngine(self):
+        self._testCanSkipRows(xsc.EngineCompiled)
+
+    def testCanSkipRowsWithInterpretedEngine(self):
+        self._testCanSkipRows(xsc.EngineInterpreted)
+
+    def testCanFindSourceConditions(self):
+        self.assertEqual(xsc.XscTemplate(_OlderCustomersXscPath).sourceConditions, {'customers': u"customers.dateOfBirth < '1970'"})
+        self.assertEqual(xsc.XscTemplate(_CustomersXscPath).sourceConditions, {})
+        self.assertEqual(
+            self._sourceConditions('<c><?xsc for c?><?xsc if int(c.id) in (1, 2)?><x/><?xsc end if?><?xsc end for?></c>'),
+            {'c': u'int(c.id) in (1, 2)'}
+        )
+
+    def testCanKeepRowsForOtherConditions(self):
+        # Text outside the condition is written for every row.
+        self.assertEqual(self._sourceConditions('<c><?xsc for c?> <?xsc if c.id?><x/><?xsc end if?><?xsc end for?></c>'), {})
+        # Condition refers to other names than the row.
+        self.assertEqual(self._sourceConditions('<c><?xsc for c?><?xsc if c.id == limit?><x/><?xsc end if?><?xsc end for?></c>'), {})
+        self.assertEqual(self._sourceConditions('<c><?xsc for c?><?xsc if c?><x/><?xsc end if?><?xsc end for?></c>'), {})
+        # Loops with different conditions.
+        self.assertEqual(self._sourceConditions(
+            '<c><?xsc for c?><?xsc if c.id?><x/><?xsc end if?><?xsc end for?>'
+            + '<?xsc for c?><?xsc if not c.id?><y/><?xsc end if?><?xsc end for?></c>'
+        ), {})
+        # Builtins might be replaced by Python code.
+        self.assertEqual(self._sourceConditions(
+            '<c><?xsc python\nint = len\n?><?xsc for c?><?xsc if int(c.id)?><x/><?xsc end if?><?xsc end for?></c>'
+        ), {})
+
+    def testCanCacheRowsSkipped(self):
+        interface = xsc._readInterface(_testFilePath('customers.csv'), None, 'utf-8')
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        self.assertNotEqual(
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface),
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface, u"customers.surname == 'Doe'")
+        )
+        source = xsc.DataSource('customers')
+        source.setInterface(interface)
+        source.setRowCondition(u"customers.surname == 'Doe'")
+        source.setData(_testFilePath('customers.csv'), dataCache=dataCache)
+        self.assertEqual([row[1] for row in source.rows()], [u'Doe'])
+
+class ColumnProjectionTest(_TempFolderTest):
+    def _usedColumnNames(self, content):
+        return self._template(content).usedColumnNames
+
+    def testCanFindUsedColumns(self):
+        self.assertEqual(xsc.XscTemplate(_CustomersXscPath).usedColumnNames, {'customers': frozenset(['surname', 'dateOfBirth'])})
+        self.assertEqual(xsc.XscTemplate(_LoanTotalsXscPath).usedColumnNames['loans'], frozenset(['balance', 'customer_id', 'rate']))
+        self.assertEqual(self._usedColumnNames(
+            '<c a="${c.a}"><?xsc for c?><?xsc if c.b?>${c.c}<?xsc for d where e == c.f?><?xsc end for?><?xsc end if?>'
+            + '<?xsc python\nx = c.g\n?><?xsc end for?></c>'
+        ), {'c': frozenset(['a', 'b', 'c', 'f', 'g']), 'd': frozenset(['e'])})
+
+    def testCanStoreAllColumnsForDynamicAccess(self):
+        self.assertEqual(self._usedColumnNames('<c><?xsc for c?><?xsc for d?>${c.a}${len(d.namesAndValues())}<?xsc end for?><?xsc end for?></c>'),
+            {'c': frozenset(['a'])})
+        self.assertEqual(self._usedColumnNames('<c><?xsc for c?><?xsc for d?>${c.a}${getattr(d, "b")}<?xsc end for?><?xsc end for?></c>'),
+            {'c': frozenset(['a'])})
+        self.assertEqual(self._usedColumnNames('<c><?xsc for c?>${c.a}${globals()["c"]}<?xsc end for?></c>'), {})
+        self.assertEqual(self._usedColumnNames('<c><?xsc for c?>${c.a}<?xsc python\nexec "x = c.b"\n?><?xsc end for?></c>'), {})
+
+    def testCanSkipUnusedColumns(self):
+        interface = xsc._readInterface(_testFilePath('customers.csv'), None, 'utf-8')
+        dataCache = xsc._DataCache(self._tempFolderPath)
+        self.assertNotEqual(
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface),
+            dataCache.rowsKey(_testFilePath('customers.csv'), interface, usedColumnNames=['surname'])
+        )
+        for _ in range(2):
+            # Store rows in the cache and read them from it.
+            source = xsc.DataSource('customers')
+            source.setInterface(interface)
+            source.setUsedColumnNames(['surname'])
+            source.setData(_testFilePath('customers.csv'), dataCache=dataCache)
+            self.assertEqual(list(source.rows())[0], [None, u'Doe', None, None])
+
+    def testCanKeepShardKeyColumn(self):
+        targetXmlFilePath = os.path.join(self._tempFolderPath, 'customers.xml')
+        statistics = xsc.RunStatistics()
+        xsc.convert(
+            xsc.XscTemplate(_CustomersXscPath), {'customers': (_testFilePath('customers.csv'), None)},
+            targetXmlFilePath, sharding=xsc.Sharding(keyColumn='id'), statistics=statistics
+        )
+        self.assertEqual(statistics.sources['customers']['usedColumns'], ['dateOfBirth', 'id', 'surname'])
+        with open(xsc.shardManifestPath(targetXmlFilePath), 'rb') as manifestFile:
+            self.assertEqual(len(json.load(manifestFile)['shards']), 3)
+
+    def testCanKeepAllColumnsByDefault(self):
+        converter = xsc.Converter(xsc.XscTemplate(_CustomersXscPath))
+        converter.setInterface('customers', xsc._readInterface(_testFilePath('customers.csv'), None, 'utf-8'))
+        converter.setData('customers', _testFilePath('customers.csv'))
+        self.assertEqual(list(converter.source('customers').rows())[0], [u'1', u'Doe', u'John', u'1957-03-08'])
+
+    def testFailsOnUnstoredShardKeyColumn(self):
+        converter = xsc.Converter(xsc.XscTemplate(_CustomersXscPath), isProjected=True)
+        converter.setInterface('customers', xsc._readInterface(_testFilePath('customers.csv'), None, 'utf-8'))
+        converter.setData('customers', _testFilePath('customers.csv'))
+        self.assertRaises(
+            xsc.XscValueError, converter.write, os.path.join(self._tempFolderPath, 'customers.xml'),
+            sharding=xsc.Sharding(keyColumn='id')
+        )
+
+class NamespaceTest(_ExpectedFileTest):
+    def testCanBindRowsByColumnIndex(self):
+        variablesClass = xsc._variablesClass([u'id', u'name'])
+        self.assertTrue(xsc._variablesClass((u'id', u'name')) is variablesClass)
+        variables = variablesClass()
+        variables._values = [u'1', u'Doe']
+        self.assertEqual(variables.name, u'Doe')
+        self.assertEqual(variables.namesAndValues(), [(u'id', u'1'), (u'name', u'Doe')])
+        self.assertEqual(xsc._possibleVariableName(self._attributeError(variables, 'noSuchColumn')), 'noSuchColumn')
+
+    def testCanSetAttributesOfRows(self):
+        variables = xsc._variablesClass([u'id'])([u'1'])
+        variables.extra = u'x'
+        self.assertEqual((variables.id, variables.extra), (u'1', u'x'))
+
+    def testFailsOnColumnsClashingWithVariables(self):
+        for fieldName in (u'_values', u'_fieldNames', u'namesAndValues'):
+            self.assertRaises(xsc.XscValueError, xsc._variablesClass, [u'id', fieldName])
+
+    def _attributeError(self, variables, name):
+        try:
+            getattr(variables, name)
+        except AttributeError, error:
+            return error
+        self.fail('AttributeError must be raised') # pragma: no cover
+
+    def testCanKeepPythonNamesInConversion(self):
+        template = xsc.XscTemplate(_PythonXscPath)
+        xsc.convert(template, {}, os.path.join('test', 'python.xml'))
+        self.assertFalse(hasattr(xsc, 'eAccess'))
+        self.assertFalse('eAccess' in template.newNamespace())
+
+    def testCanImportIntoNamespace(self):
+        template = xsc.XscTemplate(_ImportXscPath)
+        self.assertEqual(template.importedModules.keys(), ['errno'])
+        self.assertTrue('errno' in template.newNamespace())
+
+    def _testCanConvertConcurrently(self, engine):
+        template = xsc.XscTemplate(_EdmBalanceXscPath)
+        converter = xsc.Converter(template)
+        for name, dataFileName, cidFileName in (
+            ('edmNotification', 'edmBalanceNotification.csv', 'cid_edmBalanceNotification.xls'),
+            ('edmPeriod', 'edmBalancePeriod.csv', 'cid_edmBalancePeriod.xls')
+        ):
+            interface = cutplace.interface.InterfaceControlDocument()
+            interface.read(_testFilePath(cidFileName))
+            converter.setInterface(name, interface)
+            converter.setData(name, _testFilePath(dataFileName))
+        customersTemplate = xsc.XscTemplate(_CustomersXscPath)
+        customersConverter = xsc.Converter(customersTemplate)
+        customersTemplate.singlePassSourceNames = set()
+        with open(_testFilePath('customers.csv'), 'rb') as dataFile:
+            customersConverter.setInterface('customers', cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding='utf-8', header=1))
+        customersConverter.setData('customers', _testFilePath('customers.csv'))
+        errors = []
+        def write(someConverter, targetXmlFileName):
+            try:
+                for _ in range(3):
+                    someConverter.write(os.path.join('test', targetXmlFileName), engine)
+            except Exception, error: # pragma: no cover
+                errors.append(error)
+        threads = [
+            threading.Thread(target=write, args=(converter, 'edmBalance.xml')),
+            threading.Thread(target=write, args=(customersConverter, 'customers.xml')),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertFileMatches(os.path.join('test', 'edmBalance.xml'))
+        self.assertFileMatches(os.path.join('test', 'customers.xml'))
+
+    def testCanConvertConcurrentlyWithCompiledEngine(self):
+        self._testCanConvertConcurrently(xsc.EngineCompiled)
+
+    def testCanConvertConcurrentlyWithInterpretedEngine(self):
+        self._testCanConvertConcurrently(xsc.EngineInterpreted)
+
+class ParallelTest(_ExpectedFileTest):
+    def setUp(self):
+        self._oldParallelChunkRowCount = xsc._ParallelChunkRowCount
+        # Use small chunks so even the test data result in several of them.
+        xsc._ParallelChunkRowCount = 2
+
+    def tearDown(self):
+        xsc._ParallelChunkRowCount = self._oldParallelChunkRowCount
+
+    def testCanFindParallelLoops(self):
+        edmTemplate = xsc.XscTemplate(_EdmBalanceXscPath)
+        # Both top level loops over edmNotification qualify, but not the nested loop over edmPeriod.
+        self.assertEqual([loop.rider for loop in edmTemplate.parallelLoops], ['edmNotification', 'edmNotification'])
+        self.assertEqual(xsc.XscTemplate(_LoanGroupsXscPath).parallelLoops, [])
+        self.assertEqual(xsc.XscTemplate(_PythonXscPath).parallelLoops, [])
+
+    def _testCanConvertInParallel(self, engine):
+        template = xsc.XscTemplate(_EdmBalanceXscPath)
+        sourceNameToPathMap = {
+            'edmNotification': (_testFilePath('edmBalanceNotification.csv'), _testFilePath('cid_edmBalanceNotification.xls')),
+            'edmPeriod': (_testFilePath('edmBalancePeriod.csv'), _testFilePath('cid_edmBalancePeriod.xls'))
+        }
+        targetXmlFilePath = os.path.join('test', 'edmBalance.xml')
+        xsc.convert(template, sourceNameToPathMap, targetXmlFilePath, engine=engine, jobs=2)
+        self.assertFileMatches(targetXmlFilePath)
+
+    def testCanConvertInParallelWithCompiledEngine(self):
+        self._testCanConvertInParallel(xsc.EngineCompiled)
+
+    def testCanConvertInParallelWithInterpretedEngine(self):
+        self._testCanConvertInParallel(xsc.EngineInterpreted)
+
+    def testCanReportProgressInParallel(self):
+        oldRowCountToCheck = xsc._ProgressReporter._RowCountToCheck
+        xsc._ProgressReporter._RowCountToCheck = 1
+        try:
+            for engine in xsc._Engines:
+                with _CollectingLogHandler() as logHandler:
+                    xsc.convert(
+                        xsc.XscTemplate(_CustomersXscPath), {'customers': (_testFilePath('customers.csv'), None)},
+                        os.path.join('test', 'customers.xml'), engine=engine, jobs=2, progressInterval=1e-9
+                    )
+                self.assertTrue(u"wrote 3 rows of 'customers'" in u' '.join(logHandler.messages), logHandler.messages)
+        finally:
+            xsc._ProgressReporter._RowCountToCheck = oldRowCountToCheck
+        self.assertFileMatches(os.path.join('test', 'customers.xml'))
+
+    def testCanConvertStreamedSourceInParallel(self):
+        exitCode, _ = xsc.main([
+            'test',
+            '--jobs', '3',
+            _CustomersXscPath,
+            'customers:%s' % _testFilePath('customers.csv'),
+        ])
+        self.assertEqual(exitCode, 0)
+        self.assertFileMatches(os.path.join('test', 'customers.xml'))
+
+    def testFailsOnBrokenExpressionInParallel(self):
+        template = xsc.XscTemplate(_BrokenExpressionXscPath)
+        targetXmlFilePath = os.path.join('test', 'brokenExpression.xml')
+        self.assertRaises(xsc.XscValueError, xsc.convert,
+            template, {'customers': (_testFilePath('customers.csv'), None)}, targetXmlFilePath, jobs=2
+        )
+
+class ProfilerTest(_TempFolderTest):
+    def testCanLocateNodes(self):
+        template = xsc.XscTemplate(_CustomersXscPath)
+        forNode = [xscNode for xscNode in template.content.childNodes[-1].childNodes if isinstance(xscNode, xsc.XscForNode)][0]
+        self.assertEqual(forNode.location, (5, 3))
+        self.assertEqual(forNode.description, u'for customers')
+        textNodes = [xscNode for xscNode in forNode.childNodes[1].childNodes if isinstance(xscNode, xsc.ElementNode)]
+        self.assertEqual(textNodes[0].childNodes[0].location, (7, 14))
+        self.assertEqual(textNodes[0].childNodes[0].description, u'${customers.surname}')
+
+    def testCanProfileNodes(self):
+        profiler = xsc.TemplateProfiler()
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        xsc.convert(
+            xsc.XscTemplate(_CustomersXscPath), {'customers': (_testFilePath('customers.csv'), None)}, targetXmlFilePath,
+            profiler=profiler
+        )
+        self.assertFileMatches(targetXmlFilePath)
+        locationToEntryMap = dict((entry.location, entry) for entry in profiler.entries)
+        self.assertEqual(locationToEntryMap[(5, 3)].callCount, 1)
+        self.assertEqual(locationToEntryMap[(7, 14)].callCount, 3)
+        self.assertTrue(profiler.writerEntry.callCount > 0)
+        forEntry = locationToEntryMap[(5, 3)]
+        self.assertTrue(forEntry.totalTime >= forEntry.selfTime)
+        self.assertEqual(len(profiler.reportLines(2)), 3)
+
+    def testCanWriteProfileJson(self):
+        profileJsonPath = os.path.join(self._tempFolderPath, 'profile.json')
+        exitCode, _ = xsc.main([
+            'test', '--profile-json', profileJsonPath, _CustomersXscPath, 'customers:%s' % _testFilePath('customers.csv')
+        ])
+        self.assertEqual(exitCode, 0)
+        self.assertFileMatches(os.path.join('test', 'customers.xml'))
+        with open(profileJsonPath, 'rb') as profileJsonFile:
+            profile = json.load(profileJsonFile)
+        self.assertEqual(profile['template'], _CustomersXscPath)
+        self.assertTrue(u'writer' in [node['kind'] for node in profile['nodes']])
+        self.assertTrue([node for node in profile['nodes'] if node['description'] == u'for customers'])
+
+class StatisticsTest(_TempFolderTest):
+    def testCanMeasurePhases(self):
+        statistics = xsc.RunStatistics()
+        targetXmlFilePath = os.path.join('test', 'customers.xml')
+        xsc.convert(
+            xsc.XscTemplate(_CustomersXscPath), {'customers': (_testFilePath('customers.csv'), None)}, targetXmlFilePath,
+            statistics=statistics
+        )
+        self.assertFileMatches(targetXmlFilePath)
+        self.assertEqual(
+            [(phase['phase'], phase['source']) for phase in statistics.phases],
+            [('sniff', 'customers'), ('load', 'customers'), ('write', None)]
+        )
+        for phase in statistics.phases:
+            self.assertTrue(phase['rssAtStart'] > 0)
+            self.assertTrue(phase['rssAtEnd'] > 0)
+            self.assertTrue(phase['peakRssSoFar'] > 0)
+        self.assertEqual(statistics.outputByteCount, os.path.getsize(targetXmlFilePath))
+        self.assertEqual(statistics.sources['customers']['rows'], 3)
+        statisticsJson = statistics.asJson()
+        self.assertEqual(statisticsJson['rows'], 3)
+        self.assertTrue(statisticsJson['peakRss'] > 0)
+
+    def testCanWriteStatisticsJson(self):
+        statisticsJsonPath = os.path.join(self._tempFolderPath, 'statistics.json')
+        exitCode, _ = xsc.main([
+            'test', '--stats', statisticsJsonPath, '--progress', '0', _CustomersXscPath,
+            'customers:%s' % _testFilePath('customers.csv')
+        ])
+        self.assertEqual(exitCode, 0)
+        with open(statisticsJsonPath, 'rb') as statisticsJsonFile:
+            statistics = json.load(statisticsJsonFile)
+        self.assertEqual(statistics['phases'][0]['phase'], u'template')
+        self.assertEqual(statistics['outputBytes'], os.path.getsize(os.path.join('test', 'customers.xml')))
+
+    def testCanReportProgress(self):
+        source = xsc.DataSource('customers')
+        source.setInterface(xsc._readInterface(_testFilePath('customers.csv'), None, 'utf-8'))
+        source.setData(_testFilePath('customers.csv'))
+        progressReporter = xsc._ProgressReporter(1e-9)
+        oldRowCountToCheck = xsc._ProgressReporter._RowCountToCheck
+        xsc._ProgressReporter._RowCountToCheck = 1
+        try:
+            self.assertEqual(list(progressReporter.rows(source, source.rows())), list(source.rows()))
+        finally:
+            xsc._ProgressReporter._RowCountToCheck = oldRowCountToCheck
+
+class ShardTest(_TempFolderTest):
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        self._targetXmlFilePath = os.path.join(self._tempFolderPath, 'customers.xml')
+
+    def _convert(self, sharding, engine=xsc.EngineCompiled, writer=xsc.WriterNative):
+        xsc.convert(
+            xsc.XscTemplate(_CustomersXscPath), {'customers': (_testFilePath('customers.csv'), None)},
+            self._targetXmlFilePath, engine=engine, writer=writer, sharding=sharding
+        )
+
+    def _manifest(self):
+        with open(xsc.shardManifestPath(self._targetXmlFilePath), 'rb') as manifestFile:
+            return json.load(manifestFile)
+
+    def _shardSurnames(self, manifest, openShard=open):
+        result = []
+        for shard in manifest['shards']:
+            with openShard(os.path.join(self._tempFolderPath, shard['path']), 'rb') as shardFile:
+                shardDocument = xml.dom.minidom.parse(shardFile)
+            result.append([
+                surnameElement.firstChild.data for surnameElement in shardDocument.getElementsByTagName('surname')
+            ])
+        return result
+
+    def testCanSplitByRowCount(self):
+        for engine in (xsc.EngineCompiled, xsc.EngineInterpreted):
+            for writer in (xsc.WriterNative, xsc.WriterLoxun):
+                self._convert(xsc.Sharding(rowCount=2), engine, writer)
+                manifest = self._manifest()
+                self.assertEqual([shard['rows'] for shard in manifest['shards']], [2, 1])
+                self.assertEqual(manifest['rows'], 3)
+                self.assertEqual(self._shardSurnames(manifest), [[u'Doe', u'Miller'], [u'Webster']])
+
+    def testCanSplitByByteCount(self):
+        shardByteCount = 400
+        self._convert(xsc.Sharding(byteCount=shardByteCount))
+        manifest = self._manifest()
+        self.assertEqual(self._shardSurnames(manifest), [[u'Doe', u'Miller'], [u'Webster']])
+        for shard in manifest['shards']:
+            self.assertTrue(shard['bytes'] <= shardByteCount, shard)
+            self.assertEqual(shard['bytes'], os.path.getsize(os.path.join(self._tempFolderPath, shard['path'])))
+
+    def testCanSplitByKeyUsingMain(self):
+        self._targetXmlFilePath = os.path.join(self._tempFolderPath, 'customers.xml.gz')
+        exitCode, _ = xsc.main([
+            'test', '--shard-by', 'surname', '--output', self._targetXmlFilePath, _CustomersXscPath,
+            'customers:%s' % _testFilePath('customers.csv')
+        ])
+        self.assertEqual(exitCode, 0)
+        manifest = self._manifest()
+        self.assertEqual(
+            [(shard['path'], shard['key']) for shard in manifest['shards']],
+            [(u'customers-00001.xml.gz', u'Doe'), (u'customers-00002.xml.gz', u'Miller'), (u'customers-00003.xml.gz', u'Webster')]
+        )
+        self.assertEqual(self._shardSurnames(manifest, gzip.open), [[u'Doe'], [u'Miller'], [u'Webster']])
+
+    def testCanRepeatOnlyOpenElements(self):
+        template = self._template(
+            '<report kind="${\'loans\'}"><?xsc for customers?><c id="${customers.id}"/><?xsc end for?>'
+            + '<loans><?xsc for loans?><l id="${loans.id}"/><?xsc end for?></loans></report>'
+        )
+        for writer in (xsc.WriterNative, xsc.WriterLoxun):
+            xsc.convert(
+                template,
+                {'customers': (_testFilePath('customers.csv'), None), 'loans': (_testFilePath('loans.csv'), None)},
+                self._targetXmlFilePath, writer=writer, sharding=xsc.Sharding(rowCount=2, loopRider='loans')
+            )
+            shardDocuments = [
+                xml.dom.minidom.parse(os.path.join(self._tempFolderPath, shard['path'])) for shard in self._manifest()['shards']
+            ]
+            self.assertTrue(len(shardDocuments) >= 2)
+            self.assertEqual(len(shardDocuments[0].getElementsByTagName('c')), 3)
+            for shardDocument in shardDocuments:
+                self.assertEqual(shardDocument.documentElement.getAttribute('kind'), u'loans')
+                self.assertEqual(len(shardDocument.getElementsByTagName('loans')), 1)
+            for shardDocument in shardDocuments[1:]:
+                self.assertEqual(shardDocument.getElementsByTagName('c'), [])
+
+    def testFailsOnUnknownShardLoop(self):
+        self.assertRaises(xsc.XscValueError, self._convert, xsc.Sharding(rowCount=1, loopRider='orders'))
+
+    def testFailsOnUnknownShardKeyColumn(self):
+        self.assertRaises(xsc.XscValueError, self._convert, xsc.Sharding(keyColumn='city'))
+
+    def testFailsOnShardsInStandardOutput(self):
+        self.assertRaises(SystemExit, xsc.main, [
+            'test', '--shard-rows', '1', '--output', '-', _CustomersXscPath, 'customers:%s' % _testFilePath('customers.csv')
+        ])
+
+class DeltaTest(_TempFolderTest):
+    def setUp(self):
+        super(DeltaTest, self).setUp()
+        self._dataPath = os.path.join(self._tempFolderPath, 'customers.csv')
+        self._storePath = os.path.join(self._tempFolderPath, 'customers.fingerprints')
+        self._targetXmlFilePath = os.path.join(self._tempFolderPath, 'customers.xml')
+
+    def _writeData(self, dataRows):
+        with open(self._dataPath, 'wb') as dataFile:
+            dataFile.write('id,surname,firstname,dateOfBirth\n')
+            for dataRow in dataRows:
+                dataFile.write(','.join(dataRow) + '\n')
+
+    def _convertedSurnames(self, fingerprintStore, engine=xsc.EngineCompiled):
+        xsc.convert(
+            xsc.XscTemplate(_CustomersXscPath), {'customers': (self._dataPath, None)}, self._targetXmlFilePath,
+            engine=engine, fingerprintStore=fingerprintStore
+        )
+        targetDocument = xml.dom.minidom.parse(self._targetXmlFilePath)
+        return [surnameElement.firstChild.data for surnameElement in targetDocument.getElementsByTagName('surname')]
+
+    def testCanWriteChangedRows(self):
+        for engine in (xsc.EngineCompiled, xsc.EngineInterpreted):
+            if os.path.exists(self._storePath):
+                os.remove(self._storePath)
+            self._writeData([('1', 'Doe', 'John', '1957-03-08'), ('2', 'Miller', 'Jane', '1946-10-04'), ('3', 'Webster', 'Mike', '1974-12-23')])
+            fingerprintStore = xsc.FingerprintStore(self._storePath, {'customers': 'id'})
+            self.assertEqual(self._convertedSurnames(fingerprintStore, engine), [u'Doe', u'Miller', u'Webster'])
+            self.assertEqual(fingerprintStore.deletedKeys(), {})
+
+            self._writeData([('1', 'Doe', 'John', '1957-03-08'), ('2', 'Miller', 'Jane', '1946-10-05'), ('4', 'Smith', 'Anna', '1980-01-01')])
+            fingerprintStore = xsc.FingerprintStore(self._storePath, {'customers': 'id'})
+            self.assertEqual(self._convertedSurnames(fingerprintStore, engine), [u'Miller', u'Smith'])
+            self.assertEqual(fingerprintStore.deletedKeys(), {'customers': [u'3']})
+
+            fingerprintStore = xsc.FingerprintStore(self._storePath, {'customers': 'id'})
+            self.assertEqual(self._convertedSurnames(fingerprintStore, engine), [])
+
+    def testCanWriteAllRowsAfterKeyColumnChanged(self):
+        self._writeData([('1', 'Doe', 'John', '1957-03-08')])
+        self._convertedSurnames(xsc.FingerprintStore(self._storePath, {'customers': 'id'}))
+        fingerprintStore = xsc.FingerprintStore(self._storePath, {'customers': 'surname'})
+        self.assertEqual(self._convertedSurnames(fingerprintStore), [u'Doe'])
+
+    def testCanWriteDeletedKeysUsingMain(self):
+        deletedKeysPath = os.path.join(self._tempFolderPath, 'deleted.json')
+        arguments = [
+            'test', '--delta', 'customers:surname', '--delta-store', self._storePath, '--deleted', deletedKeysPath,
+            '--output', self._targetXmlFilePath, _CustomersXscPath, 'customers:%s' % self._dataPath
+        ]
+        self._writeData([('1', 'Doe', 'John', '1957-03-08'), ('2', 'Miller', 'Jane', '1946-10-04')])
+        self.assertEqual(xsc.main(arguments)[0], 0)
+        self._writeData([('2', 'Miller', 'Jane', '1946-10-04')])
+        self.assertEqual(xsc.main(arguments)[0], 0)
+        with open(deletedKeysPath, 'rb') as deletedKeysFile:
+            self.assertEqual(json.load(deletedKeysFile), {u'customers': [u'Doe']})
+
+    def testFailsOnUnknownKeyColumn(self):
+        self._writeData([('1', 'Doe', 'John', '1957-03-08')])
+        self.assertRaises(xsc.XscValueError, self._convertedSurnames, xsc.FingerprintStore(self._storePath, {'customers': 'city'}))
+
+    def testFailsOnSourceWithoutOutermostLoop(self):
+        self._writeData([('1', 'Doe', 'John', '1957-03-08')])
+        self.assertRaises(xsc.XscValueError, self._convertedSurnames, xsc.FingerprintStore(self._storePath, {'orders': 'id'}))
+
+    def testFailsOnBrokenStore(self):
+        with open(self._storePath, 'wb') as storeFile:
+            storeFile.write('broken')
+        self.assertRaises(xsc.XscError, xsc.FingerprintStore, self._storePath, {'customers': 'id'})
+
+class BenchmarkTest(_TempFolderTest):
+    def testCanGenerateValidData(self):
+        notificationPath = os.path.join(self._tempFolderPath, 'notification.csv')
+        periodPath = os.path.join(self._tempFolderPath, 'period.csv')
+        benchmark_xsc.writeEdmBalance(notificationPath, periodPath, 100)
+        source = xsc.DataSource('edmPeriod')
+        source.setInterface(xsc._readInterface(periodPath, _testFilePath('cid_edmBalancePeriod.xls'), 'utf-8'))
+        source.setData(periodPath)
+        self.assertEqual(source.rowCount, 100)
+
+    def testCanGenerateDataAgainAfterInterruption(self):
+        generatedData = benchmark_xsc._GeneratedData(self._tempFolderPath)
+        notificationPath = os.path.join(self._tempFolderPath, 'edmBalanceNotification_20.csv')
+        periodPath = os.path.join(self._tempFolderPath, 'edmBalancePeriod_20.csv')
+        # Simulate a previous run interrupted after writing only part of the data.
+        with open(notificationPath, 'wb') as notificationFile:
+            notificationFile.write('9008390100400;')
+        with open(periodPath + '.tmp', 'wb') as periodFile:
+            periodFile.write('9008390101544;')
+        dataPaths = generatedData.paths('edmBalance', 20)
+        self.assertEqual([dataFilePath for dataFilePath, _ in dataPaths], [notificationPath, periodPath])
+        self.assertEqual(sorted(os.listdir(self._tempFolderPath)), ['edmBalanceNotification_20.csv', 'edmBalancePeriod_20.csv'])
+        source = xsc.DataSource('edmPeriod')
+        source.setInterface(xsc._readInterface(periodPath, _testFilePath('cid_edmBalancePeriod.xls'), 'utf-8'))
+        source.setData(periodPath)
+        self.assertEqual(source.rowCount, 20)
+
+    def testCanBenchmark(self):
+        benchmarkResult = benchmark_xsc.benchmark([20], benchmark_xsc.ScenarioNames, self._tempFolderPath)
+        self.assertEqual(
+            sorted(benchmarkResult['results'].keys()),
+            sorted(benchmark_xsc.resultKey(scenarioName, 20) for scenarioName in benchmark_xsc.ScenarioNames)
+        )
+        joinResult = benchmarkResult['results'][benchmark_xsc.resultKey('join', 20)]
+        self.assertTrue(joinResult['rowsPerSecond'] > 0)
+        self.assertTrue(joinResult['outputBytes'] > 0)
+        self.assertEqual(len(benchmark_xsc.reportLines(benchmarkResult)), 1 + len(benchmark_xsc.ScenarioNames))
+
+    def testCanDetectRegressions(self):
+        baselineResult = {'results': {'load/10': {'rowsPerSecond': 100.0, 'peakRss': 1000}}}
+        self.assertEqual(benchmark_xsc.regressions(baselineResult, baselineResult), [])
+        slowerResult = {'results': {'load/10': {'rowsPerSecond': 80.0, 'peakRss': 1000}}}
+        self.assertEqual(len(benchmark_xsc.regressions(slowerResult, baselineResult)), 1)
+        self.assertEqual(benchmark_xsc.regressions(slowerResult, baselineResult, 25.0), [])
+        biggerResult = {'results': {'load/10': {'rowsPerSecond': 100.0, 'peakRss': 2000}}}
+        self.assertEqual(len(benchmark_xsc.regressions(biggerResult, baselineResult)), 1)
+
+class BatchTest(_TempFolderTest):
+    def _manifestPath(self, content):
+        result = os.path.join(self._tempFolderPath, 'test.manifest')
+        with open(result, 'wb') as manifestFile:
+            manifestFile.write(content)
+        return result
+
+    def testCanReadManifest(self):
+        batchJobs = xsc.readBatchManifest(_BatchManifestPath)
+        self.assertEqual([batchJob.targetXmlFilePath for batchJob in batchJobs], [
+            os.path.join('test', 'customers.xml'), os.path.join('test', 'edmBalance.xml'), os.path.join('test', 'edmBalanceJoin.xml')
+        ])
+        self.assertEqual(batchJobs[0].templatePath, _CustomersXscPath)
+        self.assertEqual(batchJobs[0].sourceNameToSourceMap, {'customers': (_testFilePath('customers.csv'), None)})
+        self.assertEqual(batchJobs[1].sourceNameToSourceMap['edmPeriod'], (
+            _testFilePath('edmBalancePeriod.csv'), _testFilePath('cid_edmBalancePeriod.xls')
+        ))
+        self.assertEqual(batchJobs[2].engine, xsc.EngineInterpreted)
+
+    def _testCanConvertBatch(self, jobs):
+        failedJobs = xsc.convertBatch(xsc.readBatchManifest(_BatchManifestPath), jobs)
+        self.assertEqual(failedJobs, [])
+        for targetXmlFileName in ('customers.xml', 'edmBalance.xml', 'edmBalanceJoin.xml'):
+            self.assertFileMatches(os.path.join('test', targetXmlFileName))
+
+    def testCanConvertBatchSerially(self):
+        self._testCanConvertBatch(1)
+
+    def testCanConvertBatchInParallel(self):
+        self._testCanConvertBatch(2)
+
+    def testCanContinueAfterBrokenJob(self):
+        batchJobs = [
+            xsc.BatchJob(_testFilePath('noSuchTemplate.xsc'), {}, os.path.join('test', 'noSuchTemplate.xml')),
+            xsc.BatchJob(_CustomersXscPath, {'customers': (_testFilePath('customers.csv'), None)}, os.path.join('test', 'customers.xml')),
+        ]
+        failedJobs = xsc.convertBatch(batchJobs)
+        self.assertEqual([batchJob for batchJob, _ in failedJobs], batchJobs[:1])
+        self.assertFileMatches(os.path.join('test', 'customers.xml'))
+
+    def testFailsOnBrokenManifest(self):
+        self.assertRaises(xsc.XscSyntaxError, xsc.readBatchManifest, _testFilePath('brokenBatch.manifest'))
+
+    def testFailsOnStandardOutputInManifest(self):
+        manifestPath = self._manifestPath('--output - customers.xsc customers:customers.csv\n')
+        self.assertRaises(xsc.XscSyntaxError, xsc.readBatchManifest, manifestPath)
+
+    def testFailsOnSniffOptionsInManifest(self):
+        manifestPath = self._manifestPath('--sniff-lines 10 --output customers.xml customers.xsc customers:customers.csv\n')
+        self.assertRaises(xsc.XscSyntaxError, xsc.readBatchManifest, manifestPath)
+
+    def testCanRunBatchMain(self):
+        exitCode, _ = xsc.batchMain(['test', '--jobs', '2', _BatchManifestPath])
+        self.assertEqual(exitCode, 0)
+
+    def testFailsOnDeltaOptionsForBatch(self):
+        # Batch jobs cannot be compared with a previous conversion, so the options must not be ignored.
+        self.assertRaises(SystemExit, xsc.batchMain, ['test', '--delta', 'customers:id', _BatchManifestPath])
+        self.assertRaises(SystemExit, xsc.batchMain, ['test', '--delta-store', 'test/customers.fingerprints', _BatchManifestPath])
+        self.assertRaises(SystemExit, xsc.batchMain, ['test', '--deleted', 'test/deleted.json', _BatchManifestPath])
+
+class ServerTest(_TempFolderTest):
+    def setUp(self):
+        super(ServerTest, self).setUp()
+        self._socketPath = os.path.join(self._tempFolderPath, 'xsc.socket')
+        self._server = xsc_server.ConversionServer(self._socketPath, 2)
+        self._serverThread = threading.Thread(target=self._server.serve_forever)
+        self._serverThread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._serverThread.join()
+        self._server.server_close()
+        super(ServerTest, self).tearDown()
+
+    def _clientExitCode(self, arguments):
+        exitCode, _ = xsc_client.main(['test', '--socket', self._socketPath] + arguments)
+        return exitCode
+
+    def testCanConvertUsingServer(self):
+        targetXmlFilePath = os.path.join('test', 'edmBalance.xml')
+        arguments = [
+            '--output', targetXmlFilePath, _EdmBalanceXscPath,
+            'edmNotification:%s@%s' % (_testFilePath('edmBalanceNotification.csv'), _testFilePath('cid_edmBalanceNotification.xls')),
+            'edmPeriod:%s@%s' % (_testFilePath('edmBalancePeriod.csv'), _testFilePath('cid_edmBalancePeriod.xls')),
+        ]
+        # Run more conversions than workers so some use templates and interfaces from memory.
+        for _ in range(3):
+            self.assertEqual(self._clientExitCode(arguments), 0)
+            self.assertFileMatches(targetXmlFilePath)
+
+    def testCanResolveRelativePaths(self):
+        response = xsc_client.convert(
+            ['customers.xsc', 'customers:customers.csv'], os.path.abspath('test'), self._socketPath
+        )
+        self.assertEqual(response['exitCode'], 0)
+        self.assertFileMatches(os.path.join('test', 'customers.xml'))
+
+    def testCanShowHelp(self):
+        response = xsc_client.convert(['--help'], serverSocketPath=self._socketPath)
+        self.assertEqual(response['exitCode'], 0)
+        self.assertTrue(u'--output' in response['output'])
+
+    def testFailsOnBrokenArguments(self):
+        self.assertEqual(self._clientExitCode(['--jobs', '0', _CustomersXscPath]), 2)
+        self.assertEqual(self._clientExitCode(['--output', '-', _CustomersXscPath, 'customers']), 1)
+        self.assertEqual(self._clientExitCode([_testFilePath('noSuchTemplate.xsc')]), 1)
+
+    def testFailsOnSecondServer(self):
+        self.assertRaises(xsc.XscError, xsc_server.ConversionServer, self._socketPath)
+
+    def testFailsWithoutServer(self):
+        exitCode, _ = xsc_client.main(['test', '--socket', os.path.join(self._tempFolderPath, 'noSuch.socket'), _CustomersXscPath])
+        self.assertEqual(exitCode, 1)
+
+    def testFailsOnSocketOfOtherUser(self):
+        oldGetuid = os.getuid
+        os.getuid = lambda: oldGetuid() + 1
+        try:
+            self.assertRaises(EnvironmentError, xsc_client.convert, ['--help'], serverSocketPath=self._socketPath)
+            self.assertRaises(xsc.XscError, xsc_server._removeStaleSocket, self._socketPath)
+        finally:
+            os.getuid = oldGetuid
+
+    def testCanCreateSocketFolder(self):
+        socketPath = os.path.join(self._tempFolderPath, 'sockets', 'xsc.socket')
+        xsc_server.ConversionServer(socketPath).server_close()
+        self.assertEqual(os.stat(os.path.dirname(socketPath)).st_mode & 0777, 0700)
+
+    def testCanFindDefaultSocketPath(self):
+        oldRuntimeFolderPath = os.environ.get('XDG_RUNTIME_DIR')
+        os.environ['XDG_RUNTIME_DIR'] = self._tempFolderPath
+        try:
+            self.assertEqual(xsc_client.defaultSocketPath(), os.path.join(self._tempFolderPath, 'xsc.socket'))
+            del os.environ['XDG_RUNTIME_DIR']
+            self.assertEqual(os.path.basename(xsc_client.defaultSocketPath()), 'xsc.socket')
+            self.assertNotEqual(os.path.dirname(xsc_client.defaultSocketPath()), tempfile.gettempdir())
+        finally:
+            if oldRuntimeFolderPath is not None:
+                os.environ['XDG_RUNTIME_DIR'] = oldRuntimeFolderPath
+
+    def testCanForgetLeastRecentlyUsed(self):
+        recentlyUsedMap = xsc_server._RecentlyUsedMap(2)
+        recentlyUsedMap['a'] = 1
+        recentlyUsedMap['b'] = 2
+        self.assertEqual(recentlyUsedMap.get('a'), 1)
+        recentlyUsedMap['c'] = 3
+        self.assertEqual(len(recentlyUsedMap), 2)
+        self.assertEqual(recentlyUsedMap.get('b'), None)
+        self.assertEqual(recentlyUsedMap.get('a'), 1)
+        self.assertEqual(recentlyUsedMap.get('c'), 3)
+
 class XscImportTest(unittest.TestCase):
     def testCanResolveImportedSymbols(self):
         template = xsc.XscTemplate(_ImportXscPath)
@@ -221,6 +1722,9 @@ class MainTest(_ExpectedFileTest):
         self.assertEqual(exitCode, 0)
         self.assertXmlFileMatches(_NamespaceXscPath)
 
+    def testFailsOnBrokenJobs(self):
+        self._testMainRaisesSystemExit(['--jobs', '0', _CustomersXscPath], 2)
+
     def testFailsOnMissingTemplate(self):
         self._testMainRaisesSystemExit([], 2)
 
@@ -23,20 +23,60 @@ For more information, visit <https://github.com/roskakori/xsc/>.
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import array
+import ast
+import bz2
+import collections
+import contextlib
+import copy
+import cPickle
+import decimal
+import errno
+import gzip
+import hashlib
+import imp
+import io
+import itertools
+import json
 import logging
+import marshal
+import mmap
+import multiprocessing
 import optparse
 import os
 import re
+import shlex
+import struct
 import sys
+import tempfile
+import threading
+import time
+import timeit
 import token
 import tokenize
 import StringIO
-from xml.dom import minidom
-from xml.dom.minidom import Node
+import types
+import zlib
+from xml.parsers import expat
 
 import cutplace.interface
+import cutplace.sniff
 import loxun
 
+try:
+    import resource
+except ImportError: # pragma: no cover
+    # Not available on Windows.
+    resource = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 __version_info__ = (0, 1, 2)
 __version__ = '.'.join(unicode(item) for item in __version_info__)
 
@@ -44,6 +84,29 @@ _Description = 'convert CSV, PRN, etc. to XML based on a template'
 
 _log = logging.getLogger('xsc')
 
+# Default number of data lines to sniff the interface from if no CID is specified.
+DefaultSniffLineCount = 1000
+
+# Number of header lines with field names when sniffing an interface.
+_SniffHeaderLineCount = 1
+
+# Engines to render a template.
+EngineCompiled = 'compiled'
+EngineInterpreted = 'interpreted'
+_Engines = (EngineCompiled, EngineInterpreted)
+
+# Writers to produce the XML output with.
+WriterNative = 'native'
+WriterLoxun = 'loxun'
+_Writers = (WriterNative, WriterLoxun)
+
+# Compressions of data files and XML output.
+CompressionNone = 'none'
+CompressionGzip = 'gzip'
+CompressionBzip2 = 'bzip2'
+CompressionXz = 'xz'
+_Compressions = (CompressionNone, CompressionGzip, CompressionBzip2, CompressionXz)
+
 class XscError(Exception):
     pass
 
@@ -53,10 +116,89 @@ class XscSyntaxError(XscError):
 class XscValueError(XscError):
     pass
 
+class _CodeWriter(object):
+    """
+    Python source code generated line by line with proper indentation.
+    """
+    def __init__(self):
+        self._lines = []
+        self._lineCount = 0
+        self._pendingLineCount = 0
+        self._indent = 0
+        self._nameCount = 0
+        self._constantIdToNameMap = {}
+        # Name of the variable holding the map of data source names to data sources.
+        self.sourcesName = u'_sources'
+        # List of (name, value) for values to be passed to the generated function.
+        self.constants = []
+        # Map of line number in generated code to xsc expression for error messages.
+        self.lineToExpressionMap = {}
+
+    def line(self, text):
+        """
+        Add ``text`` as next line, possibly containing expressions obtained from
+        `expression()`.
+        """
+        assert text is not None
+        assert text.count(u'\n') == self._pendingLineCount, 'text=%r' % text
+        self._lines.append(u'    ' * self._indent + text)
+        self._lineCount += self._pendingLineCount + 1
+        self._pendingLineCount = 0
+
+    def expression(self, expression):
+        """
+        Python code for ``expression`` in parentheses with a line break before the closing
+        parenthesis so that comments in it cannot interfere with the surrounding code. The
+        result must be used in the next call to `line()`.
+        """
+        assert expression is not None
+        strippedExpression = expression.strip()
+        firstLineNumber = self._lineCount + self._pendingLineCount + 1
+        lineCount = strippedExpression.count(u'\n') + 1
+        for lineNumber in range(firstLineNumber, firstLineNumber + lineCount):
+            self.lineToExpressionMap[lineNumber] = strippedExpression
+        self._pendingLineCount += lineCount
+        return u'(%s\n)' % strippedExpression
+
+    def indent(self):
+        self._indent += 1
+
+    def dedent(self):
+        assert self._indent > 0
+        self._indent -= 1
+
+    def constant(self, value, prefix='Constant'):
+        """
+        Name of a local variable in the generated function that refers to ``value``.
+        """
+        assert prefix
+        valueId = id(value)
+        result = self._constantIdToNameMap.get(valueId)
+        if result is None:
+            result = self.uniqueName(prefix)
+            self._constantIdToNameMap[valueId] = result
+            self.constants.append((result, value))
+        return result
+
+    def uniqueName(self, prefix):
+        """
+        A name starting with ``prefix`` that has not been used in the code so far.
+        """
+        assert prefix
+        self._nameCount += 1
+        return u'_xsc%s%d' % (prefix, self._nameCount)
+
+    @property
+    def source(self):
+        assert not self._pendingLineCount
+        return u'\n'.join(self._lines) + u'\n'
+
 class XscNode(object):
     def __init__(self, name=None):
         self.name = name
         self.childNodes = None
+        # Tuple of (line, column) where the node starts in the template or ``None``.
+        self.location = None
 
     def addChild(self, xscNodeToAdd):
         if self.childNodes is None:
@@ -64,60 +206,324 @@ class XscNode(object):
         else:
             self.childNodes.append(xscNodeToAdd)
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
+    @property
+    def isStatic(self):
+        """
+        ``True`` if the node always results in the same output.
+        """
+        return False
+
+    @property
+    def description(self):
+        """
+        Short human readable text describing the node, for example the expression it evaluates.
+        """
+        return self.name
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        """
+        Write the output of the node to ``xmlWriter`` evaluating expressions in ``namespace``.
+        """
+        raise NotImplementedError() # pragma: no cover
+
+    def writeCode(self, code):
+        """
+        Add Python code to ``code`` that has the same effect as `write()`.
+        """
         raise NotImplementedError() # pragma: no cover
 
+    def writeChildrenCode(self, code):
+        if self.childNodes:
+            for xscNode in self.childNodes:
+                xscNode.writeCode(code)
+
 class _Variables(object):
     """
-    Dump for arbitrary attributes.
+    Values of the current row of a data source as attributes named after the columns. Classes
+    with attributes for specific columns are created using `_variablesClass()`. Binding a row
+    merely sets ``_values`` no matter how many columns there are. Code in templates can still
+    set attributes of its own.
+    """
+    __slots__ = ('_values', '__dict__')
+    _fieldNames = ()
+
+    def __init__(self, values=None):
+        self._values = values
+
+    def namesAndValues(self):
+        """
+        List of ``(name, value)`` for all columns of the current row.
+        """
+        if self._values is None:
+            result = []
+        else:
+            result = zip(self._fieldNames, self._values)
+        return result
+
+_fieldNamesToVariablesClassMap = {}
+_fieldNamesToVariablesClassLock = threading.Lock()
+
+def _variablesClass(fieldNames):
+    """
+    Subclass of `_Variables` with a property for each name in ``fieldNames`` that refers to the
+    value with the same index in the current row. Names of attributes `_Variables` needs
+    itself, for example ``_values``, cannot be used for columns.
+    """
+    assert fieldNames is not None
+    fieldNames = tuple(fieldNames)
+    with _fieldNamesToVariablesClassLock:
+        result = _fieldNamesToVariablesClassMap.get(fieldNames)
+        if result is None:
+            classAttributes = {'__slots__': (), '_fieldNames': fieldNames}
+            for columnIndex, fieldName in enumerate(fieldNames):
+                if hasattr(_Variables, fieldName):
+                    raise XscValueError(u'column "%s" must be renamed because xsc uses this name itself' % fieldName)
+                classAttributes[fieldName] = property(lambda self, columnIndex=columnIndex: self._values[columnIndex])
+            # Keep the class name so `_possibleVariableName()` can recognize unknown columns.
+            result = type(_Variables.__name__, (_Variables,), classAttributes)
+            _fieldNamesToVariablesClassMap[fieldNames] = result
+    return result
+
+def _restoreVariable(namespace, name, oldValue):
     """
-    def setNamesAndValues(self, names, values):
-        assert names
-        assert values
-        assert len(names) == len(values)
-        for index in range(len(names)):
-            name = names[index]
-            value = values[index]
-            self.__dict__[name] = value
+    Set variable ``name`` in ``namespace`` back to ``oldValue`` or remove it if it did not
+    exist before.
+    """
+    if oldValue is None:
+        namespace.pop(name, None)
+    else:
+        namespace[name] = oldValue
 
 class XscForNode(XscNode):
-    def __init__(self, rider):
+    """
+    Node to write children for each row of a data source. If ``keyColumn`` is specified, only
+    rows where this column equals the value of the Python expression ``keyExpression`` are
+    used, which is looked up in an index of the data source. The ``location`` in the template
+    is reported if ``keyExpression`` is broken.
+    """
+    def __init__(self, rider, keyColumn=None, keyExpression=None, location=None):
+        assert (keyColumn is None) == (keyExpression is None)
         super(XscForNode, self).__init__('for')
         self.rider = rider
+        self.keyColumn = keyColumn
+        self.keyExpression = keyExpression
+        # Index in `XscTemplate.parallelLoops` if rows can be rendered in parallel.
+        self.parallelLoopIndex = None
+        # Index in `XscTemplate.outermostLoops` if the loop is not nested in another loop, so
+        # progress can be reported for it, its rows can be compared with fingerprints and its
+        # output can be split into shards.
+        self.outermostLoopIndex = None
+        if keyExpression is not None:
+            self._compiledKeyExpression = _compiledExpression(keyExpression, location)
+        else:
+            self._compiledKeyExpression = None
+
+    @property
+    def description(self):
+        result = u'for %s' % self.rider
+        if self.keyColumn is not None:
+            result += u' where %s == %s' % (self.keyColumn, self.keyExpression.strip())
+        return result
+
+    def _rows(self, source, namespace):
+        if self.keyColumn is None:
+            result = source.rows()
+        else:
+            try:
+                key = eval(self._compiledKeyExpression, namespace)
+            except Exception, error:
+                raise _expressionError(self.keyExpression, error, namespace)
+            result = source.rowsWhere(self.keyColumn, key)
+        return result
+
+    def _rowsCode(self, code, source):
+        if self.keyColumn is None:
+            result = u'%s.rows()' % source
+        else:
+            result = u'%s.rowsWhere(%r, %s)' % (source, self.keyColumn, code.expression(self.keyExpression))
+        return result
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        source = sourceNameToSourceMap[self.rider]
+        rows = self._rows(source, namespace)
+        if self.outermostLoopIndex is not None:
+            if self.keyColumn is None:
+                progressReporter = namespace.get('_xscProgressReporter')
+                if progressReporter is not None:
+                    rows = progressReporter.rows(source, rows)
+                fingerprintStore = namespace.get('_xscFingerprintStore')
+                if fingerprintStore is not None:
+                    rows = fingerprintStore.rows(source, rows)
+            sharder = namespace.get('_xscSharder')
+            if sharder is not None:
+                rows = sharder.rows(self.outermostLoopIndex, source, rows)
+        if self.parallelLoopIndex is not None:
+            parallelLoopWriter = namespace.get('_xscParallelLoopWriter')
+            if parallelLoopWriter is not None:
+                parallelLoopWriter.write(xmlWriter, rows, self.parallelLoopIndex)
+                return
+        variables = _variablesClass(source.interface.fieldNames)()
+        oldVariables = namespace.get('_xscVariables')
+        oldRiderVariables = namespace.get(self.rider)
+        namespace['_xscVariables'] = variables
+        namespace[self.rider] = variables
+        for row in rows:
+            variables._values = row
+            if self.childNodes:
+                for xscNode in self.childNodes:
+                    xscNode.write(xmlWriter, sourceNameToSourceMap, namespace)
+        _restoreVariable(namespace, self.rider, oldRiderVariables)
+        _restoreVariable(namespace, '_xscVariables', oldVariables)
+
+    def writeCode(self, code):
+        source = code.uniqueName('Source')
+        code.line(u'%s = %s[%r]' % (source, code.sourcesName, self.rider))
+        rows = code.uniqueName('Rows')
+        code.line(u'%s = %s' % (rows, self._rowsCode(code, source)))
+        if self.outermostLoopIndex is not None:
+            if self.keyColumn is None:
+                progressReporter = code.uniqueName('ProgressReporter')
+                code.line(u"%s = _globals.get('_xscProgressReporter')" % progressReporter)
+                code.line(u'if %s is not None:' % progressReporter)
+                code.line(u'    %s = %s.rows(%s, %s)' % (rows, progressReporter, source, rows))
+                fingerprintStore = code.uniqueName('FingerprintStore')
+                code.line(u"%s = _globals.get('_xscFingerprintStore')" % fingerprintStore)
+                code.line(u'if %s is not None:' % fingerprintStore)
+                code.line(u'    %s = %s.rows(%s, %s)' % (rows, fingerprintStore, source, rows))
+            sharder = code.uniqueName('Sharder')
+            code.line(u"%s = _globals.get('_xscSharder')" % sharder)
+            code.line(u'if %s is not None:' % sharder)
+            code.line(u'    %s = %s.rows(%d, %s, %s)' % (rows, sharder, self.outermostLoopIndex, source, rows))
+        if self.parallelLoopIndex is not None:
+            parallelLoopWriter = code.uniqueName('ParallelLoopWriter')
+            code.line(u"%s = _globals.get('_xscParallelLoopWriter')" % parallelLoopWriter)
+            code.line(u'if %s is not None:' % parallelLoopWriter)
+            code.line(u'    %s.write(_xml, %s, %d)' % (parallelLoopWriter, rows, self.parallelLoopIndex))
+            code.line(u'else:')
+            code.indent()
+            self._writeLoopCode(code, source, rows)
+            code.dedent()
+        else:
+            self._writeLoopCode(code, source, rows)
+
+    def _writeLoopCode(self, code, source, rows):
+        if self.childNodes:
+            variables = code.uniqueName('Variables')
+            oldVariables = code.uniqueName('OldVariables')
+            oldRiderVariables = code.uniqueName('OldRiderVariables')
+            restoreVariable = code.constant(_restoreVariable, 'RestoreVariable')
+            variablesClass = code.constant(_variablesClass, 'VariablesClass')
+            code.line(u'%s = %s(%s.interface.fieldNames)()' % (variables, variablesClass, source))
+            code.line(u"%s = _globals.get('_xscVariables')" % oldVariables)
+            code.line(u'%s = _globals.get(%r)' % (oldRiderVariables, self.rider))
+            code.line(u"_globals['_xscVariables'] = %s" % variables)
+            code.line(u'_globals[%r] = %s' % (self.rider, variables))
+            code.line(u'for %s._values in %s:' % (variables, rows))
+            code.indent()
+            self.writeChildrenCode(code)
+            code.dedent()
+            code.line(u'%s(_globals, %r, %s)' % (restoreVariable, self.rider, oldRiderVariables))
+            code.line(u"%s(_globals, '_xscVariables', %s)" % (restoreVariable, oldVariables))
+        else:
+            # Still read all rows so streamed data are validated.
+            code.line(u'for _ in %s:' % rows)
+            code.line(u'    pass')
+
+class XscGroupNode(XscNode):
+    """
+    Node to write children for each group of consecutive rows with the same value in column
+    ``keyColumn``. Within the group, the rider refers to the first row of the group and a
+    ``<?xsc for ...?>`` with the same rider traverses only the rows of the group.
+    """
+    def __init__(self, rider, keyColumn):
+        assert rider
+        assert keyColumn
+        super(XscGroupNode, self).__init__('group')
+        self.rider = rider
+        self.keyColumn = keyColumn
+
+    @property
+    def description(self):
+        return u'group %s by %s' % (self.rider, self.keyColumn)
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
-        # TODO: Check that rider name has not been used by other <?for ...?> on the stack.
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
         source = sourceNameToSourceMap[self.rider]
-        variables = _Variables()
-        for row in source.data:
-            variables.setNamesAndValues(source.interface.fieldNames, row)
-            oldVariables = globals().get('_xscVariables')
-            globals()['_xscVariables'] = variables
-            globals()[self.rider] = variables
+        groupSourceNameToSourceMap = dict(sourceNameToSourceMap)
+        variables = _variablesClass(source.interface.fieldNames)()
+        oldVariables = namespace.get('_xscVariables')
+        oldRiderVariables = namespace.get(self.rider)
+        for groupSource in source.groups(self.keyColumn):
+            groupSourceNameToSourceMap[self.rider] = groupSource
+            variables._values = groupSource.data[0]
+            # Loops over the group rows bind variables of their own, so bind them again.
+            namespace['_xscVariables'] = variables
+            namespace[self.rider] = variables
             if self.childNodes:
                 for xscNode in self.childNodes:
-                    xscNode.write(xmlWriter, sourceNameToSourceMap)
-            del globals()[self.rider]
-            if oldVariables is not None:
-                globals()['_xscVariables'] = oldVariables
-            else:
-                del globals()['_xscVariables']
+                    xscNode.write(xmlWriter, groupSourceNameToSourceMap, namespace)
+        _restoreVariable(namespace, self.rider, oldRiderVariables)
+        _restoreVariable(namespace, '_xscVariables', oldVariables)
+
+    def writeCode(self, code):
+        source = code.uniqueName('Source')
+        groupSources = code.uniqueName('GroupSources')
+        groupSource = code.uniqueName('GroupSource')
+        variables = code.uniqueName('Variables')
+        oldVariables = code.uniqueName('OldVariables')
+        oldRiderVariables = code.uniqueName('OldRiderVariables')
+        restoreVariable = code.constant(_restoreVariable, 'RestoreVariable')
+        variablesClass = code.constant(_variablesClass, 'VariablesClass')
+        code.line(u'%s = %s[%r]' % (source, code.sourcesName, self.rider))
+        code.line(u'%s = dict(%s)' % (groupSources, code.sourcesName))
+        code.line(u'%s = %s(%s.interface.fieldNames)()' % (variables, variablesClass, source))
+        code.line(u"%s = _globals.get('_xscVariables')" % oldVariables)
+        code.line(u'%s = _globals.get(%r)' % (oldRiderVariables, self.rider))
+        code.line(u'for %s in %s.groups(%r):' % (groupSource, source, self.keyColumn))
+        code.indent()
+        code.line(u'%s[%r] = %s' % (groupSources, self.rider, groupSource))
+        code.line(u'%s._values = %s.data[0]' % (variables, groupSource))
+        code.line(u"_globals['_xscVariables'] = %s" % variables)
+        code.line(u'_globals[%r] = %s' % (self.rider, variables))
+        if self.childNodes:
+            oldSourcesName = code.sourcesName
+            code.sourcesName = groupSources
+            self.writeChildrenCode(code)
+            code.sourcesName = oldSourcesName
+        code.dedent()
+        code.line(u'%s(_globals, %r, %s)' % (restoreVariable, self.rider, oldRiderVariables))
+        code.line(u"%s(_globals, '_xscVariables', %s)" % (restoreVariable, oldVariables))
 
 class XscIfNode(XscNode):
     """
     Node to write children only if a condition if fulfilled. The condition is text describing a
-    Python expression to be processed using ``evaluated()``.
+    Python expression to be processed using ``evaluated()``. The ``location`` in the template
+    is reported if the condition is broken.
     """
-    def __init__(self, condition):
+    def __init__(self, condition, location=None):
         super(XscIfNode, self).__init__('if')
         self.condition = condition
+        self._compiledCondition = _compiledExpression(condition, location)
+
+    @property
+    def description(self):
+        return u'if %s' % self.condition.strip()
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
         if self.childNodes:
-            conditionFulfilled = eval(self.condition)
+            try:
+                conditionFulfilled = eval(self._compiledCondition, namespace)
+            except Exception, error:
+                raise _expressionError(self.condition, error, namespace)
             if conditionFulfilled:
                 for xscNode in self.childNodes:
-                    xscNode.write(xmlWriter, sourceNameToSourceMap)
+                    xscNode.write(xmlWriter, sourceNameToSourceMap, namespace)
+
+    def writeCode(self, code):
+        if self.childNodes:
+            code.line(u'if %s:' % code.expression(self.condition))
+            code.indent()
+            self.writeChildrenCode(code)
+            code.dedent()
 
 class XscPythonNode(XscNode):
     """
@@ -127,9 +533,166 @@ class XscPythonNode(XscNode):
         assert code is not None
         super(XscPythonNode, self).__init__('python')
         self.code = code
+        self._compiledCode = compile(code, '<xsc python>', 'exec')
+
+    @property
+    def description(self):
+        return u'python %s' % u' '.join(self.code.split())
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        exec self._compiledCode in namespace
+
+    def writeCode(self, code):
+        code.line(u'exec %s in _globals' % code.constant(self._compiledCode, 'Python'))
+
+class XscAggregate(object):
+    """
+    Aggregate declared using ``<?xsc let name = function(rider.column) by keyColumn?>``,
+    which is computed in a single pass over the data source ``rider`` before the template is
+    rendered. With ``keyColumn``, the name refers to a map of the values in this column to
+    the aggregate of their rows, otherwise to the aggregate of all rows. The ``function`` is
+    one of `Functions`; except for ``count``, values are converted to ``decimal.Decimal``.
+    Empty values are ignored, and ``count`` without ``column`` counts rows.
+    """
+    # Map of function names to tuples of (initial state, function to update the state with a
+    # value, function to compute the result from the state).
+    _FunctionToOperationsMap = {
+        'avg': ((0, 0), lambda state, value: (state[0] + value, state[1] + 1),
+            lambda state: state[0] / state[1] if state[1] else None),
+        'count': (0, lambda state, value: state + 1, lambda state: state),
+        'max': (None, lambda state, value: value if (state is None) or (value > state) else state, lambda state: state),
+        'min': (None, lambda state, value: value if (state is None) or (value < state) else state, lambda state: state),
+        'sum': (0, lambda state, value: state + value, lambda state: state),
+    }
+    Functions = tuple(sorted(_FunctionToOperationsMap.keys()))
+
+    def __init__(self, name, function, rider, column=None, keyColumn=None):
+        assert name
+        assert function in XscAggregate.Functions, 'function=%r' % function
+        assert rider
+        assert (column is not None) or (function == 'count')
+        self.name = name
+        self.function = function
+        self.rider = rider
+        self.column = column
+        self.keyColumn = keyColumn
+
+    @property
+    def description(self):
+        result = u'let %s = %s(%s%s)' % (self.name, self.function, self.rider, u'.' + self.column if self.column else u'')
+        if self.keyColumn is not None:
+            result += u' by %s' % self.keyColumn
+        return result
+
+class _AggregateMap(dict):
+    """
+    Map of keys to aggregates of their rows that results in ``default`` for keys without rows.
+    """
+    def __init__(self, keyToValueMap, default):
+        super(_AggregateMap, self).__init__(keyToValueMap)
+        self.default = default
+
+    def __missing__(self, key):
+        return self.default
+
+class _AggregateAccumulator(object):
+    """
+    Accumulator computing the `XscAggregate` ``aggregate`` from the rows of ``source``
+    passed to `add()`.
+    """
+    def __init__(self, aggregate, source):
+        assert aggregate is not None
+        assert source is not None
+        self.aggregate = aggregate
+        self._sourceName = source.name
+        fieldNames = list(source.interface.fieldNames)
+        self._columnIndex = self._fieldIndex(fieldNames, aggregate.column)
+        self._keyColumnIndex = self._fieldIndex(fieldNames, aggregate.keyColumn)
+        self._initialState, self._update, self._result = XscAggregate._FunctionToOperationsMap[aggregate.function]
+        self._isNumeric = (aggregate.function != 'count')
+        self._keyToStateMap = {}
+
+    def _fieldIndex(self, fieldNames, column):
+        result = None
+        if column is not None:
+            if column not in fieldNames:
+                raise XscValueError(u'column of data source %r for <?xsc %s?> is %r but must be one of: %s'
+                    % (self._sourceName, self.aggregate.description, column, fieldNames))
+            result = fieldNames.index(column)
+        return result
+
+    def add(self, row, rowNumber):
+        value = None
+        if self._columnIndex is not None:
+            value = row[self._columnIndex]
+            if not value:
+                return
+            if self._isNumeric:
+                try:
+                    value = decimal.Decimal(value)
+                except decimal.InvalidOperation:
+                    raise XscValueError(u'cannot compute <?xsc %s?>: value of column %r in row %d of %r must be a number but is: %r'
+                        % (self.aggregate.description, self.aggregate.column, rowNumber, self._sourceName, value))
+        key = row[self._keyColumnIndex] if self._keyColumnIndex is not None else None
+        keyToStateMap = self._keyToStateMap
+        keyToStateMap[key] = self._update(keyToStateMap.get(key, self._initialState), value)
+
+    def value(self):
+        """
+        The aggregate of the rows added so far.
+        """
+        default = self._result(self._initialState)
+        if self._keyColumnIndex is None:
+            result = self._result(self._keyToStateMap[None]) if self._keyToStateMap else default
+        else:
+            result = _AggregateMap(
+                ((key, self._result(state)) for key, state in self._keyToStateMap.iteritems()), default
+            )
+        return result
+
+def _aggregateValues(source, aggregates):
+    """
+    Map of the names of ``aggregates`` to their values computed in a single pass over the
+    rows of ``source``.
+    """
+    assert source is not None
+    assert aggregates
+    accumulators = [_AggregateAccumulator(aggregate, source) for aggregate in aggregates]
+    for rowNumber, row in enumerate(source.rows(), 1):
+        for accumulator in accumulators:
+            accumulator.add(row, rowNumber)
+    return dict((accumulator.aggregate.name, accumulator.value()) for accumulator in accumulators)
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
-        exec self.code in globals()
+class _ElementTags(object):
+    """
+    Start and end tag of an `ElementNode` prepared once so XML writers only have to process
+    the values of attributes that contain code for each row. Attributes are sorted by name
+    the same way ``loxun.XmlWriter`` writes them, including ``xmlns`` declarations.
+    """
+    def __init__(self, name, attributeTemplates):
+        assert name
+        assert attributeTemplates is not None
+        self.name = name
+        # List of (name, value) for attributes without code.
+        self.staticAttributeItems = []
+        # Names of attributes with code in the order their values are passed to XML writers.
+        self.dynamicAttributeNames = []
+        # Start tag as UTF-8 encoded parts without the final '>' to be joined with the quoted
+        # values of dynamic attributes, so there is one part more than dynamic attributes.
+        self.encodedStartTagParts = []
+        encodedStartTagPart = '<' + name.encode('utf-8')
+        for attributeName, attributeTemplate in sorted(attributeTemplates, key=lambda item: item[0]):
+            encodedStartTagPart += ' %s=' % attributeName.encode('utf-8')
+            if attributeTemplate.hasCode:
+                self.dynamicAttributeNames.append(attributeName)
+                self.encodedStartTagParts.append(encodedStartTagPart)
+                encodedStartTagPart = ''
+            else:
+                attributeValue = attributeTemplate.evaluated(None)
+                self.staticAttributeItems.append((attributeName, attributeValue))
+                encodedStartTagPart += _quotedAttributeValue(attributeValue)
+        self.encodedStartTagParts.append(encodedStartTagPart)
+        self.encodedEndTag = '</%s>' % name.encode('utf-8')
 
 class ElementNode(XscNode):
     def __init__(self, name, attributes):
@@ -143,22 +706,47 @@ class ElementNode(XscNode):
                 _log.error(u'%s.%s = %r', name, attributeName, attributeValue)
                 raise
             self.attributeTemplates.append((attributeName, attributeTemplate))
+        self.tags = _ElementTags(name, self.attributeTemplates)
+
+    @property
+    def isStatic(self):
+        result = not any(attributeTemplate.hasCode for _, attributeTemplate in self.attributeTemplates)
+        if result and self.childNodes:
+            result = all(xscNode.isStatic for xscNode in self.childNodes)
+        return result
+
+    @property
+    def description(self):
+        return u'<%s%s>' % (self.name, u''.join(
+            u' %s="%s"' % (attributeName, attributeTemplate)
+            for attributeName, attributeTemplate in self.attributeTemplates if attributeTemplate.hasCode
+        ))
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
-        processedAttributes = {}
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        attributeNameToValueMap = {}
         for name, attributeTemplate in self.attributeTemplates:
-            attributeValue = attributeTemplate.evaluated()
-            if name == u'xmlns':
-                xmlWriter.addNamespace(u'', attributeValue)
-            elif name.startswith(u'xmlns:'):
-                xmlWriter.addNamespace(name[6:], attributeValue)
-            else:
-                processedAttributes[name] = attributeValue
-        xmlWriter.startTag(self.name, processedAttributes)
+            if attributeTemplate.hasCode:
+                attributeNameToValueMap[name] = attributeTemplate.evaluated(namespace)
+        xmlWriter.startElement(
+            self.tags, tuple(attributeNameToValueMap[name] for name in self.tags.dynamicAttributeNames)
+        )
         if self.childNodes:
             for xscNode in self.childNodes:
-                xscNode.write(xmlWriter, sourceNameToSourceMap)
-        xmlWriter.endTag(self.name)
+                xscNode.write(xmlWriter, sourceNameToSourceMap, namespace)
+        xmlWriter.endElement(self.tags)
+
+    def writeCode(self, code):
+        attributeNameToValueMap = {}
+        for name, attributeTemplate in self.attributeTemplates:
+            if attributeTemplate.hasCode:
+                value = code.uniqueName('Value')
+                code.line(u'%s = %s' % (value, attributeTemplate.code(code)))
+                attributeNameToValueMap[name] = value
+        tags = code.constant(self.tags, 'Tags')
+        values = u''.join(u'%s, ' % attributeNameToValueMap[name] for name in self.tags.dynamicAttributeNames)
+        code.line(u'_xmlStartElement(%s, (%s))' % (tags, values))
+        self.writeChildrenCode(code)
+        code.line(u'_xmlEndElement(%s)' % tags)
 
 class DataNode(XscNode):
     def __init__(self, name, data):
@@ -174,26 +762,316 @@ class TextNode(DataNode):
         super(TextNode, self).__init__('text', data)
         self.template = _InlineTemplate(data)
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
+    @property
+    def isStatic(self):
+        return not self.template.hasCode
+
+    @property
+    def description(self):
+        return u' '.join(unicode(self.template).split())
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
         assert xmlWriter
-        xmlWriter.text(self.template.evaluated())
+        xmlWriter.text(self.template.evaluated(namespace))
+
+    def writeCode(self, code):
+        if self.template.hasCode:
+            # Evaluate expressions in a separate statement so errors can be attributed to them.
+            code.line(u'_xscText = %s' % self.template.code(code))
+            code.line(u'_xmlText(_xscText)')
+        else:
+            code.line(u'_xmlText(%s)' % self.template.code(code))
 
 class CommentNode(DataNode):
     def __init__(self, data):
         super(CommentNode, self).__init__('comment', data)
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
+    @property
+    def isStatic(self):
+        # Comments containing '--' are left to the XML writer to complain about.
+        return u'--' not in self.data
+
+    @property
+    def description(self):
+        return u'<!--%s-->' % self.data
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
         assert xmlWriter
         xmlWriter.comment(self.data)
 
+    def writeCode(self, code):
+        code.line(u'_xmlComment(%r)' % self.data)
+
+class StaticNode(DataNode):
+    """
+    Node for a sequence of static nodes serialized to UTF-8 once so it can be written as
+    is for each row.
+    """
+    def __init__(self, staticNodes):
+        assert staticNodes
+        encodedData = _encodedStaticNodes(staticNodes)
+        super(StaticNode, self).__init__('static', encodedData.decode('utf-8'))
+        self.encodedData = encodedData
+        self.location = staticNodes[0].location
+
+    @property
+    def isStatic(self):
+        return True
+
+    @property
+    def description(self):
+        return u'static data of %d bytes' % len(self.encodedData)
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        assert xmlWriter
+        xmlWriter.writeEncoded(self.encodedData)
+
+    def writeCode(self, code):
+        code.line(u'_xmlWriteEncoded(%s)' % code.constant(self.encodedData, 'Static'))
+
 class ProcessInstructionNode(DataNode):
     def __init__(self, target, data):
         super(ProcessInstructionNode, self).__init__(u'instruction: %s' % target, data)
 
-    def write(self, xmlWriter, sourceNameToSourceMap):
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
         assert xmlWriter
         xmlWriter.processingInstruction(self.target, self.data)
 
+class _XmlWriter(loxun.XmlWriter):
+    """
+    XML writer that in addition to ``loxun.XmlWriter`` can write data that already have been
+    serialized and encoded as UTF-8.
+    """
+    def __init__(self, output, **keywords):
+        assert output is not None
+        super(_XmlWriter, self).__init__(output, pretty=False, sourceEncoding='utf-8', **keywords)
+        assert self.encoding == u'utf-8', 'encoding=%r' % self.encoding
+
+    def writeEncoded(self, data):
+        assert data is not None
+        self._possiblyFlushTag()
+        self._output.write(data)
+
+    def flush(self):
+        """
+        Nothing to do because ``loxun`` writes to the output immediately.
+        """
+        pass
+
+    def startElement(self, elementTags, attributeValues):
+        """
+        Start element described by the `_ElementTags` ``elementTags`` using ``attributeValues``
+        for its `_ElementTags.dynamicAttributeNames`.
+        """
+        assert elementTags is not None
+        assert len(attributeValues) == len(elementTags.dynamicAttributeNames)
+        attributes = {}
+        for name, value in elementTags.staticAttributeItems + zip(elementTags.dynamicAttributeNames, attributeValues):
+            if name == u'xmlns':
+                self.addNamespace(u'', value)
+            elif name.startswith(u'xmlns:'):
+                self.addNamespace(name[6:], value)
+            else:
+                attributes[name] = value
+        self.startTag(elementTags.name, attributes)
+
+    def endElement(self, elementTags):
+        assert elementTags is not None
+        self.endTag(elementTags.name)
+
+class _FragmentXmlWriter(_XmlWriter):
+    """
+    XML writer for fragments of a document without a prolog. As namespace prefixes might be
+    declared outside of the fragment, they are not validated. The XML parser already did so
+    when reading the template.
+    """
+    def __init__(self, output):
+        super(_FragmentXmlWriter, self).__init__(output, prolog=False)
+
+    def _validateNamespaceItem(self, itemName, namespace, qualifiedName):
+        pass
+
+_AttributeValueToEscapeRegEx = re.compile('[&<>"\n\r\t]')
+
+def _encodedXmlValue(value):
+    """
+    ``value`` encoded as UTF-8, possibly after converting it to unicode the same way
+    ``loxun.XmlWriter`` does.
+    """
+    if isinstance(value, unicode):
+        result = value.encode('utf-8')
+    elif isinstance(value, str):
+        # Validate that the value actually is UTF-8.
+        value.decode('utf-8')
+        result = value
+    else:
+        result = unicode(value).encode('utf-8')
+    return result
+
+def _escapedText(text):
+    """
+    ``text`` encoded as UTF-8 with '&', '<' and '>' escaped.
+    """
+    result = _encodedXmlValue(text)
+    if ('&' in result) or ('<' in result) or ('>' in result):
+        result = result.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return result
+
+def _quotedAttributeValue(value):
+    """
+    ``value`` encoded as UTF-8, escaped and quoted the same way as
+    ``xml.sax.saxutils.quoteattr()`` does.
+    """
+    result = _encodedXmlValue(value)
+    if _AttributeValueToEscapeRegEx.search(result) is None:
+        result = '"' + result + '"'
+    else:
+        result = result.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        result = result.replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;')
+        if '"' in result:
+            if "'" in result:
+                result = '"%s"' % result.replace('"', '&quot;')
+            else:
+                result = "'%s'" % result
+        else:
+            result = '"%s"' % result
+    return result
+
+class _NativeXmlWriter(object):
+    """
+    XML writer with the same output as `_XmlWriter` for the elements, text and encoded data
+    xsc writes, but faster. Tags and static attributes are encoded once per `ElementNode`,
+    only text and values of dynamic attributes are escaped, and output is collected in a list
+    of encoded parts which is written in large blocks. Like ``loxun``, an element without
+    content ends up as empty element tag such as ``<some/>``.
+
+    Names and namespaces are not validated because the XML parser already did so when reading
+    the template.
+    """
+    # Number of collected parts after which to write them to the output.
+    _PartCountToFlush = 8192
+
+    def __init__(self, output, prolog=True):
+        assert output is not None
+        self._output = output
+        self._parts = []
+        # Has the last start tag been written without its final '>' yet?
+        self._isStartTagOpen = False
+        self._depth = 0
+        if prolog:
+            self._parts.append('<?xml version="1.0" encoding="utf-8"?>')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, errorType, error, traceback):
+        if error is None:
+            self.close()
+        else:
+            # Keep what has been written so far like loxun does.
+            self.flush()
+
+    def flush(self):
+        """
+        Write the parts collected so far to the output.
+        """
+        if self._parts:
+            self._output.write(''.join(self._parts))
+            self._parts = []
+
+    def startElement(self, elementTags, attributeValues):
+        """
+        Start element described by the `_ElementTags` ``elementTags`` using ``attributeValues``
+        for its `_ElementTags.dynamicAttributeNames`.
+        """
+        parts = self._parts
+        if self._isStartTagOpen:
+            parts.append('>')
+        encodedStartTagParts = elementTags.encodedStartTagParts
+        parts.append(encodedStartTagParts[0])
+        if attributeValues:
+            assert len(attributeValues) == len(elementTags.dynamicAttributeNames)
+            for partIndex, attributeValue in enumerate(attributeValues, 1):
+                parts.append(_quotedAttributeValue(attributeValue))
+                parts.append(encodedStartTagParts[partIndex])
+        self._isStartTagOpen = True
+        self._depth += 1
+
+    def endElement(self, elementTags):
+        if self._depth == 0:
+            raise loxun.XmlError('tag stack must not be empty')
+        self._depth -= 1
+        if self._isStartTagOpen:
+            self._parts.append('/>')
+            self._isStartTagOpen = False
+        else:
+            self._parts.append(elementTags.encodedEndTag)
+        if len(self._parts) >= _NativeXmlWriter._PartCountToFlush:
+            self.flush()
+
+    def text(self, text):
+        if text is None:
+            raise loxun.XmlError('text must not be None')
+        if self._isStartTagOpen:
+            self._parts.append('>')
+            self._isStartTagOpen = False
+        if text:
+            self._parts.append(_escapedText(text))
+
+    def writeEncoded(self, data):
+        assert data is not None
+        if self._isStartTagOpen:
+            self._parts.append('>')
+            self._isStartTagOpen = False
+        self._parts.append(data)
+
+    def comment(self, text):
+        # Comments only get here if they are invalid, so leave the error message to loxun.
+        fragment = StringIO.StringIO()
+        fragmentWriter = _FragmentXmlWriter(fragment)
+        fragmentWriter.comment(text)
+        fragmentWriter.close()
+        self.writeEncoded(fragment.getvalue())
+
+    def close(self):
+        if self._depth:
+            raise loxun.XmlError('missing end tags must be added: %d' % self._depth)
+        self.flush()
+
+class _NativeFragmentXmlWriter(_NativeXmlWriter):
+    """
+    `_NativeXmlWriter` for fragments of a document without a prolog.
+    """
+    def __init__(self, output):
+        super(_NativeFragmentXmlWriter, self).__init__(output, prolog=False)
+
+def _newXmlWriter(writer, output, isFragment=False):
+    """
+    XML writer of kind ``writer`` writing to ``output``, which is either `WriterNative` or
+    `WriterLoxun`.
+    """
+    assert writer in _Writers, 'writer=%r' % writer
+    assert output is not None
+    if writer == WriterNative:
+        writerClass = _NativeFragmentXmlWriter if isFragment else _NativeXmlWriter
+    else:
+        writerClass = _FragmentXmlWriter if isFragment else _XmlWriter
+    return writerClass(output)
+
+def _encodedStaticNodes(staticNodes):
+    """
+    The output of ``staticNodes`` as UTF-8 encoded data, exactly as it would be written one
+    node after another.
+    """
+    assert staticNodes
+    fragment = StringIO.StringIO()
+    fragmentWriter = _FragmentXmlWriter(fragment)
+    for staticNode in staticNodes:
+        assert staticNode.isStatic
+        staticNode.write(fragmentWriter, None, None)
+    fragmentWriter.close()
+    return fragment.getvalue()
+
 class XscInlineSyntaxError(XscSyntaxError):
     # TODO: Add error location.
     pass
@@ -207,10 +1085,6 @@ class _InlineTemplate(object):
     Internal representation of text that might use ``${...}`` to inline Python
     variables and code.
     """
-    _StateInText = 't'
-    _StateInTextAfterDollar = '$'
-    _StateInPlaceHolder = '*'
-
     _ItemText = 'text'
     _ItemCode = 'code'
 
@@ -219,107 +1093,104 @@ class _InlineTemplate(object):
 
     def __init__(self, templateDescripton):
         assert templateDescripton is not None
-        self._state = _InlineTemplate._StateInText
         self._items = []
-        self._text = u''
-        for ch in templateDescripton:
-            if self._state == _InlineTemplate._StateInText:
-                if ch == '$':
-                    self._append(_InlineTemplate._ItemText, _InlineTemplate._StateInTextAfterDollar)
-                self._text += ch
-            elif self._state == _InlineTemplate._StateInTextAfterDollar:
-                assert self._text == u'$', "text=%r" % self._text
-                if ch == '$':
-                    self._append(_InlineTemplate._ItemText, _InlineTemplate._StateInText)
-                elif ch == '{':
-                    self._state = _InlineTemplate._StateInPlaceHolder
-                    self._text = u''
-                else:
-                    # TODO: Add location to error message.
-                    raise XscInlineSyntaxError(u'$ must be followed by $ or { but found: %r' % ch)
-            elif self._state == _InlineTemplate._StateInPlaceHolder:
-                if ch == '}':
-                    self._append(_InlineTemplate._ItemCode, _InlineTemplate._StateInText)
-                else:
-                    self._text += ch
+        # Search for the next '$' instead of looking at each character so long texts
+        # without code are processed at once.
+        position = 0
+        dollarIndex = templateDescripton.find(u'$')
+        while dollarIndex != -1:
+            self._appendItem(_InlineTemplate._ItemText, templateDescripton[position:dollarIndex])
+            charAfterDollar = templateDescripton[dollarIndex + 1:dollarIndex + 2]
+            if charAfterDollar == u'$':
+                self._appendItem(_InlineTemplate._ItemText, u'$')
+                position = dollarIndex + 2
+            elif charAfterDollar == u'{':
+                placeHolderEndIndex = templateDescripton.find(u'}', dollarIndex + 2)
+                if placeHolderEndIndex == -1:
+                    raise XscInlineSyntaxError('place holder must end with }')
+                self._appendItem(_InlineTemplate._ItemCode, templateDescripton[dollarIndex + 2:placeHolderEndIndex])
+                position = placeHolderEndIndex + 1
+            elif charAfterDollar:
+                # TODO: Add location to error message.
+                raise XscInlineSyntaxError(u'$ must be followed by $ or { but found: %r' % charAfterDollar)
             else:
-                assert False
-        if self._state == _InlineTemplate._StateInText:
-            self._append(_InlineTemplate._ItemText)
-        elif self._state == _InlineTemplate._StateInTextAfterDollar:
-            # TODO: Add location to error message.
-            raise XscInlineSyntaxError(u'$ at end of template must be followed by $')
-        elif self._state == _InlineTemplate._StateInPlaceHolder:
-            raise XscInlineSyntaxError('place holder must end with }')
-        else:
-            assert False
-
-    def _possibleVariableName(self, attributeError):
-        """
-        Name of variable in ``attributeError`` or ``None``.
-        """
-        assert attributeError
-        assert isinstance(attributeError, AttributeError)
-        attributeErrorMatch = _InlineTemplate.attributeErrorRegEx.match(unicode(attributeError))
-        if attributeErrorMatch:
-            className = attributeErrorMatch.group('className')
-            if className == _Variables.__name__:
-                result = attributeErrorMatch.group('attributeName')
-        return result
+                # TODO: Add location to error message.
+                raise XscInlineSyntaxError(u'$ at end of template must be followed by $')
+            dollarIndex = templateDescripton.find(u'$', position)
+        self._appendItem(_InlineTemplate._ItemText, templateDescripton[position:])
+        self._compiledItems = []
+        for itemType, itemText in self._items:
+            if itemType == _InlineTemplate._ItemCode:
+                self._compiledItems.append((itemType, _compiledExpression(itemText), itemText))
+            else:
+                self._compiledItems.append((itemType, itemText, itemText))
 
-    def evaluated(self):
+    def evaluated(self, namespace):
         """
         The value resulting by evaluating expressions embedded in ``${...}`` using
-        current ``globals()``.
+        ``namespace`` as globals.
         """
         result = u''
-
-        # If there are no variables (for example when using Python constants or expressions
-        # without a <?xsc for?>), use an empty dummy variable dump.
-        if '_xscVariables' not in globals():
-            globals()['_xscVariables'] = _Variables()
-
-        for itemType, itemText in self._items:
+        for itemType, itemTextOrCode, itemText in self._compiledItems:
             if itemType == _InlineTemplate._ItemCode:
                 try:
-                    evaluatedText = eval(itemText)
+                    evaluatedText = eval(itemTextOrCode, namespace)
                     if not isinstance(evaluatedText, basestring):
                         evaluatedText = unicode(evaluatedText)
                     result += evaluatedText
                 except Exception, error:
-                    _log.error(u'cannot evaluate expression: %s', itemText)
-                    _log.error(u'currently defined variables:')
-                    variables = globals()['_xscVariables']
-                    for variableName in sorted(variables.__dict__.keys()):
-                        _log.error(u'  %s = %s', variableName, repr(variables.__dict__[variableName]))
-                    detailMessage = unicode(error)
-                    if isinstance(error, AttributeError):
-                        # Extract unknown attribute name from error message.
-                        unknownVariableName = self._possibleVariableName(error)
-                        if unknownVariableName:
-                            detailMessage = u'cannot find column "%s"' % unknownVariableName
-                    _log.exception(error)
-                    raise XscValueError(u'cannot evaluate expression: %r: %s' % (itemText, detailMessage))
+                    raise _expressionError(itemText, error, namespace)
             elif itemType == _InlineTemplate._ItemText:
-                result += itemText
+                result += itemTextOrCode
             else:
                 assert False
         return result
 
-    def _append(self, itemType, newState=None):
-        assert itemType in (_InlineTemplate._ItemCode, _InlineTemplate._ItemText)
-        assert newState in (None, _InlineTemplate._StateInPlaceHolder, _InlineTemplate._StateInText, _InlineTemplate._StateInTextAfterDollar)
-        if self._text:
-            # TODO: De-HTML-escape '&lt;' to '<' and so on.
-            self._items.append((itemType, self._text))
-        if newState:
-            self._state = newState
-        self._text = u''
-
-    def __str__(self):
-        return unicode(self).encode('utf-8')
+    @property
+    def hasCode(self):
+        """
+        ``True`` if the template contains at least one ``${...}``.
+        """
+        return _InlineTemplate._ItemCode in (itemType for itemType, _ in self._items)
 
-    def __repr__(self):
+    @property
+    def expressions(self):
+        """
+        List of the Python expressions embedded in ``${...}``.
+        """
+        return [itemText for itemType, itemText in self._items if itemType == _InlineTemplate._ItemCode]
+
+    def code(self, codeWriter):
+        """
+        Python code for an expression with the same result as `evaluated()`.
+        """
+        assert codeWriter is not None
+        itemCodes = []
+        for itemType, itemText in self._items:
+            if itemType == _InlineTemplate._ItemCode:
+                itemCodes.append(codeWriter.constant(unicode, 'Unicode') + codeWriter.expression(itemText))
+            elif itemType == _InlineTemplate._ItemText:
+                itemCodes.append(repr(itemText))
+            else:
+                assert False
+        if not itemCodes:
+            result = repr(u'')
+        elif len(itemCodes) == 1:
+            result = itemCodes[0]
+        else:
+            result = u"u''.join((%s))" % u', '.join(itemCodes)
+        return result
+
+    def _appendItem(self, itemType, itemText):
+        assert itemType in (_InlineTemplate._ItemCode, _InlineTemplate._ItemText)
+        if itemText:
+            # TODO: De-HTML-escape '&lt;' to '<' and so on.
+            self._items.append((itemType, unicode(itemText)))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __repr__(self):
         return '_InlineTemplate(%s)' % self._items
 
     def __unicode__(self):
@@ -333,15 +1204,439 @@ class _InlineTemplate(object):
                 assert False
         return result
 
+def _compiledExpression(expression, location=None):
+    """
+    Python code object for ``expression`` to be processed using ``eval()``. If ``location``
+    is a tuple of (line, column), it is part of the error message for a broken expression.
+    """
+    assert expression is not None
+    try:
+        result = compile(expression.strip(), '<xsc expression>', 'eval')
+    except SyntaxError, error:
+        message = u'cannot process Python expression: %r: %s' % (expression, error)
+        if location is not None:
+            message = u'%d:%d: %s' % (location + (message,))
+        raise XscSyntaxError(message)
+    return result
+
+def _possibleVariableName(attributeError):
+    """
+    Name of variable in ``attributeError`` or ``None``.
+    """
+    assert attributeError
+    assert isinstance(attributeError, AttributeError)
+    result = None
+    attributeErrorMatch = _InlineTemplate.attributeErrorRegEx.match(unicode(attributeError))
+    if attributeErrorMatch:
+        className = attributeErrorMatch.group('className')
+        if className == _Variables.__name__:
+            result = attributeErrorMatch.group('attributeName')
+    return result
+
+def _expressionError(expression, error, namespace):
+    """
+    `XscValueError` describing that ``expression`` could not be evaluated because of
+    ``error``, after logging details about variables currently defined in ``namespace``.
+    """
+    assert expression is not None
+    assert error is not None
+    assert namespace is not None
+    _log.error(u'cannot evaluate expression: %s', expression)
+    _log.error(u'currently defined variables:')
+    variables = namespace.get('_xscVariables')
+    if variables is not None:
+        for variableName, value in sorted(variables.namesAndValues()):
+            _log.error(u'  %s = %s', variableName, repr(value))
+    detailMessage = unicode(error)
+    if isinstance(error, AttributeError):
+        # Extract unknown attribute name from error message.
+        unknownVariableName = _possibleVariableName(error)
+        if unknownVariableName:
+            detailMessage = u'cannot find column "%s"' % unknownVariableName
+    _log.exception(error)
+    return XscValueError(u'cannot evaluate expression: %r: %s' % (expression, detailMessage))
+
+# Names that give code access to the rows of all data sources without referring to columns
+# by name.
+_DynamicRowAccessNames = frozenset(['_xscVariables', 'eval', 'execfile', 'globals', 'locals', 'vars'])
+
+# Names of builtins conditions may use to be applied while loading data.
+_RowConditionBuiltinNames = frozenset(['abs', 'bool', 'float', 'int', 'len', 'max', 'min', 'round', 'str', 'unicode'])
+
 class XscTemplate(object):
-    def __init__(self, xscFilePath):
+    _ForRegEx = re.compile(
+        r'^for\s+(?P<rider>\S+)(\s+where\s+(?P<keyColumn>[a-zA-Z_][a-zA-Z0-9_]*)\s*==\s*(?P<keyExpression>\S.*))?$',
+        re.DOTALL
+    )
+    _GroupRegEx = re.compile(r'^group\s+(?P<rider>\S+)\s+by\s+(?P<keyColumn>[a-zA-Z_][a-zA-Z0-9_]*)$')
+    _LetRegEx = re.compile(
+        r'^let\s+(?P<name>[a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*(?P<function>[a-z]+)\s*\(\s*(?P<rider>[a-zA-Z_][a-zA-Z0-9_]*)'
+        + r'(\.(?P<column>[a-zA-Z_][a-zA-Z0-9_]*))?\s*\)(\s+by\s+(?P<keyColumn>[a-zA-Z_][a-zA-Z0-9_]*))?$'
+    )
+
+    def __init__(self, xscFilePath, cacheFolderPath=None):
+        """
+        Template read from ``xscFilePath``. If ``cacheFolderPath`` is specified, the parsed and
+        compiled template is cached in this folder, so an unchanged template need not be
+        parsed and compiled again.
+        """
+        self.path = xscFilePath
         self.content = XscNode()
+        # Map of names to modules imported using ``<?xsc import ...?>``.
+        self.importedModules = {}
+        # Names of modules in the order they are imported.
+        self._importedModuleNames = []
+        # List of `XscAggregate` declared using ``<?xsc let ...?>``.
+        self.aggregates = []
         self._xscStack = [self.content]
         self._commandStack = []
+        self._compiled = None
+        self._compiledParallelLoops = {}
 
         _log.info('read template "%s"', xscFilePath)
-        domDocument = minidom.parse(xscFilePath)
-        self._processNode(domDocument)
+        cachedState = None
+        if cacheFolderPath is not None:
+            dataCache = _DataCache(cacheFolderPath)
+            templateKey = dataCache.templateKey(xscFilePath)
+            cachedState = dataCache.templateState(templateKey)
+        if cachedState is not None:
+            _log.info('  use compiled template from cache')
+            self.__setstate__(cachedState)
+        else:
+            with open(xscFilePath, 'rb') as xscFile:
+                self._read(xscFile)
+            self._foldStaticNodes(self.content)
+            self.singlePassSourceNames = self._singlePassSourceNames()
+            self.parallelLoops = self._parallelLoops()
+            self.outermostLoops = self._outermostLoops()
+            self.sourceConditions = self._sourceConditions()
+            self.usedColumnNames = self._usedColumnNames()
+            if cacheFolderPath is not None:
+                # Compile now so the cache holds the compiled template too.
+                self.compiled
+                try:
+                    dataCache.storeTemplateState(templateKey, self.__getstate__())
+                except EnvironmentError, error:
+                    _log.warning(u'cannot store compiled template in cache: %s', error)
+
+    def __getstate__(self):
+        result = dict(self.__dict__)
+        # Modules cannot be pickled, so they are imported again by `__setstate__()`.
+        del result['importedModules']
+        # Parallel loops are compiled on demand before forking workers.
+        result['_compiledParallelLoops'] = {}
+        return result
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.importedModules = {}
+        for moduleToImport in self._importedModuleNames:
+            self._importModule(moduleToImport)
+
+    def _import(self, moduleToImport):
+        """
+        Import module ``moduleToImport`` for expressions like ``<?xsc import ...?>``.
+        """
+        assert moduleToImport
+        self._importModule(moduleToImport)
+        self._importedModuleNames.append(moduleToImport)
+
+    def _importModule(self, moduleToImport):
+        try:
+            _log.info('import %s', moduleToImport)
+            # Like the import statement, bind the top level package.
+            self.importedModules[moduleToImport.split('.')[0]] = __import__(moduleToImport)
+        except Exception, error:
+            raise XscError(u'cannot xsc import module %r: %s' % (moduleToImport, error))
+
+    def _addAggregate(self, command):
+        assert command is not None
+        letMatch = XscTemplate._LetRegEx.match(command)
+        if letMatch is None:
+            raise XscSyntaxError(
+                u'let command must match <?xsc let {name} = {function}({rider}.{column})?> or '
+                + u'<?xsc let {name} = {function}({rider}.{column}) by {column}?> but is: %s' % command
+            )
+        name, function, rider, column, keyColumn = letMatch.group('name', 'function', 'rider', 'column', 'keyColumn')
+        if function not in XscAggregate.Functions:
+            raise XscSyntaxError(u'function for let command is %r but must be one of: %s' % (function, ', '.join(XscAggregate.Functions)))
+        if (column is None) and (function != 'count'):
+            raise XscSyntaxError(u'column to compute %s() of must be specified: %s' % (function, command))
+        if any(isinstance(xscCommandNode, (XscForNode, XscGroupNode)) for xscCommandNode in self._commandStack):
+            raise XscSyntaxError(u'let command must be moved outside of loops because it refers to all rows: %s' % command)
+        if name in set(aggregate.name for aggregate in self.aggregates):
+            raise XscSyntaxError(u'duplicate name for let command must be resolved: %s' % name)
+        _log.debug(u'%sadd xsc command: %s', self._debugIndent, command)
+        self.aggregates.append(XscAggregate(name, function, rider, column, keyColumn))
+
+    def _collectSourcePassCounts(self, xscNode, loopDepth, groupedRiders, sourceNameToPassCountMap):
+        assert xscNode is not None
+        assert loopDepth >= 0
+        assert groupedRiders is not None
+        assert sourceNameToPassCountMap is not None
+        if xscNode.childNodes:
+            for childNode in xscNode.childNodes:
+                childLoopDepth = loopDepth
+                childGroupedRiders = groupedRiders
+                if isinstance(childNode, (XscForNode, XscGroupNode)):
+                    rider = childNode.rider
+                    if rider not in groupedRiders:
+                        # A loop nested in another loop is passed once for each row of the outer
+                        # loop. A loop with a key needs an index on all rows.
+                        isSinglePass = (loopDepth == 0) and not (
+                            isinstance(childNode, XscForNode) and (childNode.keyColumn is not None)
+                        )
+                        passCount = 1 if isSinglePass else 2
+                        sourceNameToPassCountMap[rider] = sourceNameToPassCountMap.get(rider, 0) + passCount
+                    # Loops within a group traverse only the rows of the group.
+                    if isinstance(childNode, XscGroupNode):
+                        childGroupedRiders = groupedRiders | set([rider])
+                    childLoopDepth += 1
+                self._collectSourcePassCounts(childNode, childLoopDepth, childGroupedRiders, sourceNameToPassCountMap)
+
+    def _singlePassSourceNames(self):
+        """
+        Set of names of data sources the template reads exactly once, so rows can be streamed
+        from the data file instead of being loaded into memory first.
+        """
+        sourceNameToPassCountMap = {}
+        self._collectSourcePassCounts(self.content, 0, frozenset(), sourceNameToPassCountMap)
+        # Aggregates of the same data source are computed in a single pass.
+        for rider in set(aggregate.rider for aggregate in self.aggregates):
+            sourceNameToPassCountMap[rider] = sourceNameToPassCountMap.get(rider, 0) + 1
+        return set(name for name, passCount in sourceNameToPassCountMap.items() if passCount == 1)
+
+    def _hasPythonNode(self, xscNode):
+        assert xscNode is not None
+        return isinstance(xscNode, XscPythonNode) \
+            or any(self._hasPythonNode(childNode) for childNode in (xscNode.childNodes or []))
+
+    def _collectParallelLoops(self, xscNode, parallelLoops):
+        assert xscNode is not None
+        assert parallelLoops is not None
+        for childNode in xscNode.childNodes or []:
+            if isinstance(childNode, XscForNode):
+                if (childNode.keyColumn is None) and childNode.childNodes:
+                    childNode.parallelLoopIndex = len(parallelLoops)
+                    parallelLoops.append(childNode)
+            elif not isinstance(childNode, XscGroupNode):
+                self._collectParallelLoops(childNode, parallelLoops)
+
+    def _collectOutermostLoops(self, xscNode, outermostLoops):
+        assert xscNode is not None
+        assert outermostLoops is not None
+        for childNode in xscNode.childNodes or []:
+            if isinstance(childNode, XscForNode):
+                childNode.outermostLoopIndex = len(outermostLoops)
+                outermostLoops.append(childNode)
+            elif not isinstance(childNode, XscGroupNode):
+                self._collectOutermostLoops(childNode, outermostLoops)
+
+    def _outermostLoops(self):
+        """
+        List of `XscForNode` not nested in another loop, so each of them is passed at most once.
+        """
+        result = []
+        self._collectOutermostLoops(self.content, result)
+        return result
+
+    def _collectSourceUses(self, xscNode, sourceNameToUsesMap):
+        assert xscNode is not None
+        assert sourceNameToUsesMap is not None
+        for childNode in xscNode.childNodes or []:
+            if isinstance(childNode, (XscForNode, XscGroupNode)):
+                sourceNameToUsesMap.setdefault(childNode.rider, []).append(childNode)
+            self._collectSourceUses(childNode, sourceNameToUsesMap)
+
+    def _isRowCondition(self, condition, rider, builtinNames):
+        """
+        Does the Python expression ``condition`` only refer to columns of ``rider``, constants
+        and ``builtinNames``, so its result depends on nothing but the current row?
+        """
+        assert condition is not None
+        assert rider
+        assert builtinNames is not None
+        try:
+            expressionTree = ast.parse(condition.strip(), mode='eval')
+        except SyntaxError:
+            return False
+        riderNameNodeIds = set(
+            id(node.value) for node in ast.walk(expressionTree)
+            if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and (node.value.id == rider)
+        )
+        for node in ast.walk(expressionTree):
+            if isinstance(node, ast.Name):
+                if node.id == rider:
+                    if id(node) not in riderNameNodeIds:
+                        return False
+                elif (node.id not in ('True', 'False', 'None')) and (node.id not in builtinNames):
+                    return False
+            elif isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)):
+                return False
+        return True
+
+    def _sourceConditions(self):
+        """
+        Map of names of data sources to conditions that rows must fulfill to be written at all,
+        so other rows can be skipped while loading. This is the case if each loop over the data
+        source consists of nothing but an ``<?xsc if?>`` with the same condition, which only
+        refers to columns of the current row and constants.
+        """
+        result = {}
+        sourceNameToUsesMap = {}
+        self._collectSourceUses(self.content, sourceNameToUsesMap)
+        aggregatedSourceNames = set(aggregate.rider for aggregate in self.aggregates)
+        # Code from ``<?xsc python?>``, aggregates and modules might replace builtins.
+        if self._hasPythonNode(self.content):
+            builtinNames = frozenset()
+        else:
+            builtinNames = _RowConditionBuiltinNames - set(self.importedModules) \
+                - set(aggregate.name for aggregate in self.aggregates)
+        for sourceName, uses in sourceNameToUsesMap.items():
+            if sourceName not in aggregatedSourceNames:
+                conditions = set()
+                for use in uses:
+                    childNodes = use.childNodes or []
+                    if isinstance(use, XscForNode) and (use.keyColumn is None) \
+                            and (len(childNodes) == 1) and isinstance(childNodes[0], XscIfNode):
+                        conditions.add(childNodes[0].condition.strip())
+                    else:
+                        conditions.add(None)
+                if len(conditions) == 1:
+                    condition = conditions.pop()
+                    if (condition is not None) and self._isRowCondition(condition, sourceName, builtinNames):
+                        _log.info(u'skip rows of data source %r unless: %s', sourceName, condition)
+                        result[sourceName] = condition
+        return result
+
+    def _collectCodes(self, xscNode, codes):
+        assert xscNode is not None
+        assert codes is not None
+        for childNode in xscNode.childNodes or []:
+            if isinstance(childNode, TextNode):
+                codes.extend((expression, 'eval') for expression in childNode.template.expressions)
+            elif isinstance(childNode, ElementNode):
+                for _, attributeTemplate in childNode.attributeTemplates:
+                    codes.extend((expression, 'eval') for expression in attributeTemplate.expressions)
+            elif isinstance(childNode, XscIfNode):
+                codes.append((childNode.condition, 'eval'))
+            elif isinstance(childNode, XscForNode) and (childNode.keyExpression is not None):
+                codes.append((childNode.keyExpression, 'eval'))
+            elif isinstance(childNode, XscPythonNode):
+                codes.append((childNode.code, 'exec'))
+            self._collectCodes(childNode, codes)
+
+    def _usedColumnNames(self):
+        """
+        Map of names of data sources to sets of names of the columns the template refers to
+        using ``rider.column`` or as key or aggregated column, so other columns need not be
+        stored while loading data. Data sources whose rows might be accessed in other ways, for
+        example by passing the rider to a function, are not in the map, so all their columns
+        are stored.
+        """
+        sourceNameToUsesMap = {}
+        self._collectSourceUses(self.content, sourceNameToUsesMap)
+        result = {}
+        for sourceName, uses in sourceNameToUsesMap.items():
+            result[sourceName] = set(use.keyColumn for use in uses if use.keyColumn is not None)
+        for aggregate in self.aggregates:
+            aggregateColumnNames = result.setdefault(aggregate.rider, set())
+            for columnName in (aggregate.column, aggregate.keyColumn):
+                if columnName is not None:
+                    aggregateColumnNames.add(columnName)
+        dynamicSourceNames = set()
+        codes = []
+        self._collectCodes(self.content, codes)
+        for code, mode in codes:
+            try:
+                codeTree = ast.parse(code.strip() if mode == 'eval' else code, mode=mode)
+            except SyntaxError:
+                # Treat code that cannot be analyzed like code accessing rows dynamically.
+                codeTree = None
+            if (codeTree is None) or any(
+                (isinstance(node, ast.Name) and (node.id in _DynamicRowAccessNames)) or isinstance(node, ast.Exec)
+                for node in ast.walk(codeTree)
+            ):
+                _log.info(u'store all columns of all data sources because code might access them dynamically: %s',
+                    u' '.join(code.split()))
+                return {}
+            columnNameNodeIds = set()
+            for node in ast.walk(codeTree):
+                if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and (node.value.id in result):
+                    sourceName = node.value.id
+                    if hasattr(_Variables, node.attr):
+                        dynamicSourceNames.add(sourceName)
+                    else:
+                        result[sourceName].add(node.attr)
+                        columnNameNodeIds.add(id(node.value))
+            for node in ast.walk(codeTree):
+                if isinstance(node, ast.Name) and (node.id in result) and (id(node) not in columnNameNodeIds):
+                    dynamicSourceNames.add(node.id)
+        for sourceName in sorted(dynamicSourceNames):
+            _log.info(u'store all columns of data source %r because code might access its rows dynamically', sourceName)
+            del result[sourceName]
+        return dict((sourceName, frozenset(columnNames)) for sourceName, columnNames in result.items())
+
+    def _parallelLoops(self):
+        """
+        List of `XscForNode` not nested in another loop whose rows can be rendered
+        independent of each other, so chunks of rows can be rendered in parallel. If the
+        template uses ``<?xsc python?>``, rows might depend on each other, so there are none.
+        """
+        result = []
+        if not self._hasPythonNode(self.content):
+            self._collectParallelLoops(self.content, result)
+        return result
+
+    def compiledParallelLoop(self, parallelLoopIndex):
+        """
+        The `XscCompiledTemplate` rendering only the loop ``parallelLoops[parallelLoopIndex]``.
+        """
+        result = self._compiledParallelLoops.get(parallelLoopIndex)
+        if result is None:
+            result = XscCompiledTemplate(self, [self.parallelLoops[parallelLoopIndex]])
+            self._compiledParallelLoops[parallelLoopIndex] = result
+        return result
+
+    def _foldStaticNodes(self, xscNode):
+        """
+        Replace sequences of static children of ``xscNode`` by a `StaticNode`.
+        """
+        assert xscNode is not None
+        if xscNode.childNodes:
+            foldedChildNodes = []
+            staticNodes = []
+            for childNode in xscNode.childNodes:
+                if childNode.isStatic:
+                    staticNodes.append(childNode)
+                else:
+                    if staticNodes:
+                        foldedChildNodes.append(StaticNode(staticNodes))
+                        staticNodes = []
+                    self._foldStaticNodes(childNode)
+                    foldedChildNodes.append(childNode)
+            if staticNodes:
+                foldedChildNodes.append(StaticNode(staticNodes))
+            xscNode.childNodes = foldedChildNodes
+
+    def newNamespace(self):
+        """
+        A new namespace to evaluate the expressions of a single conversion in. It starts with
+        the modules from ``<?xsc import ...?>``; ``<?xsc python?>`` and loops add their own
+        names, which other conversions of the same template do not see.
+        """
+        result = {'__builtins__': __builtins__}
+        result.update(self.importedModules)
+        return result
+
+    @property
+    def compiled(self):
+        """
+        The `XscCompiledTemplate` for this template, which is compiled on first access.
+        """
+        if self._compiled is None:
+            self._compiled = XscCompiledTemplate(self)
+        return self._compiled
 
     @property
     def currentXscNode(self):
@@ -381,98 +1676,1651 @@ class XscTemplate(object):
         self._commandStack.pop()
         self._popXscNode()
 
-    def _addChild(self, xscNode):
-        assert xscNode
-        self.currentXscNode.addChild(xscNode)
+    def _addChild(self, xscNode, location):
+        assert xscNode
+        xscNode.location = location
+        self.currentXscNode.addChild(xscNode)
+
+    def _read(self, xscFile):
+        """
+        Build the `XscNode` tree from the XML in ``xscFile`` while parsing it with expat, so
+        no DOM has to be built first. The location of each node is stored as tuple of
+        (line, column) in `XscNode.location`.
+        """
+        assert xscFile is not None
+        self._parser = expat.ParserCreate()
+        # Report text in pieces so the location of the first piece is where the text starts.
+        self._parser.buffer_text = False
+        self._parser.ordered_attributes = True
+        self._parser.StartElementHandler = self._startElement
+        self._parser.EndElementHandler = self._endElement
+        self._parser.CharacterDataHandler = self._characterData
+        self._parser.CommentHandler = self._comment
+        self._parser.ProcessingInstructionHandler = self._processingInstruction
+        self._pendingTextParts = []
+        self._pendingTextLocation = None
+        try:
+            self._parser.ParseFile(xscFile)
+            self._addPendingText()
+        finally:
+            self._parser = None
+
+    def _location(self):
+        return (self._parser.CurrentLineNumber, self._parser.CurrentColumnNumber + 1)
+
+    def _addPendingText(self):
+        """
+        Add text collected since the last element, comment or processing instruction as
+        single `TextNode`.
+        """
+        if self._pendingTextParts:
+            text = u''.join(self._pendingTextParts)
+            _log.debug(u'%sadd text: %r' , self._debugIndent, text)
+            self._addChild(TextNode(text), self._pendingTextLocation)
+            self._pendingTextParts = []
+
+    @property
+    def _debugIndent(self):
+        return '  ' * 2 * len(self._xscStack)
+
+    def _startElement(self, tagName, attributeNamesAndValues):
+        self._addPendingText()
+        attributes = zip(attributeNamesAndValues[::2], attributeNamesAndValues[1::2])
+        _log.debug(u'%sadd tag: %s; %s', self._debugIndent, tagName, attributes)
+        elementNode = ElementNode(tagName, attributes)
+        self._addChild(elementNode, self._location())
+        self._pushXscNode(elementNode)
+
+    def _endElement(self, tagName):
+        self._addPendingText()
+        self._popXscNode()
+
+    def _characterData(self, data):
+        if not self._pendingTextParts:
+            self._pendingTextLocation = self._location()
+        self._pendingTextParts.append(data)
+
+    def _comment(self, data):
+        self._addPendingText()
+        _log.debug(u'%sadd comment: %r' , self._debugIndent, data)
+        self._addChild(CommentNode(data), self._location())
+
+    def _processingInstruction(self, target, data):
+        self._addPendingText()
+        location = self._location()
+        indent = self._debugIndent
+        if target == 'xsc':
+            # TODO: Use Python tokenizer to split and syntax check xsc processing instructions.
+            words = data.strip().split()
+            if not words:
+                raise XscSyntaxError('xsc command must be specified')
+            command = words[0]
+            wordCount = len(words)
+            if command == 'for':
+                forMatch = XscTemplate._ForRegEx.match(data.strip())
+                if forMatch is None:
+                    raise XscSyntaxError(
+                        u'for command must match <?xsc for {rider}?> or '
+                        + u'<?xsc for {rider} where {column} == {expression}?> but is: %s' % data
+                    )
+                rider = forMatch.group('rider')
+                keyColumn = forMatch.group('keyColumn')
+                keyExpression = forMatch.group('keyExpression')
+                xscForNode = XscForNode(rider, keyColumn, keyExpression, location)
+                _log.debug(u'%sadd xsc command: %s %s', indent, command, data[3:].strip())
+                self._addChild(xscForNode, location)
+                self._pushCommand(xscForNode)
+            elif command == 'group':
+                groupMatch = XscTemplate._GroupRegEx.match(data.strip())
+                if groupMatch is None:
+                    raise XscSyntaxError(u'group command must match <?xsc group {rider} by {column}?> but is: %s' % data)
+                rider = groupMatch.group('rider')
+                keyColumn = groupMatch.group('keyColumn')
+                xscGroupNode = XscGroupNode(rider, keyColumn)
+                _log.debug(u'%sadd xsc command: %s %s by %s', indent, command, rider, keyColumn)
+                self._addChild(xscGroupNode, location)
+                self._pushCommand(xscGroupNode)
+            elif command == 'end':
+                if wordCount == 1:
+                    raise XscInlineSyntaxError(u'xsc command to end must be specified')
+                if wordCount > 2:
+                    raise XscInlineSyntaxError(u'text after xsc command to end must be removed: %r' % words[2:])
+                commandToEnd = words[1]
+                _log.debug(u'%send xsc command: %s', indent, commandToEnd)
+                self._popCommand(commandToEnd)
+            elif command == 'if':
+                if wordCount < 2:
+                    raise XscSyntaxError(u'if command must match <?xsc if {condition}?> but is: %s' % data)
+                # TODO: Remove check below once Python tokenizer is used to parse xsc processing instructions.
+                if not data.startswith('if'):
+                    raise NotImplementedError("cannot process white space before 'if'")
+                condition = data[2:]
+                xscIfNode = XscIfNode(condition, location)
+                _log.debug(u'%sadd xsc command: %s %s', indent, command, condition)
+                self._addChild(xscIfNode, location)
+                self._pushCommand(xscIfNode)
+            elif command == 'import':
+                # TODO: Use python tokenizer to validate that module name is a Python name.
+                # TODO: Add 'import x as y' syntax.
+                if wordCount == 1:
+                    raise XscInlineSyntaxError(u'Python module to import must be specified')
+                if wordCount > 2:
+                    raise XscInlineSyntaxError(u'text after Python module to import must be removed: %r' % words[2:])
+                self._import(words[1])
+            elif command == 'let':
+                self._addAggregate(data.strip())
+            elif command == 'python':
+                code = data[len('python'):]
+                cmxPythonNode = XscPythonNode(code)
+                _log.debug(u'%sadd xsc command: %s %s', indent, command, code)
+                self._addChild(cmxPythonNode, location)
+            elif command == '#':
+                # Ignore xsc comment.
+                pass
+            else:
+                raise XscSyntaxError(u'cannot process unknown xsc command: <?xsc %s ...?>' % target)
+        else:
+            raise NotImplementedError(u'processing instructions for target %r must be removed because currently only <?xsc ...?> is implemented' % target)
+
+class XscCompiledTemplate(object):
+    """
+    `XscTemplate` compiled to a single Python function rendering the whole document. Compared
+    to walking the `XscNode` tree for each row, expressions are compiled only once, text is
+    joined at once and loops are plain ``for`` statements.
+    """
+    _RenderFunctionName = '_xscRender'
+
+    def __init__(self, template, xscNodes=None):
+        """
+        Compile the ``xscNodes`` of ``template``, by default all of them.
+        """
+        assert template is not None
+
+        if xscNodes is None:
+            xscNodes = template.content.childNodes or []
+        code = _CodeWriter()
+        code.indent()
+        code.line(u'_globals = globals()')
+        for methodName in ('comment', 'endElement', 'startElement', 'text', 'writeEncoded'):
+            code.line(u'_xml%s = _xml.%s' % (methodName[0].upper() + methodName[1:], methodName))
+        for xscNode in xscNodes:
+            xscNode.writeCode(code)
+        constantNames = [name for name, _ in code.constants]
+        header = u'def %s(_xml, _sources%s):' % (
+            XscCompiledTemplate._RenderFunctionName, u''.join(u', %s=None' % name for name in constantNames)
+        )
+        # The header takes the first line, so expressions move down by one line.
+        self.source = header + u'\n' + code.source
+        self._lineToExpressionMap = dict(
+            (lineNumber + 1, expression) for lineNumber, expression in code.lineToExpressionMap.items()
+        )
+        self._fileName = '<xsc template %s>' % template.path
+        _log.debug(u'compiled template:\n%s', self.source)
+        functionNamespace = {}
+        exec compile(self.source, self._fileName, 'exec') in functionNamespace
+        self._renderCode = functionNamespace[XscCompiledTemplate._RenderFunctionName].func_code
+        self._constants = tuple(value for _, value in code.constants)
+
+    def _failedExpression(self, traceback):
+        """
+        The xsc expression the innermost rendering code in ``traceback`` was processing or
+        ``None`` if it was not processing an expression.
+        """
+        result = None
+        while traceback is not None:
+            if traceback.tb_frame.f_code.co_filename == self._fileName:
+                result = self._lineToExpressionMap.get(traceback.tb_lineno)
+            traceback = traceback.tb_next
+        return result
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        """
+        Render the template to ``xmlWriter`` using ``namespace`` as globals for expressions,
+        which typically is obtained from `XscTemplate.newNamespace()`.
+        """
+        render = types.FunctionType(
+            self._renderCode, namespace, XscCompiledTemplate._RenderFunctionName, self._constants
+        )
+        try:
+            render(xmlWriter, sourceNameToSourceMap)
+        except XscError:
+            raise
+        except Exception, error:
+            failedExpression = self._failedExpression(sys.exc_info()[2])
+            if failedExpression is None:
+                raise
+            raise _expressionError(failedExpression, error, namespace)
+
+class _ProfileEntry(object):
+    """
+    Call count and times measured by `TemplateProfiler` for an `XscNode` or the XML writer.
+    """
+    def __init__(self, location, kind, description):
+        self.location = location
+        self.kind = kind
+        self.description = description
+        self.callCount = 0
+        # Time spent in the node including its children.
+        self.totalTime = 0.0
+        # Time spent in the node excluding its children and the XML writer.
+        self.selfTime = 0.0
+
+    @property
+    def locationText(self):
+        if self.location is None:
+            result = u'-'
+        else:
+            result = u'%d:%d' % self.location
+        return result
+
+    def asJson(self):
+        return {
+            'line': self.location[0] if self.location is not None else None,
+            'column': self.location[1] if self.location is not None else None,
+            'kind': self.kind,
+            'description': self.description,
+            'calls': self.callCount,
+            'totalTime': self.totalTime,
+            'selfTime': self.selfTime,
+        }
+
+class _ProfiledNode(XscNode):
+    """
+    Node that measures the time it takes to write a copy of ``xscNode`` whose children are
+    profiled too. The copy leaves ``xscNode`` untouched, so other conversions of the same
+    template are not affected.
+    """
+    def __init__(self, xscNode, profiler):
+        assert xscNode is not None
+        assert profiler is not None
+        super(_ProfiledNode, self).__init__(xscNode.name)
+        self._profiler = profiler
+        self._entry = profiler.entryFor(xscNode)
+        self._xscNode = copy.copy(xscNode)
+        if xscNode.childNodes:
+            self._xscNode.childNodes = [_ProfiledNode(childNode, profiler) for childNode in xscNode.childNodes]
+
+    def write(self, xmlWriter, sourceNameToSourceMap, namespace):
+        profiler = self._profiler
+        profiler.enter()
+        try:
+            self._xscNode.write(xmlWriter, sourceNameToSourceMap, namespace)
+        finally:
+            profiler.leave(self._entry)
+
+class _ProfiledXmlWriter(object):
+    """
+    XML writer that measures the time spent in the XML writer it delegates to.
+    """
+    def __init__(self, xmlWriter, profiler):
+        assert xmlWriter is not None
+        assert profiler is not None
+        self._xmlWriter = xmlWriter
+        self._profiler = profiler
+
+    def _timed(self, method, *arguments):
+        profiler = self._profiler
+        profiler.enter()
+        try:
+            return method(*arguments)
+        finally:
+            profiler.leave(profiler.writerEntry)
+
+    def startElement(self, elementTags, attributeValues):
+        self._timed(self._xmlWriter.startElement, elementTags, attributeValues)
+
+    def endElement(self, elementTags):
+        self._timed(self._xmlWriter.endElement, elementTags)
+
+    def text(self, text):
+        self._timed(self._xmlWriter.text, text)
+
+    def writeEncoded(self, data):
+        self._timed(self._xmlWriter.writeEncoded, data)
+
+    def comment(self, text):
+        self._timed(self._xmlWriter.comment, text)
+
+class TemplateProfiler(object):
+    """
+    Call counts and times of each `XscNode` of a template and the XML writer measured while
+    rendering it with `write()`. Self times exclude the time spent in child nodes and the XML
+    writer, so they show where the time actually goes. A profiler must only be used by one
+    conversion at a time.
+    """
+    def __init__(self):
+        self.templatePath = None
+        self.writerEntry = _ProfileEntry(None, u'writer', u'XML output')
+        self._xscNodeToEntryMap = {}
+        self._startTimes = []
+        self._childTimes = []
+
+    def entryFor(self, xscNode):
+        """
+        The `_ProfileEntry` for ``xscNode``, which is created on first access.
+        """
+        assert xscNode is not None
+        result = self._xscNodeToEntryMap.get(xscNode)
+        if result is None:
+            result = _ProfileEntry(xscNode.location, xscNode.name, xscNode.description)
+            self._xscNodeToEntryMap[xscNode] = result
+        return result
+
+    def enter(self):
+        self._childTimes.append(0.0)
+        self._startTimes.append(timeit.default_timer())
+
+    def leave(self, entry):
+        duration = timeit.default_timer() - self._startTimes.pop()
+        entry.callCount += 1
+        entry.totalTime += duration
+        entry.selfTime += duration - self._childTimes.pop()
+        if self._childTimes:
+            self._childTimes[-1] += duration
+
+    def write(self, template, xmlWriter, sourceNameToSourceMap, namespace):
+        """
+        Render ``template`` to ``xmlWriter`` node by node like `EngineInterpreted` while
+        measuring each node.
+        """
+        assert template is not None
+        assert xmlWriter is not None
+        self.templatePath = template.path
+        profiledXmlWriter = _ProfiledXmlWriter(xmlWriter, self)
+        for xscNode in template.content.childNodes or []:
+            _ProfiledNode(xscNode, self).write(profiledXmlWriter, sourceNameToSourceMap, namespace)
+
+    @property
+    def entries(self):
+        """
+        List of `_ProfileEntry` for nodes that have been written and the XML writer, sorted
+        by self time with the slowest first.
+        """
+        result = [entry for entry in self._xscNodeToEntryMap.values() if entry.callCount]
+        result.append(self.writerEntry)
+        result.sort(key=lambda entry: (-entry.selfTime, entry.location))
+        return result
+
+    def reportLines(self, entryCount=None):
+        """
+        Lines of a human readable report on the ``entryCount`` slowest `entries`, by default all.
+        """
+        result = [u'%10s %10s %10s  %-9s %s' % (u'calls', u'total s', u'self s', u'location', u'node')]
+        for entry in self.entries[:entryCount]:
+            result.append(u'%10d %10.3f %10.3f  %-9s %s' % (
+                entry.callCount, entry.totalTime, entry.selfTime, entry.locationText, entry.description
+            ))
+        return result
+
+    def writeJson(self, targetJsonFilePath):
+        """
+        Write the `entries` to ``targetJsonFilePath`` as JSON document.
+        """
+        assert targetJsonFilePath is not None
+        with open(targetJsonFilePath, 'wb') as targetJsonFile:
+            json.dump({
+                'template': self.templatePath,
+                'nodes': [entry.asJson() for entry in self.entries],
+            }, targetJsonFile, indent=2, sort_keys=True)
+
+def _peakRss():
+    """
+    Peak resident set size in bytes of the current process and its terminated child
+    processes, or ``None`` if it cannot be determined on this platform.
+    """
+    if resource is None: # pragma: no cover
+        result = None
+    else:
+        result = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        )
+        # Mac OS X reports bytes, other platforms kilobytes.
+        if sys.platform != 'darwin':
+            result *= 1024
+    return result
+
+def _currentRss():
+    """
+    Current resident set size in bytes of the current process, or ``None`` if it cannot be
+    determined on this platform.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as statmFile:
+            result = int(statmFile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (EnvironmentError, ValueError, IndexError, AttributeError): # pragma: no cover
+        result = None
+    return result
+
+def _durationText(seconds):
+    """
+    ``seconds`` as text of the form ``h:mm:ss``.
+    """
+    assert seconds >= 0
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return u'%d:%02d:%02d' % (hours, minutes, seconds)
+
+class _ProgressReporter(object):
+    """
+    Reporter logging how many rows of an outermost `XscForNode` have been written so far,
+    at most once each ``interval`` seconds.
+    """
+    # Number of rows after which to check whether it is time to report progress.
+    _RowCountToCheck = 1024
+
+    def __init__(self, interval):
+        assert interval > 0
+        self.interval = interval
+
+    def rows(self, source, rows):
+        """
+        Iterator over ``rows`` of ``source`` that reports progress while it is iterated.
+        """
+        assert source is not None
+        assert rows is not None
+        # For streamed sources the number of rows is unknown in advance.
+        totalRowCount = None if source.isStreamed else source.rowCount
+        startTime = timeit.default_timer()
+        nextReportTime = startTime + self.interval
+        rowCountToCheck = _ProgressReporter._RowCountToCheck
+        for rowNumber, row in enumerate(rows, 1):
+            if not (rowNumber % rowCountToCheck):
+                now = timeit.default_timer()
+                if now >= nextReportTime:
+                    self._logProgress(source.name, rowNumber, totalRowCount, now - startTime)
+                    nextReportTime = now + self.interval
+            yield row
+
+    def _logProgress(self, sourceName, rowCount, totalRowCount, duration):
+        rowsPerSecond = rowCount / duration
+        if totalRowCount:
+            _log.info(u'wrote %d of %d rows of %r (%d%%), %.0f rows/s, about %s left',
+                rowCount, totalRowCount, sourceName, 100 * rowCount // totalRowCount, rowsPerSecond,
+                _durationText(max(0, totalRowCount - rowCount) / rowsPerSecond)
+            )
+        else:
+            _log.info(u'wrote %d rows of %r, %.0f rows/s', rowCount, sourceName, rowsPerSecond)
+
+class RunStatistics(object):
+    """
+    Measurements of a conversion: the duration and memory of each phase, such as reading the
+    template, reading the CID of a data source or sniffing it, loading data and writing the
+    output, the number of rows of each data source and the size of the output. The memory of
+    a phase is the resident set size at its start and end along with the peak resident set
+    size of the process so far.
+    """
+    def __init__(self):
+        self.startTime = time.time()
+        self._startTimer = timeit.default_timer()
+        # List of dictionaries describing each phase in the order they ended.
+        self.phases = []
+        # Map of data source names to dictionaries describing them.
+        self.sources = {}
+        self.outputByteCount = None
+        self.writeDuration = None
+
+    @contextlib.contextmanager
+    def phase(self, name, sourceName=None):
+        """
+        Context manager measuring the phase ``name``, possibly processing data source
+        ``sourceName``.
+        """
+        assert name
+        startRss = _currentRss()
+        startTime = timeit.default_timer()
+        yield
+        duration = timeit.default_timer() - startTime
+        self.phases.append({
+            'phase': name, 'source': sourceName, 'seconds': duration,
+            'rssAtStart': startRss, 'rssAtEnd': _currentRss(), 'peakRssSoFar': _peakRss(),
+        })
+        if name == 'write':
+            self.writeDuration = duration
+        _log.debug(u'finished phase %s%s in %.3f s', name, u' of %r' % sourceName if sourceName else u'', duration)
+
+    def setSource(self, source):
+        """
+        Remember the number of rows and other details of the `DataSource` ``source``.
+        """
+        assert source is not None
+        dataFilePath = source.dataFilePath
+        self.sources[source.name] = {
+            'rows': source.rowCount,
+            'streamed': source.isStreamed,
+            'usedColumns': sorted(source.usedColumnNames) if source.usedColumnNames is not None else None,
+            'dataFile': dataFilePath,
+            'dataBytes': os.path.getsize(dataFilePath) if (dataFilePath is not None) and os.path.exists(dataFilePath) else None,
+        }
+
+    def asJson(self):
+        """
+        The statistics as dictionary that can be stored as JSON document.
+        """
+        duration = timeit.default_timer() - self._startTimer
+        rowCount = sum(sourceStatistics['rows'] or 0 for sourceStatistics in self.sources.values())
+        writeDuration = self.writeDuration
+        return {
+            'xsc': __version__,
+            'startTime': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.startTime)),
+            'seconds': duration,
+            'peakRss': _peakRss(),
+            'phases': self.phases,
+            'sources': self.sources,
+            'rows': rowCount,
+            'outputBytes': self.outputByteCount,
+            'rowsPerSecond': rowCount / writeDuration if writeDuration else None,
+            'outputBytesPerSecond': (self.outputByteCount or 0) / writeDuration if writeDuration else None,
+        }
+
+    def writeJson(self, targetJsonFilePath):
+        """
+        Write the statistics to ``targetJsonFilePath`` as JSON document.
+        """
+        assert targetJsonFilePath is not None
+        with open(targetJsonFilePath, 'wb') as targetJsonFile:
+            json.dump(self.asJson(), targetJsonFile, indent=2, sort_keys=True)
+
+# Number of rows a worker process renders at once when using multiple jobs.
+_ParallelChunkRowCount = 500
+
+# Tuple of (template, sourceNameToSourceMap, engine, writer, aggregateValues) to render chunks with.
+# Worker processes inherit it when they are forked by `_ParallelLoopWriter`.
+_parallelWorkerState = None
+
+def _parallelChunkXml(parallelLoopIndex, rows):
+    """
+    UTF-8 encoded XML fragment resulting from the loop at ``parallelLoopIndex`` for ``rows``.
+    This runs in a worker process of `_ParallelLoopWriter`.
+    """
+    assert _parallelWorkerState is not None
+    template, sourceNameToSourceMap, engine, writer, aggregateValues = _parallelWorkerState
+    loop = template.parallelLoops[parallelLoopIndex]
+    chunkSource = DataSource(loop.rider)
+    chunkSource.setInterface(sourceNameToSourceMap[loop.rider].interface)
+    chunkSource.setRows(rows)
+    chunkSourceNameToSourceMap = dict(sourceNameToSourceMap)
+    chunkSourceNameToSourceMap[loop.rider] = chunkSource
+    namespace = template.newNamespace()
+    namespace.update(aggregateValues)
+    fragment = StringIO.StringIO()
+    fragmentWriter = _newXmlWriter(writer, fragment, isFragment=True)
+    if engine == EngineCompiled:
+        template.compiledParallelLoop(parallelLoopIndex).write(fragmentWriter, chunkSourceNameToSourceMap, namespace)
+    else:
+        loop.write(fragmentWriter, chunkSourceNameToSourceMap, namespace)
+    fragmentWriter.close()
+    return fragment.getvalue()
+
+class _ParallelLoopWriter(object):
+    """
+    Writer for the `XscTemplate.parallelLoops` that splits the rows into chunks, renders them
+    in a pool of ``jobs`` processes and writes the resulting fragments in order. Processes are
+    forked after the data have been loaded and ``aggregateValues`` have been computed, so only
+    rows of the loop are sent to them.
+    """
+    def __init__(self, template, sourceNameToSourceMap, engine, writer, jobs, aggregateValues):
+        assert template is not None
+        assert sourceNameToSourceMap is not None
+        assert aggregateValues is not None
+        assert engine in _Engines, 'engine=%r' % engine
+        assert writer in _Writers, 'writer=%r' % writer
+        assert jobs >= 2
+        global _parallelWorkerState
+
+        self._jobs = jobs
+        if engine == EngineCompiled:
+            # Compile before forking so workers need not do it.
+            for parallelLoopIndex in range(len(template.parallelLoops)):
+                template.compiledParallelLoop(parallelLoopIndex)
+        _parallelWorkerState = (template, sourceNameToSourceMap, engine, writer, aggregateValues)
+        try:
+            self._pool = multiprocessing.Pool(jobs)
+        finally:
+            _parallelWorkerState = None
+
+    def _chunks(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(list(row))
+            if len(chunk) == _ParallelChunkRowCount:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _writeFragment(self, xmlWriter, pendingFragment):
+        fragment = pendingFragment.get()
+        # Skip empty fragments so the XML writer can still collapse empty elements.
+        if fragment:
+            xmlWriter.writeEncoded(fragment)
+
+    def write(self, xmlWriter, rows, parallelLoopIndex):
+        """
+        Write the loop at ``parallelLoopIndex`` for all ``rows``, which are read in this
+        process, so wrappers such as `_ProgressReporter` still see each of them.
+        """
+        assert xmlWriter is not None
+        assert rows is not None
+        pendingFragments = collections.deque()
+        # Limit the number of pending chunks so streamed rows need not all be read at once.
+        for chunk in self._chunks(rows):
+            pendingFragments.append(self._pool.apply_async(_parallelChunkXml, (parallelLoopIndex, chunk)))
+            if len(pendingFragments) >= 2 * self._jobs:
+                self._writeFragment(xmlWriter, pendingFragments.popleft())
+        while pendingFragments:
+            self._writeFragment(xmlWriter, pendingFragments.popleft())
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+class Sharding(object):
+    """
+    Specification how to split the output into shards, each of which is a valid XML document
+    of its own. The rows of the loop over ``loopRider`` are split so a shard holds at most
+    ``rowCount`` rows, at most ``byteCount`` bytes before compression unless a single row is
+    larger, and only consecutive rows with the same value in column ``keyColumn``. At least
+    one of these limits must be specified. By default, the rows of the first loop not nested
+    in another loop are split.
+    """
+    def __init__(self, rowCount=None, byteCount=None, keyColumn=None, loopRider=None):
+        assert (rowCount is None) or (rowCount >= 1), 'rowCount=%r' % rowCount
+        assert (byteCount is None) or (byteCount >= 1), 'byteCount=%r' % byteCount
+        assert (rowCount, byteCount, keyColumn) != (None, None, None)
+        self.rowCount = rowCount
+        self.byteCount = byteCount
+        self.keyColumn = keyColumn
+        self.loopRider = loopRider
+
+    def loop(self, template):
+        """
+        The `XscForNode` of ``template`` whose rows are split into shards.
+        """
+        assert template is not None
+        outermostLoops = template.outermostLoops
+        if self.loopRider is None:
+            if not outermostLoops:
+                raise XscValueError(u'to split output into shards, the template must have a loop not nested in another loop')
+            result = outermostLoops[0]
+        else:
+            matchingLoops = [loop for loop in outermostLoops if loop.rider == self.loopRider]
+            if not matchingLoops:
+                raise XscValueError(u'shard loop is %r but must be one of the loops not nested in another loop: %s'
+                    % (self.loopRider, sorted(set(loop.rider for loop in outermostLoops))))
+            result = matchingLoops[0]
+        return result
+
+def _shardBasePathAndSuffix(targetXmlFilePath):
+    """
+    Tuple ``(basePath, suffix)`` of ``targetXmlFilePath``, where the suffix includes the
+    suffix of a compression, for example ``('customers', '.xml.gz')``.
+    """
+    assert targetXmlFilePath is not None
+    basePath, suffix = os.path.splitext(targetXmlFilePath)
+    if suffix.lower() in _SuffixToCompressionMap:
+        basePath, xmlSuffix = os.path.splitext(basePath)
+        suffix = xmlSuffix + suffix
+    return basePath, suffix
+
+def _shardPath(targetXmlFilePath, shardNumber):
+    """
+    Path of shard ``shardNumber`` of ``targetXmlFilePath``, for example
+    ``customers-00002.xml.gz`` for ``customers.xml.gz``.
+    """
+    assert shardNumber >= 1
+    basePath, suffix = _shardBasePathAndSuffix(targetXmlFilePath)
+    return '%s-%05d%s' % (basePath, shardNumber, suffix)
+
+def shardManifestPath(targetXmlFilePath):
+    """
+    Path of the JSON document describing the shards of ``targetXmlFilePath``, for example
+    ``customers-shards.json`` for ``customers.xml.gz``.
+    """
+    return _shardBasePathAndSuffix(targetXmlFilePath)[0] + '-shards.json'
+
+class _ShardOutput(object):
+    """
+    Output of the XML writer for the current shard that collects the data written for a row
+    in ``rowParts`` until it is known which shard the row belongs to.
+    """
+    def __init__(self):
+        self.xmlOutput = None
+        self.rowParts = None
+
+    def write(self, data):
+        if self.rowParts is None:
+            self.xmlOutput.write(data)
+        else:
+            self.rowParts.append(data)
+
+class _ShardedXmlWriter(object):
+    """
+    XML writer that splits the document into shards according to the `Sharding`
+    ``sharding`` at rows of the loop ``outermostLoopIndex`` in `XscTemplate.outermostLoops`.
+    The start tags of the elements open at the first row are repeated at the start of each
+    shard, which ends with their end tags, so each shard is a valid XML document. Everything
+    else written before the first row, for example comments or the rows of a previous loop,
+    ends up in the first shard only, just like everything written after the last row ends up
+    in the last shard only.
+
+    The loop passes its rows through `rows()`, so after each row it is decided whether its
+    XML still fits into the current shard. Shards are written to files named after
+    ``targetXmlFilePath`` as described in `_shardPath()`, and `close()` writes a JSON document
+    describing them to `shardManifestPath()`.
+    """
+    def __init__(self, targetXmlFilePath, compression, writer, sharding, outermostLoopIndex):
+        assert isinstance(targetXmlFilePath, basestring), 'targetXmlFilePath=%r' % targetXmlFilePath
+        assert compression in _Compressions + (None,), 'compression=%r' % compression
+        assert writer in _Writers, 'writer=%r' % writer
+        assert sharding is not None
+        assert outermostLoopIndex >= 0
+        self.manifestPath = shardManifestPath(targetXmlFilePath)
+        self._targetXmlFilePath = targetXmlFilePath
+        self._compression = compression
+        self._writer = writer
+        self._sharding = sharding
+        self._outermostLoopIndex = outermostLoopIndex
+        self._output = _ShardOutput()
+        self._xml = None
+        self._hasLoopStarted = False
+        # List of ``(elementTags, attributeValues)`` of the elements open before the first
+        # row of the loop.
+        self._openElements = []
+        self._epilogueByteCount = 0
+        # List of dictionaries describing each shard.
+        self.shards = []
+        self._openShard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, errorType, error, traceback):
+        if error is None:
+            self.close()
+        else:
+            # Keep what has been written so far like the other XML writers do.
+            self._xml.flush()
+            rowParts = self._output.rowParts
+            self._output.rowParts = None
+            if rowParts:
+                self._output.write(''.join(rowParts))
+            self._output.xmlOutput.close()
+
+    @property
+    def byteCount(self):
+        """
+        Number of bytes written to all shards before compressing them.
+        """
+        return sum(shard['bytes'] for shard in self.shards[:-1]) + self._output.xmlOutput.byteCount
+
+    def _openShard(self):
+        shard = {'path': _shardPath(self._targetXmlFilePath, len(self.shards) + 1), 'rows': 0, 'bytes': 0}
+        if self._sharding.keyColumn is not None:
+            shard['key'] = None
+        self.shards.append(shard)
+        self._output.xmlOutput = _XmlOutput(shard['path'], self._compression)
+        self._xml = _newXmlWriter(self._writer, self._output)
+
+    def _closeShard(self):
+        self._xml.close()
+        xmlOutput = self._output.xmlOutput
+        xmlOutput.close()
+        shard = self.shards[-1]
+        shard['bytes'] = xmlOutput.byteCount
+        _log.info(u'wrote shard "%s" with %d rows', shard['path'], shard['rows'])
+
+    def _nextShard(self):
+        for elementTags, _ in reversed(self._openElements):
+            self._xml.endElement(elementTags)
+        self._closeShard()
+        self._openShard()
+        for elementTags, attributeValues in self._openElements:
+            self._xml.startElement(elementTags, attributeValues)
+        # Close the last start tag so rows can be written as they are.
+        self._xml.writeEncoded('')
+
+    def _startLoop(self):
+        self._hasLoopStarted = True
+        self._xml.writeEncoded('')
+        self._epilogueByteCount = sum(len(elementTags.encodedEndTag) for elementTags, _ in self._openElements)
+        self._xml.flush()
+        self._output.rowParts = []
+
+    def _endRow(self, key):
+        self._xml.flush()
+        rowData = ''.join(self._output.rowParts)
+        self._output.rowParts = None
+        sharding = self._sharding
+        shard = self.shards[-1]
+        if shard['rows'] and (
+            ((sharding.rowCount is not None) and (shard['rows'] >= sharding.rowCount))
+            or ((sharding.keyColumn is not None) and (key != shard['key']))
+            or ((sharding.byteCount is not None)
+                and (self._output.xmlOutput.byteCount + len(rowData) + self._epilogueByteCount > sharding.byteCount))
+        ):
+            self._nextShard()
+            self._xml.flush()
+            shard = self.shards[-1]
+        if (sharding.keyColumn is not None) and not shard['rows']:
+            shard['key'] = key
+        self._output.write(rowData)
+        shard['rows'] += 1
+        self._output.rowParts = []
+
+    def rows(self, outermostLoopIndex, source, rows):
+        """
+        Iterator over ``rows`` of ``source`` for the loop ``outermostLoopIndex`` in
+        `XscTemplate.outermostLoops` that splits the output into shards while it is iterated.
+        """
+        assert outermostLoopIndex >= 0
+        assert source is not None
+        assert rows is not None
+        if outermostLoopIndex == self._outermostLoopIndex:
+            result = self._shardedRows(source, rows)
+        else:
+            result = rows
+        return result
+
+    def _shardedRows(self, source, rows):
+        keyColumn = self._sharding.keyColumn
+        keyColumnIndex = None
+        if keyColumn is not None:
+            fieldNames = list(source.interface.fieldNames)
+            if keyColumn not in fieldNames:
+                raise XscValueError(u'shard key column of %r is %r but must be one of: %s'
+                    % (source.name, keyColumn, fieldNames))
+            keyColumnIndex = fieldNames.index(keyColumn)
+        key = None
+        for row in rows:
+            if not self._hasLoopStarted:
+                self._startLoop()
+            if keyColumnIndex is not None:
+                key = row[keyColumnIndex]
+            yield row
+            self._endRow(key)
+        self._output.rowParts = None
+
+    def startElement(self, elementTags, attributeValues):
+        if not self._hasLoopStarted:
+            self._openElements.append((elementTags, attributeValues))
+        self._xml.startElement(elementTags, attributeValues)
+
+    def endElement(self, elementTags):
+        if not self._hasLoopStarted:
+            self._openElements.pop()
+        self._xml.endElement(elementTags)
+
+    def text(self, text):
+        self._xml.text(text)
+
+    def writeEncoded(self, data):
+        self._xml.writeEncoded(data)
+
+    def comment(self, text):
+        self._xml.comment(text)
+
+    def flush(self):
+        self._xml.flush()
+
+    def close(self):
+        """
+        Close the last shard and write the manifest describing all shards.
+        """
+        self._closeShard()
+        manifest = {
+            'shards': [dict(shard, path=os.path.basename(shard['path'])) for shard in self.shards],
+            'rows': sum(shard['rows'] for shard in self.shards),
+            'bytes': self.byteCount,
+        }
+        _log.info(u'write shard manifest "%s" for %d shards', self.manifestPath, len(self.shards))
+        with open(self.manifestPath, 'wb') as manifestFile:
+            json.dump(manifest, manifestFile, indent=2, sort_keys=True)
+
+class FingerprintStore(object):
+    """
+    Fingerprints of the rows of data sources from the previous conversion, so a delta
+    conversion writes only rows that are new or changed since. ``sourceNameToKeyColumnMap``
+    maps the names of data sources to compare to the column identifying their rows, whose
+    values should be unique. Only rows of loops over these sources that are not nested in
+    another loop are compared; loops nested in them still traverse all their rows.
+
+    Fingerprints are read from ``storePath`` unless it does not exist yet, in which case all
+    rows are new. `save()` replaces them with the fingerprints of the rows compared since.
+    The store holds `_Magic` followed by the key columns and fingerprints stored using
+    ``marshal``.
+    """
+    _Magic = 'xsc fingerprints 1\n'
+    # Number of bytes of the SHA1 digest of a row to keep as its fingerprint.
+    _FingerprintSize = 8
+
+    def __init__(self, storePath, sourceNameToKeyColumnMap):
+        assert storePath is not None
+        assert sourceNameToKeyColumnMap
+        self.storePath = storePath
+        self.sourceNameToKeyColumnMap = dict(sourceNameToKeyColumnMap)
+        # Maps of source names to maps of keys to fingerprints from the previous conversion
+        # and from the rows compared since.
+        self._previousFingerprints = self._read()
+        self._fingerprints = {}
+
+    def _read(self):
+        result = {}
+        try:
+            with open(self.storePath, 'rb') as storeFile:
+                if storeFile.read(len(FingerprintStore._Magic)) != FingerprintStore._Magic:
+                    raise XscError(u'cannot read fingerprint store "%s" because it has an unknown format' % self.storePath)
+                storedKeyColumns, storedFingerprints = marshal.load(storeFile)
+        except EnvironmentError, error:
+            if error.errno != errno.ENOENT:
+                raise
+            _log.info(u'write all rows because fingerprint store "%s" does not exist yet', self.storePath)
+        except (EOFError, ValueError, TypeError), error:
+            raise XscError(u'cannot read fingerprint store "%s": %s' % (self.storePath, error))
+        else:
+            for sourceName, keyColumn in self.sourceNameToKeyColumnMap.items():
+                storedKeyColumn = storedKeyColumns.get(sourceName)
+                if storedKeyColumn == keyColumn:
+                    result[sourceName] = storedFingerprints[sourceName]
+                elif storedKeyColumn is None:
+                    _log.info(u'write all rows of %r because it has no fingerprints yet', sourceName)
+                else:
+                    _log.warning(u'write all rows of %r because its key column changed from %r to %r',
+                        sourceName, storedKeyColumn, keyColumn)
+        return result
+
+    def rows(self, source, rows):
+        """
+        Iterator over those ``rows`` of ``source`` that are new or changed since the previous
+        conversion, remembering the fingerprints of all of them. If ``source`` has no key
+        column, all ``rows`` are passed.
+        """
+        assert source is not None
+        assert rows is not None
+        keyColumn = self.sourceNameToKeyColumnMap.get(source.name)
+        if keyColumn is not None:
+            result = self._changedRows(source, keyColumn, rows)
+        else:
+            result = rows
+        return result
+
+    def _changedRows(self, source, keyColumn, rows):
+        fieldNames = list(source.interface.fieldNames)
+        if keyColumn not in fieldNames:
+            raise XscValueError(u'delta key column of %r is %r but must be one of: %s' % (source.name, keyColumn, fieldNames))
+        keyColumnIndex = fieldNames.index(keyColumn)
+        previousFingerprints = self._previousFingerprints.get(source.name, {})
+        fingerprints = self._fingerprints.setdefault(source.name, {})
+        fingerprintSize = FingerprintStore._FingerprintSize
+        rowCount = 0
+        changedRowCount = 0
+        for row in rows:
+            key = row[keyColumnIndex]
+            fingerprint = hashlib.sha1(u'\0'.join(value or u'' for value in row).encode('utf-8')).digest()[:fingerprintSize]
+            fingerprints[key] = fingerprint
+            rowCount += 1
+            if previousFingerprints.get(key) != fingerprint:
+                changedRowCount += 1
+                yield row
+        _log.info(u'found %d new or changed of %d rows in %r', changedRowCount, rowCount, source.name)
+
+    def deletedKeys(self):
+        """
+        Map of names of compared data sources to sorted lists of keys of rows found by the
+        previous conversion but not since.
+        """
+        return dict(
+            (sourceName, sorted(set(previousFingerprints) - set(self._fingerprints[sourceName])))
+            for sourceName, previousFingerprints in self._previousFingerprints.items()
+            if sourceName in self._fingerprints
+        )
+
+    def save(self):
+        """
+        Store the fingerprints of the rows compared so far in ``storePath``, keeping the
+        previous ones of data sources that have not been compared.
+        """
+        storedFingerprints = dict(self._previousFingerprints)
+        storedFingerprints.update(self._fingerprints)
+        _log.info(u'write fingerprint store "%s"', self.storePath)
+        _writeAtomically(self.storePath, [
+            FingerprintStore._Magic, marshal.dumps((self.sourceNameToKeyColumnMap, storedFingerprints))
+        ])
+
+    def writeDeletedKeysJson(self, targetJsonFilePath):
+        """
+        Write `deletedKeys()` to ``targetJsonFilePath`` as JSON document.
+        """
+        assert targetJsonFilePath is not None
+        with open(targetJsonFilePath, 'wb') as targetJsonFile:
+            json.dump(self.deletedKeys(), targetJsonFile, indent=2, sort_keys=True)
+
+class _DictionaryColumn(object):
+    """
+    Column values stored as codes referring to a list of distinct values. This is compact
+    for columns with only a few distinct values, for example type codes.
+    """
+    # Array type codes to use for codes depending on the number of distinct values. The last
+    # one has no limit: with Python 2's array, 'l' is the largest integer type, which holds
+    # any number of values fitting into memory on 64 bit platforms.
+    _CodeTypes = (('B', 1 << 8), ('H', 1 << 16), ('i', 1 << 31), ('l', None))
+
+    def __init__(self):
+        self.values = []
+        self._valueToCodeMap = {}
+        self._codeTypeIndex = 0
+        self._codes = array.array(_DictionaryColumn._CodeTypes[0][0])
+
+    def append(self, value):
+        code = self._valueToCodeMap.get(value)
+        if code is None:
+            code = len(self.values)
+            if code == _DictionaryColumn._CodeTypes[self._codeTypeIndex][1]:
+                self._codeTypeIndex += 1
+                self._codes = array.array(_DictionaryColumn._CodeTypes[self._codeTypeIndex][0], self._codes)
+            self.values.append(value)
+            self._valueToCodeMap[value] = code
+        self._codes.append(code)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, rowIndex):
+        return self.values[self._codes[rowIndex]]
+
+    def __getstate__(self):
+        # Store codes as string, which is much more compact than a pickled array.
+        return (self.values, self._codeTypeIndex, self._codes.tostring())
+
+    def __setstate__(self, state):
+        self.values, self._codeTypeIndex, codes = state
+        self._valueToCodeMap = dict((value, code) for code, value in enumerate(self.values))
+        self._codes = array.array(_DictionaryColumn._CodeTypes[self._codeTypeIndex][0])
+        self._codes.fromstring(codes)
+
+class _PackedColumn(object):
+    """
+    Column values stored as UTF-8 in a single buffer. This is compact for columns with many
+    distinct values, for example IDs.
+    """
+    def __init__(self, values=()):
+        self._data = bytearray()
+        self._ends = array.array('L')
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        assert isinstance(value, unicode), 'value=%r' % value
+        self._data.extend(value.encode('utf-8'))
+        self._ends.append(len(self._data))
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, rowIndex):
+        end = self._ends[rowIndex]
+        start = self._ends[rowIndex - 1] if rowIndex > 0 else 0
+        return self._data[start:end].decode('utf-8')
+
+    def __getstate__(self):
+        return (self._ends.tostring(), str(self._data))
+
+    def __setstate__(self, state):
+        ends, data = state
+        self._ends = array.array('L')
+        self._ends.fromstring(ends)
+        # Keep memory mapped data as is.
+        self._data = data if isinstance(data, _MappedData) else bytearray(data)
+
+class _SkippedColumn(object):
+    """
+    Column whose values are not stored because they are not used, so all of them are ``None``.
+    """
+    def __init__(self):
+        self._rowCount = 0
+
+    def append(self, value):
+        self._rowCount += 1
+
+    def __len__(self):
+        return self._rowCount
+
+    def __getitem__(self, rowIndex):
+        return None
+
+class _RowView(object):
+    """
+    A row of `_ColumnarRows` that decodes values only when accessed.
+    """
+    __slots__ = ('_columns', '_rowIndex')
+
+    def __init__(self, columns, rowIndex):
+        self._columns = columns
+        self._rowIndex = rowIndex
+
+    def __getitem__(self, columnIndex):
+        return self._columns[columnIndex][self._rowIndex]
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __iter__(self):
+        rowIndex = self._rowIndex
+        for column in self._columns:
+            yield column[rowIndex]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class _ColumnarRows(object):
+    """
+    Rows stored column by column. Initially all columns are dictionary encoded; columns
+    turning out to have many distinct values are packed instead. Values of the columns with
+    indices in ``skippedColumnIndices`` are not stored at all and read as ``None``.
+    """
+    # Number of rows after which to check which columns should be packed.
+    _CheckInterval = 1024
+
+    def __init__(self, columnCount, skippedColumnIndices=()):
+        assert columnCount >= 0
+        self._columns = [
+            _SkippedColumn() if columnIndex in skippedColumnIndices else _DictionaryColumn()
+            for columnIndex in range(columnCount)
+        ]
+        self._rowCount = 0
+
+    def append(self, row):
+        assert len(row) == len(self._columns), 'row=%r' % row
+        for column, value in itertools.izip(self._columns, row):
+            column.append(value)
+        self._rowCount += 1
+        if not (self._rowCount % _ColumnarRows._CheckInterval):
+            self.packDiverseColumns()
+
+    def packDiverseColumns(self):
+        """
+        Convert dictionary encoded columns where more than half of the values are distinct
+        to packed columns.
+        """
+        for columnIndex, column in enumerate(self._columns):
+            if isinstance(column, _DictionaryColumn) and (2 * len(column.values) > self._rowCount):
+                if all(isinstance(value, unicode) for value in column.values):
+                    self._columns[columnIndex] = _PackedColumn(column)
+
+    def __len__(self):
+        return self._rowCount
+
+    def __getitem__(self, rowIndex):
+        if rowIndex < 0:
+            rowIndex += self._rowCount
+        if not (0 <= rowIndex < self._rowCount):
+            raise IndexError('row index out of range: %d' % rowIndex)
+        return _RowView(self._columns, rowIndex)
+
+    def __iter__(self):
+        columns = self._columns
+        for rowIndex in xrange(self._rowCount):
+            yield _RowView(columns, rowIndex)
+
+def _interfaceFingerprint(interface):
+    """
+    Hash of everything in ``interface`` that affects which rows are valid and how they are
+    read, no matter whether it was read from a CID or sniffed.
+    """
+    assert interface is not None
+    icdRows = list(interface.dataFormat.asIcdRows())
+    for fieldName in interface.fieldNames:
+        icdRows.append(interface.getFieldFormat(fieldName).asIcdRow())
+    for checkName in interface.checkNames:
+        check = interface.getCheck(checkName)
+        icdRows.append([u'c', checkName, check.__class__.__name__, check.rule])
+    return hashlib.sha1(repr(icdRows)).hexdigest()
+
+# Compressions of data files as tuples of (name, regular expression matching the bytes at
+# the start of the file). For bzip2, the magic 'BZh' is followed by a block size from 1 to 9
+# and the magic of either the first block or, for empty data, the end of the stream, so
+# that plain data starting with 'BZh' are not taken for compressed ones.
+_DataCompressionMagicLength = 10
+_DataCompressions = (
+    (CompressionGzip, re.compile(r'\x1f\x8b')),
+    (CompressionBzip2, re.compile(r'BZh[1-9](1AY&SY|\x17rE8P\x90)')),
+    (CompressionXz, re.compile(r'\xfd7zXZ\x00')),
+)
+
+def _dataCompression(dataFilePath):
+    """
+    Name of the compression used by ``dataFilePath`` according to its first bytes or
+    ``None`` if the data are not compressed.
+    """
+    assert dataFilePath is not None
+    with open(dataFilePath, 'rb') as dataFile:
+        magic = dataFile.read(_DataCompressionMagicLength)
+    result = None
+    for compression, compressionMagicRegex in _DataCompressions:
+        if compressionMagicRegex.match(magic):
+            result = compression
+            break
+    return result
+
+def _openData(dataFilePath):
+    """
+    File object to read the data in ``dataFilePath`` from, which is decompressed while
+    reading if it is compressed using gzip, bzip2 or xz. For xz, the ``lzma`` module of
+    Python 3.3 or the ``backports.lzma`` package must be installed.
+    """
+    assert dataFilePath is not None
+    compression = _dataCompression(dataFilePath)
+    if compression is None:
+        result = open(dataFilePath, 'rb')
+    else:
+        _log.debug(u'decompress %s data "%s"', compression, dataFilePath)
+        if compression == CompressionBzip2:
+            # Unlike the others, this is implemented in C and already buffered.
+            result = bz2.BZ2File(dataFilePath, 'rb', _DataCache.BlockSize)
+        else:
+            if compression == CompressionGzip:
+                compressedFile = gzip.GzipFile(dataFilePath, 'rb')
+            elif compression == CompressionXz:
+                if lzma is None:
+                    raise XscError(
+                        u'cannot read xz compressed data "%s" unless Python package backports.lzma is installed'
+                        % dataFilePath
+                    )
+                compressedFile = lzma.LZMAFile(dataFilePath, 'rb')
+            else:
+                assert False, 'compression=%r' % compression
+            # Buffer the decompressed data because parsers read them in small pieces.
+            result = io.BufferedReader(compressedFile, _DataCache.BlockSize)
+    return result
+
+# Suffixes of XML output files that imply a compression.
+_SuffixToCompressionMap = {
+    '.gz': CompressionGzip,
+    '.bz2': CompressionBzip2,
+    '.xz': CompressionXz,
+}
+
+def _outputCompression(targetXmlFilePath):
+    """
+    Compression to use for ``targetXmlFilePath`` according to its suffix.
+    """
+    assert targetXmlFilePath is not None
+    suffix = os.path.splitext(targetXmlFilePath)[1].lower()
+    return _SuffixToCompressionMap.get(suffix, CompressionNone)
+
+def _newCompressor(compression):
+    """
+    Object with ``compress(data)`` and ``flush()`` to compress output using ``compression``
+    or ``None`` for `CompressionNone`.
+    """
+    assert compression in _Compressions, 'compression=%r' % compression
+    if compression == CompressionNone:
+        result = None
+    elif compression == CompressionGzip:
+        # Use the default level of the gzip command, which is a lot faster than 9 but compresses
+        # almost as well. The window bits 16 + 15 result in a gzip header and trailer.
+        result = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == CompressionBzip2:
+        result = bz2.BZ2Compressor()
+    elif compression == CompressionXz:
+        if lzma is None:
+            raise XscError(u'cannot write xz compressed output unless Python package backports.lzma is installed')
+        result = lzma.LZMACompressor()
+    else:
+        assert False, 'compression=%r' % compression
+    return result
+
+class _XmlOutput(object):
+    """
+    Output for the XML document, which is either a file to create at a path or an open file
+    like object such as ``sys.stdout`` that remains open. Data are compressed while writing
+    if ``compression`` is not `CompressionNone`. By default, files are compressed according
+    to their suffix and file like objects are not compressed. ``byteCount`` is the number of
+    bytes written so far before compressing them.
+    """
+    def __init__(self, target, compression=None):
+        assert target is not None
+        assert compression in _Compressions + (None,), 'compression=%r' % compression
+        if isinstance(target, basestring):
+            if compression is None:
+                compression = _outputCompression(target)
+            self._compressor = _newCompressor(compression)
+            self._file = open(target, 'wb', _DataCache.BlockSize)
+            self._isFileToClose = True
+        else:
+            self._compressor = _newCompressor(compression or CompressionNone)
+            self._file = target
+            self._isFileToClose = False
+        self.byteCount = 0
+        # The native XML writer writes in large blocks, so counting them costs next to nothing.
+        if self._compressor is None:
+            self.write = self._uncompressedWrite
+        else:
+            self.write = self._compressedWrite
+
+    def _uncompressedWrite(self, data):
+        self.byteCount += len(data)
+        self._file.write(data)
+
+    def _compressedWrite(self, data):
+        self.byteCount += len(data)
+        compressedData = self._compressor.compress(data)
+        if compressedData:
+            self._file.write(compressedData)
+
+    def close(self):
+        try:
+            if self._compressor is not None:
+                self._file.write(self._compressor.flush())
+            self._file.flush()
+        finally:
+            if self._isFileToClose:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, errorType, error, traceback):
+        self.close()
+
+def _fileContentHash(filePath):
+    assert filePath is not None
+    result = hashlib.sha1()
+    with open(filePath, 'rb') as fileToHash:
+        data = fileToHash.read(_DataCache.BlockSize)
+        while data:
+            result.update(data)
+            data = fileToHash.read(_DataCache.BlockSize)
+    return result.hexdigest()
+
+def _fileKey(filePath):
+    """
+    Key for ``filePath`` that changes when the file is modified.
+    """
+    assert filePath is not None
+    fileStatus = os.stat(filePath)
+    return (os.path.abspath(filePath), fileStatus.st_size, fileStatus.st_mtime)
+
+def _templateKey(xscFilePath):
+    """
+    Key for the template in ``xscFilePath`` that changes when the file is modified or a
+    different version of xsc or Python reads it.
+    """
+    return _fileKey(xscFilePath) + (_fileContentHash(xscFilePath), __version__, imp.get_magic())
+
+def _marshaledCode(value):
+    """
+    ``value`` stored using ``marshal`` if it is a Python code object, which ``pickle`` cannot
+    store, otherwise ``None``.
+    """
+    return marshal.dumps(value) if isinstance(value, types.CodeType) else None
+
+def _writeAtomically(targetPath, parts):
+    """
+    Write ``parts`` to ``targetPath`` so other processes never read a partially written file.
+    """
+    assert targetPath is not None
+    assert parts is not None
+    targetFileHandle, temporaryPath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(targetPath)))
+    try:
+        with os.fdopen(targetFileHandle, 'wb') as targetFile:
+            for part in parts:
+                targetFile.write(part)
+        if os.name == 'nt': # pragma: no cover
+            if os.path.exists(targetPath):
+                os.remove(targetPath)
+        os.rename(temporaryPath, targetPath)
+    except:
+        os.remove(temporaryPath)
+        raise
+
+class _DataCache(object):
+    """
+    Folder with validated rows of data files so they can be loaded without validating them
+    again, and with interfaces sniffed from data files so they need not be sniffed again.
+
+    A rows file holds the `_ColumnarRows` of a data file and is found using a key derived from
+    size, modification time and content of the data file as well as the interface used to
+    validate it. It starts with `_Magic`, followed by the size of a header and the header
+    itself stored using ``marshal``, followed by the binary data of the columns at offsets
+    relative to the end of the header. Packed columns are memory mapped instead of being read,
+    skipped columns take no space at all.
+
+    A CID file holds the rows describing a sniffed interface stored using ``marshal``.
+
+    A template file holds the state of a parsed and compiled `XscTemplate` stored using
+    ``pickle``, where Python code objects of compiled expressions are stored using ``marshal``.
+    """
+    _Magic = 'xsc rows 1\n'
+    _TemplateMagic = 'xsc template 5\n'
+    _HeaderSizeFormat = '<Q'
+    BlockSize = 1024 * 1024
+
+    def __init__(self, folderPath):
+        assert folderPath is not None
+        self.folderPath = folderPath
+        try:
+            os.makedirs(folderPath)
+        except OSError, error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    def rowsKey(self, dataFilePath, interface, rowCondition=None, usedColumnNames=None):
+        """
+        Key to look up the rows of ``dataFilePath`` validated with ``interface``, possibly only
+        those fulfilling ``rowCondition`` and only the columns in ``usedColumnNames``.
+        """
+        assert dataFilePath is not None
+        assert interface is not None
+        dataFileStatus = os.stat(dataFilePath)
+        result = (
+            dataFileStatus.st_size, dataFileStatus.st_mtime, _fileContentHash(dataFilePath),
+            _interfaceFingerprint(interface), sys.byteorder, array.array('L').itemsize
+        )
+        if rowCondition is not None:
+            result += (rowCondition.strip(),)
+        if usedColumnNames is not None:
+            result += (tuple(sorted(usedColumnNames)),)
+        return result
+
+    def _cachePath(self, key, suffix='.rows'):
+        assert key is not None
+        return os.path.join(self.folderPath, hashlib.sha1(repr(key)).hexdigest() + suffix)
+
+    def cidRows(self, key):
+        """
+        The rows describing the interface stored for ``key`` or ``None`` if there are none.
+        """
+        assert key is not None
+        result = None
+        cachePath = self._cachePath(key, '.cid')
+        try:
+            with open(cachePath, 'rb') as cacheFile:
+                storedKey, cidRows = marshal.load(cacheFile)
+            if storedKey == key:
+                result = cidRows
+            else:
+                _log.warning(u'ignored cache file with different key: "%s"', cachePath)
+        except EnvironmentError, error:
+            if error.errno != errno.ENOENT:
+                _log.warning(u'ignored broken cache file "%s": %s', cachePath, error)
+        except (EOFError, ValueError, TypeError), error:
+            _log.warning(u'ignored broken cache file "%s": %s', cachePath, error)
+        return result
+
+    def storeCidRows(self, key, cidRows):
+        """
+        Store ``cidRows`` so `cidRows()` can find them using ``key``.
+        """
+        assert key is not None
+        assert cidRows is not None
+        _writeAtomically(self._cachePath(key, '.cid'), [marshal.dumps((key, cidRows))])
+
+    def templateKey(self, xscFilePath):
+        """
+        Key to look up the state of the template read from ``xscFilePath``.
+        """
+        return _templateKey(xscFilePath)
+
+    def templateState(self, key):
+        """
+        The state of the `XscTemplate` stored for ``key`` or ``None`` if there is none.
+        """
+        assert key is not None
+        result = None
+        cachePath = self._cachePath(key, '.xsct')
+        try:
+            with open(cachePath, 'rb') as cacheFile:
+                if cacheFile.read(len(_DataCache._TemplateMagic)) == _DataCache._TemplateMagic:
+                    unpickler = cPickle.Unpickler(cacheFile)
+                    unpickler.persistent_load = marshal.loads
+                    storedKey, state = unpickler.load()
+                    if storedKey == key:
+                        result = state
+                    else:
+                        _log.warning(u'ignored cache file with different key: "%s"', cachePath)
+                else:
+                    _log.warning(u'ignored cache file with unknown format: "%s"', cachePath)
+        except EnvironmentError, error:
+            if error.errno != errno.ENOENT:
+                _log.warning(u'ignored broken cache file "%s": %s', cachePath, error)
+        except (EOFError, ValueError, TypeError, AttributeError, ImportError, IndexError, cPickle.UnpicklingError), error:
+            _log.warning(u'ignored broken cache file "%s": %s', cachePath, error)
+        return result
+
+    def storeTemplateState(self, key, state):
+        """
+        Store the ``state`` of an `XscTemplate` so `templateState()` can find it using ``key``.
+        """
+        assert key is not None
+        assert state is not None
+        pickledState = StringIO.StringIO()
+        pickler = cPickle.Pickler(pickledState, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = _marshaledCode
+        pickler.dump((key, state))
+        cachePath = self._cachePath(key, '.xsct')
+        _writeAtomically(cachePath, [_DataCache._TemplateMagic, pickledState.getvalue()])
+        _log.info(u'stored compiled template in cache "%s"', cachePath)
+
+    def rows(self, key):
+        """
+        The `_ColumnarRows` stored for ``key`` or ``None`` if there are none.
+        """
+        assert key is not None
+        result = None
+        cachePath = self._cachePath(key)
+        try:
+            with open(cachePath, 'rb') as cacheFile:
+                if cacheFile.read(len(_DataCache._Magic)) == _DataCache._Magic:
+                    headerSizeSize = struct.calcsize(_DataCache._HeaderSizeFormat)
+                    headerSize = struct.unpack(_DataCache._HeaderSizeFormat, cacheFile.read(headerSizeSize))[0]
+                    header = marshal.loads(cacheFile.read(headerSize))
+                    if header['key'] == key:
+                        # Map the file only once it is known to match, so nothing remains mapped otherwise.
+                        binaryStart = cacheFile.tell()
+                        cacheData = mmap.mmap(cacheFile.fileno(), 0, access=mmap.ACCESS_READ)
+                        try:
+                            result = self._loadedRows(header, cacheData, binaryStart)
+                        finally:
+                            # Only packed columns keep referring to the mapped data.
+                            if (result is None) or not any(isinstance(column, _PackedColumn) for column in result._columns):
+                                cacheData.close()
+                    else:
+                        _log.warning(u'ignored cache file with different key: "%s"', cachePath)
+                else:
+                    _log.warning(u'ignored cache file with unknown format: "%s"', cachePath)
+        except EnvironmentError, error:
+            if error.errno != errno.ENOENT:
+                _log.warning(u'ignored broken cache file "%s": %s', cachePath, error)
+        except (EOFError, ValueError, struct.error), error:
+            _log.warning(u'ignored broken cache file "%s": %s', cachePath, error)
+        return result
+
+    def _loadedRows(self, header, cacheData, binaryStart):
+        result = _ColumnarRows(0)
+        result._rowCount = header['rowCount']
+        for columnDescription in header['columns']:
+            if columnDescription[0] == 'd':
+                _, values, codeTypeIndex, codesStart, codesEnd = columnDescription
+                column = _DictionaryColumn()
+                column.__setstate__((values, codeTypeIndex, cacheData[binaryStart + codesStart:binaryStart + codesEnd]))
+            elif columnDescription[0] == 's':
+                column = _SkippedColumn()
+                column._rowCount = result._rowCount
+            else:
+                assert columnDescription[0] == 'p', 'columnDescription=%r' % columnDescription
+                _, endsStart, endsEnd, dataStart, dataEnd = columnDescription
+                column = _PackedColumn()
+                column.__setstate__((
+                    cacheData[binaryStart + endsStart:binaryStart + endsEnd],
+                    _MappedData(cacheData, binaryStart + dataStart, binaryStart + dataEnd)
+                ))
+            result._columns.append(column)
+        return result
+
+    def storeRows(self, key, rows):
+        """
+        Store ``rows`` so `rows()` can find them using ``key``.
+        """
+        assert key is not None
+        assert rows is not None
+        columnDescriptions = []
+        binaryParts = []
+        binarySize = [0]
+        def addBinaryPart(data):
+            start = binarySize[0]
+            binaryParts.append(data)
+            binarySize[0] += len(data)
+            return start, binarySize[0]
+        for column in rows._columns:
+            if isinstance(column, _DictionaryColumn):
+                codesStart, codesEnd = addBinaryPart(column._codes.tostring())
+                columnDescriptions.append(['d', column.values, column._codeTypeIndex, codesStart, codesEnd])
+            elif isinstance(column, _SkippedColumn):
+                columnDescriptions.append(['s'])
+            else:
+                assert isinstance(column, _PackedColumn)
+                endsStart, endsEnd = addBinaryPart(column._ends.tostring())
+                dataStart, dataEnd = addBinaryPart(str(column._data))
+                columnDescriptions.append(['p', endsStart, endsEnd, dataStart, dataEnd])
+        header = marshal.dumps({'key': key, 'rowCount': len(rows), 'columns': columnDescriptions})
+
+        cachePath = self._cachePath(key)
+        _writeAtomically(cachePath, [
+            _DataCache._Magic, struct.pack(_DataCache._HeaderSizeFormat, len(header)), header
+        ] + binaryParts)
+        _log.info(u'stored %d rows in cache "%s"', len(rows), cachePath)
+
+class _MappedData(object):
+    """
+    Part of a memory mapped file that can be sliced like the ``bytearray`` of a `_PackedColumn`.
+    """
+    def __init__(self, data, start, end):
+        assert data is not None
+        assert 0 <= start <= end
+        self._data = data
+        self._start = start
+        self._end = end
+
+    def __getitem__(self, sliceToGet):
+        assert isinstance(sliceToGet, slice)
+        assert sliceToGet.step is None
+        return self._data[self._start + sliceToGet.start:self._start + sliceToGet.stop]
 
-    def _createXscProcessingNode(self, domProcessingNode):
-        assert domProcessingNode
-
-    def _processNode(self, domNode):
-        assert domNode
-        for node in domNode.childNodes:
-            _log.debug(u'process dom node: %s', node)
-            nodeType = node.nodeType
-            indent = '  ' * 2 * len(self._xscStack)
-            if nodeType == Node.ELEMENT_NODE:
-                tagName = node.tagName
-                attributes = node.attributes.items()
-                _log.debug(u'%sadd tag: %s; %s', indent, tagName, attributes)
-                elementNode = ElementNode(tagName, attributes)
-                self._addChild(elementNode)
-                self._pushXscNode(elementNode)
-                self._processNode(node)
-                self._popXscNode()
-            elif nodeType == Node.TEXT_NODE:
-                _log.debug(u'%sadd text: %r' , indent, node.data)
-                self._addChild(TextNode(node.data))
-            elif nodeType == Node.COMMENT_NODE:
-                _log.debug(u'%sadd comment: %r' , indent, node.data)
-                self._addChild(CommentNode(node.data))
-            elif nodeType == Node.PROCESSING_INSTRUCTION_NODE:
-                target = node.target
-                data = node.data
-                if target == 'xsc':
-                    # TODO: Use Python tokenizer to split and syntax check xsc processing instructions.
-                    words = data.strip().split()
-                    if not words:
-                        raise XscSyntaxError('xsc command must be specified')
-                    command = words[0]
-                    wordCount = len(words)
-                    if command == 'for':
-                        if wordCount != 2:
-                            raise XscSyntaxError(u'for command must match <?xsc for {rider}?> but is: %s' % data)
-                        rider = words[1]
-                        xscForNode = XscForNode(rider)
-                        _log.debug(u'%sadd xsc command: %s %s', indent, command, rider)
-                        self._addChild(xscForNode)
-                        self._pushCommand(xscForNode)
-                    elif command == 'end':
-                        if wordCount == 1:
-                            raise XscInlineSyntaxError(u'xsc command to end must be specified')
-                        if wordCount > 2:
-                            raise XscInlineSyntaxError(u'text after xsc command to end must be removed: %r' % words[2:])
-                        commandToEnd = words[1]
-                        _log.debug(u'%send xsc command: %s', indent, commandToEnd)
-                        self._popCommand(commandToEnd)
-                    elif command == 'if':
-                        if wordCount < 2:
-                            raise XscSyntaxError(u'if command must match <?xsc if {condition}?> but is: %s' % data)
-                        # TODO: Remove check below once Python tokenizer is used to parse xsc processing instructions.
-                        if not data.startswith('if'):
-                            raise NotImplementedError("cannot process white space before 'if'")
-                        condition = data[2:]
-                        xscIfNode = XscIfNode(condition)
-                        _log.debug(u'%sadd xsc command: %s %s', indent, command, condition)
-                        self._addChild(xscIfNode)
-                        self._pushCommand(xscIfNode)
-                    elif command == 'import':
-                        # TODO: Use python tokenizer to validate that module name is a Python name.
-                        # TODO: Add 'import x as y' syntax.
-                        if wordCount == 1:
-                            raise XscInlineSyntaxError(u'Python module to import must be specified')
-                        if wordCount > 2:
-                            raise XscInlineSyntaxError(u'text after Python module to import must be removed: %r' % words[2:])
-                        moduleToImport = words[1]
-                        try:
-                            _log.info('import %s', moduleToImport)
-                            globals()[moduleToImport] = __import__(moduleToImport)
-                        except Exception, error:
-                            raise XscError(u'cannot xsc import module %r: %s' % (moduleToImport, error))
-                    elif command == 'python':
-                        code = data[len('python'):]
-                        cmxPythonNode = XscPythonNode(code)
-                        _log.debug(u'%sadd xsc command: %s %s', indent, command, code)
-                        self._addChild(cmxPythonNode)
-                    elif command == '#':
-                        # Ignore xsc comment.
-                        pass
-                    else:
-                        raise XscSyntaxError(u'cannot process unknown xsc command: <?xsc %s ...?>' % target)
-                else:
-                    raise NotImplementedError(u'processing instructions for target %r must be removed because currently only <?xsc ...?> is implemented' % target)
-            else:
-                raise NotImplementedError(u'nodeType=%r' % nodeType)
+    def __len__(self):
+        return self._end - self._start
+
+    def __str__(self):
+        return self._data[self._start:self._end]
 
 class DataSource(object):
     """
@@ -484,17 +3332,256 @@ class DataSource(object):
         self.interface = None
         self.dataFilePath = None
         self.data = None
+        self.isStreamed = False
+        self.rowCount = None
         self._instructionStack = []
+        self._hasBeenStreamed = False
+        self._columnNameToIndexMap = {}
+        self._dataCache = None
+        self._dataCacheKey = None
+        self.rowCondition = None
+        self.usedColumnNames = None
 
     def setInterface(self, interface):
         self.interface = interface
 
-    def setData(self, dataFilePath):
-        with open(dataFilePath, 'rb') as dataFile:
-            self.dataFilePath = dataFile
-            self.data = []
-            for row in cutplace.interface.validatedRows(self.interface, dataFile):
-                self.data.append(row)
+    def setUsedColumnNames(self, columnNames):
+        """
+        Store only the values of the columns named in ``columnNames`` while reading data, while
+        the values of other columns are ``None``. Use ``None`` to store all columns.
+        """
+        self.usedColumnNames = frozenset(columnNames) if columnNames is not None else None
+
+    def _skippedColumnIndices(self):
+        """
+        Set of the indices of the columns that are not in `usedColumnNames`.
+        """
+        if self.usedColumnNames is None:
+            result = frozenset()
+        else:
+            result = frozenset(
+                columnIndex for columnIndex, fieldName in enumerate(self.interface.fieldNames)
+                if fieldName not in self.usedColumnNames
+            )
+        return result
+
+    def setRowCondition(self, condition):
+        """
+        Skip rows that do not fulfill the Python expression ``condition`` while reading data,
+        where the name of the data source refers to the current row. Use ``None`` to keep all
+        rows.
+        """
+        self.rowCondition = condition
+
+    def _validatedRows(self, dataFile):
+        result = cutplace.interface.validatedRows(self.interface, dataFile)
+        if self.rowCondition is not None:
+            result = self._rowsFulfillingCondition(result)
+        if self._skippedColumnIndices():
+            result = self._projectedRows(result)
+        return result
+
+    def _projectedRows(self, rows):
+        # Build new rows with the used values so the skipped ones can be released right away.
+        columnCount = len(self.interface.fieldNames)
+        skippedColumnIndices = self._skippedColumnIndices()
+        usedColumnIndices = [columnIndex for columnIndex in range(columnCount) if columnIndex not in skippedColumnIndices]
+        for row in rows:
+            projectedRow = [None] * columnCount
+            for columnIndex in usedColumnIndices:
+                projectedRow[columnIndex] = row[columnIndex]
+            yield projectedRow
+
+    def _rowsFulfillingCondition(self, rows):
+        compiledCondition = _compiledExpression(self.rowCondition)
+        variables = _variablesClass(self.interface.fieldNames)()
+        namespace = {'__builtins__': __builtins__, '_xscVariables': variables, self.name: variables}
+        skippedRowCount = 0
+        for row in rows:
+            variables._values = row
+            try:
+                isFulfilled = eval(compiledCondition, namespace)
+            except Exception, error:
+                raise _expressionError(self.rowCondition, error, namespace)
+            if isFulfilled:
+                yield row
+            else:
+                skippedRowCount += 1
+        _log.info(u'skipped %d rows of data source %r not fulfilling: %s', skippedRowCount, self.name, self.rowCondition.strip())
+
+    def setData(self, dataFilePath, isStreamed=False, dataCache=None):
+        """
+        Read and validate data from ``dataFilePath``. If ``isStreamed`` is ``True``, rows
+        are read and validated only once `rows()` is iterated, without storing them in
+        ``self.data``. This keeps memory usage constant but allows only a single pass.
+
+        If ``dataCache`` is a `_DataCache`, rows validated by a previous run are loaded from it
+        even if ``isStreamed`` is ``True``. Otherwise the validated rows are stored in it
+        unless they are streamed, which would require to hold all of them in memory.
+
+        With a `rowCondition`, only rows fulfilling it are kept, and cached separately from
+        all rows. The same applies to the columns in `usedColumnNames`.
+        """
+        self.dataFilePath = dataFilePath
+        self.isStreamed = isStreamed
+        self._hasBeenStreamed = False
+        self._columnNameToIndexMap = {}
+        self._dataCache = dataCache
+        if dataCache is not None:
+            self._dataCacheKey = dataCache.rowsKey(
+                dataFilePath, self.interface, self.rowCondition, self.usedColumnNames
+            )
+            cachedRows = dataCache.rows(self._dataCacheKey)
+        else:
+            self._dataCacheKey = None
+            cachedRows = None
+        if cachedRows is not None:
+            _log.info(u'read %d validated rows of data source %r from cache', len(cachedRows), self.name)
+            self.isStreamed = False
+            self.data = cachedRows
+            self.rowCount = len(self.data)
+        elif isStreamed:
+            self.data = None
+            self.rowCount = None
+        else:
+            with _openData(dataFilePath) as dataFile:
+                self.data = _ColumnarRows(len(self.interface.fieldNames), self._skippedColumnIndices())
+                for row in self._validatedRows(dataFile):
+                    self.data.append(row)
+                self.data.packDiverseColumns()
+            self.rowCount = len(self.data)
+            self._storeInRowCache(self.data)
+
+    def _storeInRowCache(self, rows):
+        assert rows is not None
+        if self._dataCache is not None:
+            try:
+                # Skip data files that changed while reading them.
+                dataFileStatus = os.stat(self.dataFilePath)
+                if (dataFileStatus.st_size, dataFileStatus.st_mtime) == self._dataCacheKey[:2]:
+                    self._dataCache.storeRows(self._dataCacheKey, rows)
+            except EnvironmentError, error:
+                _log.warning(u'cannot store rows of data source %r in cache: %s', self.name, error)
+
+    def setRows(self, rows):
+        """
+        Use ``rows`` that already are in memory as data.
+        """
+        assert rows is not None
+        self.dataFilePath = None
+        self.isStreamed = False
+        self._hasBeenStreamed = False
+        self._columnNameToIndexMap = {}
+        self.data = rows
+        self.rowCount = len(rows)
+
+    def rows(self):
+        """
+        Iterator over all rows of the data source.
+        """
+        if self.isStreamed:
+            if self._hasBeenStreamed:
+                raise XscError(u'data source %r is streamed and can be read only once' % self.name)
+            self._hasBeenStreamed = True
+            result = self._streamedRows()
+        else:
+            result = iter(self.data)
+        return result
+
+    def rewind(self):
+        """
+        Allow `rows()` of a streamed data source to be iterated once more, reading the data
+        file again from its start.
+        """
+        self._hasBeenStreamed = False
+
+    def index(self, columnName):
+        """
+        Map of values in column ``columnName`` to the indices of rows having this value,
+        which is built on first access.
+        """
+        assert columnName
+        result = self._columnNameToIndexMap.get(columnName)
+        if result is None:
+            if self.isStreamed:
+                raise XscError(u'data source %r is streamed and cannot be indexed' % self.name)
+            columnIndex = self._columnIndex(columnName)
+            _log.info(u'build index on column "%s" of data source %r', columnName, self.name)
+            result = {}
+            for rowIndex, row in enumerate(self.data):
+                key = row[columnIndex]
+                rowIndicesForKey = result.get(key)
+                if rowIndicesForKey is None:
+                    result[key] = array.array('L', (rowIndex,))
+                else:
+                    rowIndicesForKey.append(rowIndex)
+            self._columnNameToIndexMap[columnName] = result
+        return result
+
+    def _columnIndex(self, columnName):
+        assert columnName
+        try:
+            result = self.interface.fieldNames.index(columnName)
+        except ValueError:
+            raise XscValueError(u'cannot find column "%s" in data source %r, available columns are: %s' % (
+                columnName, self.name, u', '.join(self.interface.fieldNames))
+            )
+        return result
+
+    def groups(self, columnName):
+        """
+        Iterator over data sources each holding the consecutive rows that have the same value
+        in column ``columnName``. The rows must be sorted by this column, or at least rows with
+        the same value must be next to each other. Only the rows of the current group are held
+        in memory. To detect a value showing up again after other values, the values of all
+        groups so far are remembered too, so memory also grows with the number of groups.
+        """
+        columnIndex = self._columnIndex(columnName)
+        completedKeys = set()
+        groupKey = None
+        groupRows = []
+        for rowNumber, row in enumerate(self.rows(), 1):
+            key = row[columnIndex]
+            if groupRows and (key != groupKey):
+                completedKeys.add(groupKey)
+                yield self._groupSource(groupRows)
+                groupRows = []
+            if not groupRows:
+                if key in completedKeys:
+                    raise XscValueError(
+                        u'data source %r must be sorted by column "%s" but value %r in data row %d already showed up before'
+                        % (self.name, columnName, key, rowNumber)
+                    )
+                groupKey = key
+            groupRows.append(row)
+        if groupRows:
+            yield self._groupSource(groupRows)
+
+    def _groupSource(self, groupRows):
+        assert groupRows
+        result = DataSource(self.name)
+        result.setInterface(self.interface)
+        result.setRows(groupRows)
+        return result
+
+    def rowsWhere(self, columnName, value):
+        """
+        Rows where column ``columnName`` has ``value``.
+        """
+        rowIndices = self.index(columnName).get(value)
+        if rowIndices is None:
+            result = ()
+        else:
+            data = self.data
+            result = [data[rowIndex] for rowIndex in rowIndices]
+        return result
+
+    def _streamedRows(self):
+        self.rowCount = 0
+        with _openData(self.dataFilePath) as dataFile:
+            for row in self._validatedRows(dataFile):
+                self.rowCount += 1
+                yield row
 
 def _checkPythonName(name, text):
     assert name
@@ -544,37 +3631,328 @@ def splitDataSourceDefintion(definition):
     result = (dataSourceName, dataSourcePath, cidPath)
     return result
 
+# Tuple of (sourceNameToSourceMap, dataCache) for `_loadedSourceData()`. Worker processes
+# inherit it when the process pool is forked.
+_loadingState = None
+
+def _loadedSourceData(name, dataFilePath):
+    """
+    Tuple ``(rows, errorMessage)`` with the rows of data source ``name`` read from
+    ``dataFilePath`` or an error message describing why they cannot be read. This runs in
+    a worker process of `Converter.setAllData()`.
+    """
+    assert _loadingState is not None
+    sourceNameToSourceMap, dataCache = _loadingState
+    source = sourceNameToSourceMap[name]
+    try:
+        source.setData(dataFilePath, dataCache=dataCache)
+        result = (source.data, None)
+    except Exception, error:
+        # Exceptions of other modules are not necessarily picklable, so only pass a message.
+        result = (None, u'cannot read data source %r from "%s": %s' % (name, dataFilePath, error))
+    return result
+
 class Converter(object):
-    def __init__(self, template):
+    def __init__(self, template, cacheFolderPath=None, statistics=None, isProjected=False, isStreamed=False):
+        """
+        Converter for ``template``. If ``cacheFolderPath`` is specified, validated rows of
+        data files are cached in this folder, so unchanged data files need not be validated
+        again. Loading and writing are measured in ``statistics``, by default a new
+        `RunStatistics`. If ``isProjected`` is ``True``, only the columns in
+        `XscTemplate.usedColumnNames` are stored, so `dataFor()` yields ``None`` for others.
+        If ``isStreamed`` is ``True``, data sources in `XscTemplate.singlePassSourceNames`
+        are streamed from their files while writing instead of being loaded, so `dataFor()`
+        yields ``None`` for them.
+        """
         assert template is not None
 
         self._template = template
+        self.isProjected = isProjected
+        self.isStreamed = isStreamed
         self._sourceNameToSourceMap = {}
         self._xml = None
+        if cacheFolderPath is not None:
+            self.dataCache = _DataCache(cacheFolderPath)
+        else:
+            self.dataCache = None
+        self.statistics = statistics if statistics is not None else RunStatistics()
 
     def setInterface(self, name, interface):
         assert name
         assert interface is not None
         source = DataSource(name)
         source.setInterface(interface)
+        source.setRowCondition(self._template.sourceConditions.get(name))
+        if self.isProjected:
+            source.setUsedColumnNames(self._template.usedColumnNames.get(name))
         self._sourceNameToSourceMap[name] = source
 
+    def useColumn(self, name, columnName):
+        """
+        Store the values of column ``columnName`` of data source ``name`` even if the template
+        does not refer to it, for example because it is a key to split output into shards.
+        This has to happen before setting the data.
+        """
+        assert columnName
+        self._validateDataName(name)
+        source = self._sourceNameToSourceMap[name]
+        if source.usedColumnNames is not None:
+            source.setUsedColumnNames(source.usedColumnNames | set([columnName]))
+
+    def _validateUsedColumn(self, name, columnName):
+        source = self._sourceNameToSourceMap[name]
+        if (source.usedColumnNames is not None) and (columnName not in source.usedColumnNames) \
+                and (columnName in source.interface.fieldNames):
+            raise XscValueError(
+                u'column "%s" of data source %r has not been stored because the template does not refer to it; '
+                u'call Converter.useColumn() before setting the data' % (columnName, name)
+            )
+
     def setData(self, name, dataFilePath):
+        """
+        Set the data file for data source ``name``. With `isStreamed` and a template reading
+        the data source only once, rows are streamed from the file while writing instead of
+        loading them first. With `isProjected`, only the columns the template refers to are stored, see
+        `XscTemplate.usedColumnNames`.
+        """
         self._validateDataName(name)
         source = self._sourceNameToSourceMap[name]
-        source.setData(dataFilePath)
+        if source.usedColumnNames is not None:
+            fieldNames = source.interface.fieldNames
+            _log.info(u'store %d of %d columns of data source %r: %s', len(source.usedColumnNames.intersection(fieldNames)),
+                len(fieldNames), name, u', '.join(fieldName for fieldName in fieldNames if fieldName in source.usedColumnNames))
+        with self.statistics.phase('load', name):
+            source.setData(dataFilePath, self._isStreamedSource(name), self.dataCache)
+
+    def _isStreamedSource(self, name):
+        return self.isStreamed and (name in self._template.singlePassSourceNames)
+
+    def setSource(self, name, loadedSource):
+        """
+        Use the data already loaded in ``loadedSource`` for data source ``name``. The data
+        can be shared with other converters because they are only read.
+        """
+        assert name
+        assert loadedSource is not None
+        assert loadedSource.data is not None, 'source must be loaded: %r' % loadedSource.name
+        source = DataSource(name)
+        source.setInterface(loadedSource.interface)
+        source.setRows(loadedSource.data)
+        self._sourceNameToSourceMap[name] = source
+
+    def setAllData(self, nameToDataFilePathMap, jobs=1):
+        """
+        Like `setData()` for each item in ``nameToDataFilePathMap``. With ``jobs`` greater
+        than 1, data sources that have to be loaded are read and validated concurrently by as
+        many processes. If any of them cannot be read, the resulting `XscError` describes the
+        errors of all of them.
+        """
+        assert nameToDataFilePathMap is not None
+        assert jobs >= 1
+        namesToLoad = []
+        for name, dataFilePath in sorted(nameToDataFilePathMap.items()):
+            if (jobs > 1) and not self._isStreamedSource(name):
+                self._validateDataName(name)
+                namesToLoad.append(name)
+            else:
+                self.setData(name, dataFilePath)
+        if len(namesToLoad) == 1:
+            self.setData(namesToLoad[0], nameToDataFilePathMap[namesToLoad[0]])
+        elif namesToLoad:
+            if hasattr(os, 'fork'):
+                self._loadConcurrently(dict((name, nameToDataFilePathMap[name]) for name in namesToLoad), jobs)
+            else:
+                _log.warning('ignored jobs=%d because processes cannot be forked on this platform', jobs)
+                for name in namesToLoad:
+                    self.setData(name, nameToDataFilePathMap[name])
+
+    def _loadConcurrently(self, nameToDataFilePathMap, jobs):
+        global _loadingState
 
-    def write(self, targetXmlFilePath):
+        processCount = min(jobs, len(nameToDataFilePathMap))
+        _log.info('read %d data sources using %d processes', len(nameToDataFilePathMap), processCount)
+        _loadingState = (self._sourceNameToSourceMap, self.dataCache)
+        try:
+            pool = multiprocessing.Pool(processCount)
+        finally:
+            _loadingState = None
+        with self.statistics.phase('load'):
+            try:
+                nameToPendingResultMap = dict(
+                    (name, pool.apply_async(_loadedSourceData, (name, dataFilePath)))
+                    for name, dataFilePath in nameToDataFilePathMap.items()
+                )
+                errorMessages = []
+                for name, pendingResult in sorted(nameToPendingResultMap.items()):
+                    rows, errorMessage = pendingResult.get()
+                    if errorMessage is None:
+                        source = self._sourceNameToSourceMap[name]
+                        source.setRows(rows)
+                        source.dataFilePath = nameToDataFilePathMap[name]
+                    else:
+                        _log.error(u'%s', errorMessage)
+                        errorMessages.append(errorMessage)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            if errorMessages:
+                raise XscError(u'cannot read %d of %d data sources: %s' % (
+                    len(errorMessages), len(nameToDataFilePathMap), u'; '.join(errorMessages)
+                ))
+
+    def source(self, name):
+        """
+        The `DataSource` for ``name``.
+        """
+        self._validateDataName(name)
+        return self._sourceNameToSourceMap[name]
+
+    def write(self, targetXmlFilePath, engine=EngineCompiled, jobs=1, writer=WriterNative, compression=None,
+            profiler=None, progressInterval=None, sharding=None, fingerprintStore=None):
+        """
+        Write the XML document resulting from the template to ``targetXmlFilePath``, which
+        can also be a file like object such as ``sys.stdout``. With ``compression``, the output
+        is compressed while writing as described in `_XmlOutput`. The
+        ``engine`` to render the template is either `EngineCompiled` or `EngineInterpreted`.
+        With ``jobs`` greater than 1, rows of loops in `XscTemplate.parallelLoops` are
+        rendered by as many processes, which results in the same output. The XML is written
+        using ``writer``, which is either `WriterNative` or the slower `WriterLoxun`; both
+        result in the same output. Streamed data sources are read again each time the output
+        is written.
+
+        If ``profiler`` is a `TemplateProfiler`, it measures each node of the template while
+        rendering it node by node in this process, no matter which ``engine`` and ``jobs`` are
+        specified.
+
+        With ``progressInterval``, the progress of loops not nested in other loops is logged
+        each time this many seconds have passed.
+
+        With a `Sharding` ``sharding``, the output is split into shards as described in
+        `_ShardedXmlWriter`, in which case ``targetXmlFilePath`` must be a path and rows are
+        rendered by a single job.
+
+        With a `FingerprintStore` ``fingerprintStore``, only rows that are new or changed since
+        the previous conversion are written for its data sources, in which case rows are
+        rendered by a single job too. Once the output is complete, the fingerprint store is
+        saved.
+        """
         assert targetXmlFilePath is not None
+        assert engine in _Engines, 'engine=%r' % engine
+        assert jobs >= 1
+        assert writer in _Writers, 'writer=%r' % writer
+        assert compression in _Compressions + (None,), 'compression=%r' % compression
+        assert (sharding is None) or isinstance(targetXmlFilePath, basestring)
 
-        _log.info('write output "%s"', targetXmlFilePath)
-        with open(targetXmlFilePath, 'wb') as targetXmlFile:
-            with loxun.XmlWriter(targetXmlFile, pretty=False, sourceEncoding='utf-8') as self._xml:
-                for xscNode in self._template.content.childNodes:
-                    xscNode.write(self._xml, self._sourceNameToSourceMap)
+        for source in self._sourceNameToSourceMap.values():
+            source.rewind()
+        aggregateValues = self._aggregateValues()
+        _log.info('write output "%s"', getattr(targetXmlFilePath, 'name', targetXmlFilePath))
+        namespace = self._template.newNamespace()
+        namespace.update(aggregateValues)
+        if progressInterval:
+            namespace['_xscProgressReporter'] = _ProgressReporter(progressInterval)
+        if fingerprintStore is not None:
+            self._validateFingerprintStore(fingerprintStore)
+            namespace['_xscFingerprintStore'] = fingerprintStore
+        sharder = None
+        if sharding is not None:
+            shardLoop = sharding.loop(self._template)
+            if sharding.keyColumn is not None:
+                self._validateUsedColumn(shardLoop.rider, sharding.keyColumn)
+            _log.info('split output into shards at rows of %r', shardLoop.rider)
+            sharder = _ShardedXmlWriter(targetXmlFilePath, compression, writer, sharding, shardLoop.outermostLoopIndex)
+            namespace['_xscSharder'] = sharder
+        parallelLoopWriter = None
+        if profiler is not None:
+            _log.info('profile template using the interpreted engine and a single job')
+        elif (jobs > 1) and self._template.parallelLoops:
+            if sharder is not None:
+                _log.info('render loops using a single job because the output is split into shards')
+            elif fingerprintStore is not None:
+                _log.info('render loops using a single job because rows are compared with fingerprints')
+            elif hasattr(os, 'fork'):
+                _log.info('render loops using %d jobs', jobs)
+                parallelLoopWriter = _ParallelLoopWriter(
+                    self._template, self._sourceNameToSourceMap, engine, writer, jobs, aggregateValues
+                )
+                namespace['_xscParallelLoopWriter'] = parallelLoopWriter
+            else:
+                _log.warning('ignored jobs=%d because processes cannot be forked on this platform', jobs)
+        try:
+            with self.statistics.phase('write'):
+                self._write(targetXmlFilePath, engine, writer, compression, profiler, namespace, sharder)
+        except:
+            if parallelLoopWriter is not None:
+                parallelLoopWriter.terminate()
+            raise
+        if parallelLoopWriter is not None:
+            parallelLoopWriter.close()
+        if fingerprintStore is not None:
+            fingerprintStore.save()
+        for source in self._sourceNameToSourceMap.values():
+            self.statistics.setSource(source)
+
+    def _aggregateValues(self):
+        """
+        Map of the names of `XscTemplate.aggregates` to their values, computed in a single pass
+        over each data source they refer to.
+        """
+        result = {}
+        sourceNameToAggregatesMap = {}
+        for aggregate in self._template.aggregates:
+            if aggregate.name in self._sourceNameToSourceMap:
+                raise XscValueError(u'name of <?xsc %s?> must be different from data source names' % aggregate.description)
+            self._validateDataName(aggregate.rider)
+            sourceNameToAggregatesMap.setdefault(aggregate.rider, []).append(aggregate)
+        for sourceName, aggregates in sorted(sourceNameToAggregatesMap.items()):
+            _log.info(u'compute %d aggregates of "%s"', len(aggregates), sourceName)
+            with self.statistics.phase('aggregate', sourceName):
+                result.update(_aggregateValues(self._sourceNameToSourceMap[sourceName], aggregates))
+        return result
+
+    def _validateFingerprintStore(self, fingerprintStore):
+        assert fingerprintStore is not None
+        comparableSourceNames = set(
+            loop.rider for loop in self._template.outermostLoops if loop.keyColumn is None
+        )
+        for sourceName in sorted(fingerprintStore.sourceNameToKeyColumnMap.keys()):
+            self._validateDataName(sourceName)
+            if sourceName not in comparableSourceNames:
+                raise XscValueError(
+                    u'to compare rows of %r with fingerprints, the template must have a loop over all its rows not nested in another loop'
+                    % sourceName
+                )
+            self._validateUsedColumn(sourceName, fingerprintStore.sourceNameToKeyColumnMap[sourceName])
+
+    def _write(self, targetXmlFilePath, engine, writer, compression, profiler, namespace, sharder):
+        if sharder is None:
+            with _XmlOutput(targetXmlFilePath, compression) as targetXmlFile:
+                with _newXmlWriter(writer, targetXmlFile) as self._xml:
+                    self._render(engine, profiler, namespace)
+                self._xml = None
+            self.statistics.outputByteCount = targetXmlFile.byteCount
+        else:
+            with sharder as self._xml:
+                self._render(engine, profiler, namespace)
             self._xml = None
+            self.statistics.outputByteCount = sharder.byteCount
+
+    def _render(self, engine, profiler, namespace):
+        if profiler is not None:
+            profiler.write(self._template, self._xml, self._sourceNameToSourceMap, namespace)
+        elif engine == EngineCompiled:
+            self._template.compiled.write(self._xml, self._sourceNameToSourceMap, namespace)
+        else:
+            for xscNode in self._template.content.childNodes:
+                xscNode.write(self._xml, self._sourceNameToSourceMap, namespace)
 
     def dataFor(self, dataName):
+        """
+        The rows of data source ``dataName`` or ``None`` if the data source is streamed.
+        """
         self._validateDataName(dataName)
         dataSource = self._sourceNameToSourceMap[dataName]
         return dataSource.data
@@ -587,39 +3965,566 @@ class Converter(object):
         if not name in self._sourceNameToSourceMap:
             raise XscValueError('data name is %r but must be one of: %s' % (name, sorted(self._sourceNameToSourceMap.keys())))
 
-def convert(template, sourceNameToSourceMap, targetXmlFilePath, autoDataEncoding='utf-8'):
+def convert(template, sourceNameToSourceMap, targetXmlFilePath, autoDataEncoding='utf-8', engine=EngineCompiled, jobs=1,
+        cacheFolderPath=None, sniffLineCount=DefaultSniffLineCount, sniffByteCount=0, writer=WriterNative, compression=None,
+        profiler=None, statistics=None, progressInterval=None, warmCache=None, sharding=None, fingerprintStore=None):
     assert template is not None
     assert sourceNameToSourceMap is not None
     assert targetXmlFilePath is not None
     assert autoDataEncoding is not None
+    assert engine in _Engines, 'engine=%r' % engine
+    assert jobs >= 1
+    assert writer in _Writers, 'writer=%r' % writer
+    assert compression in _Compressions + (None,), 'compression=%r' % compression
+    assert sniffLineCount >= 0
+    assert sniffByteCount >= 0
 
-    converter = Converter(template)
+    converter = Converter(template, cacheFolderPath, statistics, isProjected=True, isStreamed=True)
+    dataNameToDataFilePathMap = {}
+    # Interfaces in memory cannot be shared with other processes.
+    if (jobs > 1) and (len(sourceNameToSourceMap) > 1) and (warmCache is None) and hasattr(os, 'fork'):
+        with converter.statistics.phase('interface'):
+            dataNameToInterfaceMap = _readInterfacesConcurrently(
+                sourceNameToSourceMap, autoDataEncoding, sniffLineCount, sniffByteCount, cacheFolderPath, jobs
+            )
+    else:
+        dataNameToInterfaceMap = {}
+        for dataName, source in sourceNameToSourceMap.items():
+            dataFilePath, interfaceFilePath = source
+            _log.info('read interface of data "%s" from "%s"', dataName, dataFilePath)
+            readInterface = warmCache.interface if warmCache is not None else _readInterface
+            with converter.statistics.phase('cid' if interfaceFilePath else 'sniff', dataName):
+                dataNameToInterfaceMap[dataName] = readInterface(
+                    dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount, sniffByteCount, converter.dataCache
+                )
     for dataName, source in sourceNameToSourceMap.items():
-        dataFilePath, interfaceFilePath = source
-        _log.info('read data "%s" from "%s"', dataName, dataFilePath)
-        if interfaceFilePath:
-            _log.info('  use interface "%s"', interfaceFilePath)
-            interface = cutplace.interface.InterfaceControlDocument()
-            interface.read(interfaceFilePath)
-        else:
-            with open(dataFilePath, 'rb') as dataFile:
-                _log.info('  sniff interface')
-                interface = cutplace.interface.createSniffedInterfaceControlDocument(dataFile, encoding=autoDataEncoding, header=1)
-                humanReadableFieldNames = ', '.join(interface.fieldNames)
-                _log.info('  found fields: %s', humanReadableFieldNames)
-        converter.setInterface(dataName, interface)
-        converter.setData(dataName, dataFilePath)
-        _log.info('  found %d data rows', len(converter.dataFor(dataName)))
-    converter.write(targetXmlFilePath)
-
-def _parsedOptions(arguments):
+        converter.setInterface(dataName, dataNameToInterfaceMap[dataName])
+        dataNameToDataFilePathMap[dataName] = source[0]
+    if (sharding is not None) and (sharding.keyColumn is not None):
+        converter.useColumn(sharding.loop(template).rider, sharding.keyColumn)
+    if fingerprintStore is not None:
+        for dataName, keyColumn in fingerprintStore.sourceNameToKeyColumnMap.items():
+            if dataName in dataNameToDataFilePathMap:
+                converter.useColumn(dataName, keyColumn)
+    converter.setAllData(dataNameToDataFilePathMap, jobs)
+    for dataName in sorted(dataNameToDataFilePathMap.keys()):
+        if converter.source(dataName).isStreamed:
+            _log.info('stream data rows of "%s" while writing', dataName)
+        else:
+            _log.info('found %d data rows in "%s"', converter.source(dataName).rowCount, dataName)
+    converter.write(
+        targetXmlFilePath, engine, jobs, writer, compression, profiler, progressInterval, sharding, fingerprintStore
+    )
+    _logStreamedRowCounts(converter, sourceNameToSourceMap.keys())
+
+def _readInterfaceRowsOrError(dataName, dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount,
+        sniffByteCount, cacheFolderPath):
+    """
+    Tuple ``(interfaceRows, errorMessage)`` with the rows describing the interface of data
+    source ``dataName`` as obtained by `_readInterfaceRows()` or an error message describing
+    why it cannot be read. This runs in a worker process of `_readInterfacesConcurrently()`.
+    """
+    dataCache = _DataCache(cacheFolderPath) if cacheFolderPath is not None else None
+    try:
+        _log.info('read interface of data "%s" from "%s"', dataName, interfaceFilePath or dataFilePath)
+        interfaceRows = _readInterfaceRows(
+            dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount, sniffByteCount, dataCache
+        )
+        # Validate the rows here so errors are collected like the others.
+        cutplace.interface.InterfaceControlDocument().readFromRows(interfaceRows)
+        result = (interfaceRows, None)
+    except Exception, error:
+        # Exceptions of other modules are not necessarily picklable, so only pass a message.
+        result = (None, u'cannot read interface of data source %r from "%s": %s' % (
+            dataName, interfaceFilePath or dataFilePath, error
+        ))
+    return result
+
+def _readInterfacesConcurrently(sourceNameToSourceMap, autoDataEncoding, sniffLineCount, sniffByteCount, cacheFolderPath,
+        jobs):
+    """
+    Map of the names in ``sourceNameToSourceMap`` to the interfaces read by `_readInterface()`
+    using up to ``jobs`` processes. If any of them cannot be read, the resulting `XscError`
+    describes the errors of all of them.
+
+    Interfaces hold locks and cannot be pickled, so the processes only read the CID or sniff
+    the data and pass the resulting rows, from which the interfaces are built in this process.
+    """
+    assert sourceNameToSourceMap is not None
+    assert jobs >= 1
+    processCount = min(jobs, len(sourceNameToSourceMap))
+    _log.info('read %d interfaces using %d processes', len(sourceNameToSourceMap), processCount)
+    result = {}
+    pool = multiprocessing.Pool(processCount)
+    try:
+        nameToPendingResultMap = dict(
+            (name, pool.apply_async(_readInterfaceRowsOrError, (
+                name, dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount, sniffByteCount, cacheFolderPath
+            )))
+            for name, (dataFilePath, interfaceFilePath) in sourceNameToSourceMap.items()
+        )
+        errorMessages = []
+        for name, pendingResult in sorted(nameToPendingResultMap.items()):
+            interfaceRows, errorMessage = pendingResult.get()
+            if errorMessage is None:
+                interface = cutplace.interface.InterfaceControlDocument()
+                interface.readFromRows(interfaceRows)
+                result[name] = interface
+            else:
+                _log.error(u'%s', errorMessage)
+                errorMessages.append(errorMessage)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if errorMessages:
+        raise XscError(u'cannot read %d of %d interfaces: %s' % (
+            len(errorMessages), len(sourceNameToSourceMap), u'; '.join(errorMessages)
+        ))
+    return result
+
+def _readInterface(dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount=DefaultSniffLineCount,
+        sniffByteCount=0, dataCache=None):
+    """
+    The cutplace interface read from ``interfaceFilePath`` or, if it is ``None``, sniffed
+    from a sample of ``dataFilePath`` as described in `_readInterfaceRows()`.
+    """
+    assert dataFilePath is not None
+    assert autoDataEncoding is not None
+    result = cutplace.interface.InterfaceControlDocument()
+    if interfaceFilePath:
+        _log.info('  use interface "%s"', interfaceFilePath)
+        # Read the file directly so errors refer to its cells.
+        result.read(interfaceFilePath)
+    else:
+        result.readFromRows(_readInterfaceRows(
+            dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount, sniffByteCount, dataCache
+        ))
+        humanReadableFieldNames = ', '.join(result.fieldNames)
+        _log.info('  found fields: %s', humanReadableFieldNames)
+    return result
+
+def _readInterfaceRows(dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount=DefaultSniffLineCount,
+        sniffByteCount=0, dataCache=None):
+    """
+    Rows describing the cutplace interface read from ``interfaceFilePath`` or, if it is
+    ``None``, sniffed from a sample of ``dataFilePath`` as described in `_sniffSample()`. If
+    ``dataCache`` is a `_DataCache`, interfaces sniffed from the same sample before are taken
+    from it. Unlike an interface, the rows can be passed to other processes.
+    """
+    assert dataFilePath is not None
+    assert autoDataEncoding is not None
+    if interfaceFilePath:
+        with open(interfaceFilePath, 'rb') as interfaceFile:
+            result = list(cutplace.sniff.createReader(interfaceFile, encoding='ascii'))
+    else:
+        sample, isCompleteSample = _sniffSample(dataFilePath, _SniffHeaderLineCount, sniffLineCount, sniffByteCount)
+        if not isCompleteSample:
+            _log.warning(
+                u'sniffed interface only from the first %d bytes of "%s", so all its fields accept any text; '
+                u'use --sniff-lines 0 or a CID to validate types, lengths and empty values of all rows',
+                len(sample), dataFilePath
+            )
+        result = None
+        if dataCache is not None:
+            cidKey = (hashlib.sha1(sample).hexdigest(), isCompleteSample, autoDataEncoding, _SniffHeaderLineCount)
+            result = dataCache.cidRows(cidKey)
+        if result is None:
+            _log.info('  sniff interface from %d bytes', len(sample))
+            result = cutplace.sniff.createCidRows(
+                StringIO.StringIO(sample), encoding=autoDataEncoding, header=_SniffHeaderLineCount
+            )
+            if not isCompleteSample:
+                result = _generalizedCidRows(result)
+            if dataCache is not None:
+                try:
+                    dataCache.storeCidRows(cidKey, result)
+                except EnvironmentError, error:
+                    _log.warning(u'cannot store sniffed interface in cache: %s', error)
+        else:
+            _log.info('  use sniffed interface from cache')
+    return result
+
+def _sniffSample(dataFilePath, headerLineCount, sniffLineCount, sniffByteCount):
+    """
+    Tuple ``(sample, isCompleteSample)`` with the first records of ``dataFilePath`` to sniff
+    the interface from. The sample contains at most ``sniffLineCount`` data records in
+    addition to the ``headerLineCount`` header records and ends before the record starting
+    beyond ``sniffByteCount``, but contains at least one data record. A count of 0 means no
+    limit. A record ends with the first line break outside of a value quoted with ``"``, so
+    values spanning several lines are never cut.
+    """
+    assert dataFilePath is not None
+    assert headerLineCount >= 0
+    assert sniffLineCount >= 0
+    assert sniffByteCount >= 0
+    lines = []
+    byteCount = 0
+    recordCount = 0
+    isInQuotedValue = False
+    isCompleteSample = True
+    with _openData(dataFilePath) as dataFile:
+        for line in dataFile:
+            if not isInQuotedValue:
+                dataRecordCount = recordCount - headerLineCount
+                if dataRecordCount >= 1:
+                    isLineLimitReached = sniffLineCount and (dataRecordCount >= sniffLineCount)
+                    isByteLimitReached = sniffByteCount and (byteCount + len(line) > sniffByteCount)
+                    if isLineLimitReached or isByteLimitReached:
+                        isCompleteSample = False
+                        break
+                recordCount += 1
+            lines.append(line)
+            byteCount += len(line)
+            # Escaped quotes come in pairs, so only an odd number of them starts or ends a value.
+            if line.count('"') % 2:
+                isInQuotedValue = not isInQuotedValue
+    return ''.join(lines), isCompleteSample
+
+def _generalizedCidRows(cidRows):
+    """
+    Copy of the interface described by ``cidRows`` where all fields are optional text of any
+    length. A sniffer derives lengths and types from the values it found, but a sample does
+    not necessarily contain all kinds of values of the complete data.
+    """
+    assert cidRows is not None
+    result = []
+    for cidRow in cidRows:
+        if cidRow and (cidRow[0] == 'f'):
+            _, fieldName, example = cidRow[:3]
+            result.append(['f', fieldName, example, 'X', '', 'Text', ''])
+        else:
+            result.append(cidRow)
+    return result
+
+def _logStreamedRowCounts(converter, dataNames):
+    for dataName in sorted(dataNames):
+        source = converter.source(dataName)
+        if source.isStreamed:
+            _log.info('streamed %d data rows from "%s"', source.rowCount or 0, dataName)
+
+class BatchJob(object):
+    """
+    A single conversion of a batch: the path of the template, a map of data source names to
+    ``(dataFilePath, interfaceFilePath)`` and the path of the XML file to write.
+    """
+    def __init__(self, templatePath, sourceNameToSourceMap, targetXmlFilePath, engine=EngineCompiled, jobs=1, cacheFolderPath=None,
+            writer=WriterNative, compression=None):
+        assert templatePath is not None
+        assert sourceNameToSourceMap is not None
+        assert targetXmlFilePath is not None
+        assert engine in _Engines, 'engine=%r' % engine
+        assert jobs >= 1
+        assert writer in _Writers, 'writer=%r' % writer
+        assert compression in _Compressions + (None,), 'compression=%r' % compression
+        self.templatePath = templatePath
+        self.sourceNameToSourceMap = sourceNameToSourceMap
+        self.targetXmlFilePath = targetXmlFilePath
+        self.engine = engine
+        self.jobs = jobs
+        self.cacheFolderPath = cacheFolderPath
+        self.writer = writer
+        self.compression = compression
+
+    def __repr__(self):
+        return 'BatchJob(%r, %r, %r)' % (self.templatePath, self.sourceNameToSourceMap, self.targetXmlFilePath)
+
+class _ManifestOptionParser(optparse.OptionParser):
+    """
+    Option parser for a line in a batch manifest that raises `XscSyntaxError` instead of
+    exiting.
+    """
+    def exit(self, status=0, msg=None):
+        raise XscSyntaxError(msg or u'option must be removed because it exits')
+
+    def error(self, msg):
+        raise XscSyntaxError(msg)
+
+    def get_default_values(self):
+        result = optparse.OptionParser.get_default_values(self)
+        # Tell sniff options specified in the manifest from the defaults, see `check_values()`.
+        result.sniffLineCount = None
+        result.sniffByteCount = None
+        return result
+
+    def check_values(self, values, args):
+        if (values.sniffLineCount is not None) or (values.sniffByteCount is not None):
+            self.error(u'--sniff-lines and --sniff-bytes must be removed because batch jobs sniff using the options of xsc-batch')
+        values.sniffLineCount = self.defaults['sniffLineCount']
+        values.sniffByteCount = self.defaults['sniffByteCount']
+        return optparse.OptionParser.check_values(self, values, args)
+
+def _manifestRelativePath(manifestFolderPath, path):
+    """
+    ``path`` resolved against ``manifestFolderPath`` unless it is absolute or ``None``.
+    """
+    return os.path.join(manifestFolderPath, path) if path is not None else None
+
+def readBatchManifest(manifestPath):
+    """
+    List of `BatchJob` read from the manifest file in ``manifestPath``. Each line describes
+    a job using the same options and arguments as the command line, for example::
+
+      --output customers.xml customers.xsc customers:customers.csv
+
+    Empty lines and lines starting with ``#`` are ignored. Relative paths of templates, data,
+    interfaces, output and cache refer to the folder containing the manifest.
+    """
+    assert manifestPath is not None
+    manifestFolderPath = os.path.dirname(manifestPath)
+    result = []
+    with open(manifestPath, 'rb') as manifestFile:
+        for lineNumber, line in enumerate(manifestFile, 1):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                try:
+                    options, xscTemplatePath, dataSourceMap = _parsedOptions(shlex.split(line), _ManifestOptionParser)
+                    if options.outXmlPath == _StandardOutputPath:
+                        raise XscSyntaxError(u'--output must be a file because batch jobs cannot write to standard output')
+                    if options.isProfile:
+                        raise XscSyntaxError(u'--profile and --profile-json must be removed because batch jobs cannot be profiled')
+                    if (options.statsPath is not None) or (options.progressInterval is not None):
+                        raise XscSyntaxError(u'--stats and --progress must be removed because batch jobs are measured as a whole')
+                    if options.sharding is not None:
+                        raise XscSyntaxError(u'--shard-rows, --shard-bytes and --shard-by must be removed because batch jobs cannot be split into shards')
+                    if options.deltaKeyColumnMap:
+                        raise XscSyntaxError(u'--delta must be removed because batch jobs cannot be compared with a previous conversion')
+                except (ValueError, XscSyntaxError), error:
+                    raise XscSyntaxError(u'%s:%d: cannot process batch job: %s' % (manifestPath, lineNumber, error))
+                sourceNameToSourceMap = dict(
+                    (name, (_manifestRelativePath(manifestFolderPath, dataPath), _manifestRelativePath(manifestFolderPath, icdPath)))
+                    for name, (dataPath, icdPath) in dataSourceMap.items()
+                )
+                result.append(BatchJob(
+                    _manifestRelativePath(manifestFolderPath, xscTemplatePath),
+                    sourceNameToSourceMap,
+                    _manifestRelativePath(manifestFolderPath, options.outXmlPath),
+                    options.engine,
+                    options.jobs,
+                    _manifestRelativePath(manifestFolderPath, options.cacheFolderPath),
+                    options.writer,
+                    options.compression
+                ))
+    return result
+
+# Tuple of (batchJobs, templatePathToTemplateMap, dataKeyToInterfaceMap, dataKeyToLoadedSourceMap,
+# cacheFolderPath) for `_runBatchJob()`. Worker processes inherit it when the process pool is forked.
+_batchState = None
+
+def _runBatchJob(batchJobIndex, jobs=1):
+    """
+    Error message if the job at ``batchJobIndex`` of `_batchState` failed or ``None``.
+    """
+    assert _batchState is not None
+    batchJobs, templatePathToTemplateMap, dataKeyToInterfaceMap, dataKeyToLoadedSourceMap, cacheFolderPath = _batchState
+    batchJob = batchJobs[batchJobIndex]
+    result = None
+    try:
+        _log.info('run batch job %d of %d: %s', batchJobIndex + 1, len(batchJobs), batchJob.targetXmlFilePath)
+        template = templatePathToTemplateMap[batchJob.templatePath]
+        if isinstance(template, Exception):
+            raise template
+        converter = Converter(template, batchJob.cacheFolderPath or cacheFolderPath, isStreamed=True)
+        for dataName, dataKey in batchJob.sourceNameToSourceMap.items():
+            loadedSource = dataKeyToLoadedSourceMap.get(dataKey)
+            if loadedSource is not None:
+                converter.setSource(dataName, loadedSource)
+            else:
+                interface = dataKeyToInterfaceMap[dataKey]
+                if isinstance(interface, Exception):
+                    raise interface
+                converter.setInterface(dataName, interface)
+                converter.setData(dataName, dataKey[0])
+        converter.write(batchJob.targetXmlFilePath, batchJob.engine, jobs, batchJob.writer, batchJob.compression)
+        _logStreamedRowCounts(converter, batchJob.sourceNameToSourceMap.keys())
+    except Exception, error:
+        _log.error(u'cannot run batch job %d (%s): %s', batchJobIndex + 1, batchJob.targetXmlFilePath, error)
+        result = unicode(error) or error.__class__.__name__
+    return result
+
+def convertBatch(batchJobs, jobs=1, autoDataEncoding='utf-8', cacheFolderPath=None, sniffLineCount=DefaultSniffLineCount,
+        sniffByteCount=0):
+    """
+    Run all ``batchJobs`` using ``jobs`` processes. Each template is read only once, and each
+    data file used by several jobs is read and validated only once. Validated rows are cached
+    in ``cacheFolderPath`` unless a job specifies a cache folder of its own, and so are
+    compiled templates. The result is a list of ``(batchJob, errorMessage)`` for jobs that
+    failed.
+    """
+    assert batchJobs is not None
+    assert jobs >= 1
+    assert autoDataEncoding is not None
+    global _batchState
+
+    dataCache = _DataCache(cacheFolderPath) if cacheFolderPath is not None else None
+    templatePathToTemplateMap = {}
+    dataKeyToInterfaceMap = {}
+    dataKeyToUseCountMap = {}
+    for batchJob in batchJobs:
+        if batchJob.templatePath not in templatePathToTemplateMap:
+            try:
+                template = XscTemplate(batchJob.templatePath, cacheFolderPath)
+                template.compiled
+            except Exception, error:
+                template = error
+            templatePathToTemplateMap[batchJob.templatePath] = template
+        for dataKey in batchJob.sourceNameToSourceMap.values():
+            dataKeyToUseCountMap[dataKey] = dataKeyToUseCountMap.get(dataKey, 0) + 1
+            if dataKey not in dataKeyToInterfaceMap:
+                dataFilePath, interfaceFilePath = dataKey
+                _log.info('read interface for "%s"', dataFilePath)
+                try:
+                    interface = _readInterface(
+                        dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount, sniffByteCount, dataCache
+                    )
+                except Exception, error:
+                    interface = error
+                dataKeyToInterfaceMap[dataKey] = interface
+
+    # Load data used by several jobs once. Data used by a single job are read by the job
+    # itself, possibly streamed.
+    dataKeyToLoadedSourceMap = {}
+    for dataKey, useCount in sorted(dataKeyToUseCountMap.items()):
+        interface = dataKeyToInterfaceMap[dataKey]
+        if (useCount > 1) and not isinstance(interface, Exception):
+            dataFilePath = dataKey[0]
+            _log.info('read data "%s" for %d jobs', dataFilePath, useCount)
+            loadedSource = DataSource(os.path.splitext(os.path.basename(dataFilePath))[0])
+            loadedSource.setInterface(interface)
+            try:
+                loadedSource.setData(dataFilePath, dataCache=dataCache)
+                dataKeyToLoadedSourceMap[dataKey] = loadedSource
+            except Exception, error:
+                _log.error(u'cannot read data "%s": %s', dataFilePath, error)
+                dataKeyToInterfaceMap[dataKey] = error
+
+    _batchState = (batchJobs, templatePathToTemplateMap, dataKeyToInterfaceMap, dataKeyToLoadedSourceMap, cacheFolderPath)
+    try:
+        if (jobs > 1) and (len(batchJobs) > 1) and hasattr(os, 'fork'):
+            _log.info('run %d batch jobs using %d processes', len(batchJobs), jobs)
+            pool = multiprocessing.Pool(jobs)
+            try:
+                errorMessages = pool.map(_runBatchJob, range(len(batchJobs)), 1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            errorMessages = [
+                _runBatchJob(batchJobIndex, batchJob.jobs) for batchJobIndex, batchJob in enumerate(batchJobs)
+            ]
+    finally:
+        _batchState = None
+    return [
+        (batchJob, errorMessage) for batchJob, errorMessage in zip(batchJobs, errorMessages)
+        if errorMessage is not None
+    ]
+
+def _addSniffOptions(parser):
+    assert parser is not None
+    parser.add_option('--sniff-lines', dest='sniffLineCount', metavar='NUMBER', type='int', default=DefaultSniffLineCount,
+        help='number of data lines to sniff the interface of a DATAFILE without CIDFILE from; 0 means all; if the file has '
+        + 'more lines, all fields accept any text of any length (default: %default)')
+    parser.add_option('--sniff-bytes', dest='sniffByteCount', metavar='NUMBER', type='int', default=0,
+        help='maximum number of bytes to sniff the interface of a DATAFILE without CIDFILE from; 0 means no limit; if the file '
+        + 'is larger, all fields accept any text of any length (default: %default)')
+
+def _validateSniffOptions(parser, options):
+    assert parser is not None
+    assert options is not None
+    if options.sniffLineCount < 0:
+        parser.error('--sniff-lines must be at least 0 but is: %d' % options.sniffLineCount)
+    if options.sniffByteCount < 0:
+        parser.error('--sniff-bytes must be at least 0 but is: %d' % options.sniffByteCount)
+
+# Value for ``--output`` to write to standard output.
+_StandardOutputPath = '-'
+
+# Number of nodes to report with ``--profile``.
+_ProfileReportEntryCount = 20
+
+# Number of seconds between progress messages unless ``--progress`` is specified.
+_DefaultProgressInterval = 10.0
+
+def _parsedOptions(arguments, parserClass=optparse.OptionParser):
     usage = 'usage: %prog [options] TEMPLATE [DATASOURCE ...]'
     epilog = 'TEMPLATE is an XML file typically using \'.xsc\' as suffix. DATASOURCE describes a data source using \'NAME[:DATAFILE[@CIDFILE]]\'. For more information, visit <http://pypi.python.org/pypi/xsc/>.'
-    parser = optparse.OptionParser(usage=usage, description=_Description, epilog=epilog, version=__version__)
+    parser = parserClass(usage=usage, description=_Description, epilog=epilog, version=__version__)
     parser.add_option('-o', '--output',dest='outXmlPath', metavar='FILE',
-        help='XML file where to store output (default: same as TEMPLATE but with suffix \'.xml\'')
+        help='XML file where to store output; \'-\' means standard output (default: same as TEMPLATE but with suffix \'.xml\'')
+    parser.add_option('--compress', dest='compression', type='choice', choices=list(_Compressions),
+        help='compression of the output: %s (default: depending on the suffix of FILE, for example \'.gz\' for gzip)'
+        % ', '.join(_Compressions))
+    parser.add_option('--engine', dest='engine', type='choice', choices=list(_Engines), default=EngineCompiled,
+        help='engine to render TEMPLATE: %s (default: %%default)' % ', '.join(_Engines))
+    parser.add_option('--writer', dest='writer', type='choice', choices=list(_Writers), default=WriterNative,
+        help='writer to produce the XML output with: %s (default: %%default)' % ', '.join(_Writers))
+    parser.add_option('-j', '--jobs', dest='jobs', metavar='NUMBER', type='int', default=1,
+        help='number of processes to render rows of outermost loops with (default: %default)')
+    parser.add_option('--cache', dest='cacheFolderPath', metavar='FOLDER',
+        help='folder where to cache validated data rows, sniffed interfaces and compiled templates so unchanged files need not be processed again')
+    parser.add_option('--profile', dest='isProfile', action='store_true', default=False,
+        help='measure the time spent in each node of TEMPLATE and report the slowest ones')
+    parser.add_option('--profile-json', dest='profileJsonPath', metavar='FILE',
+        help='like --profile but also store the measurements of all nodes in FILE as JSON document')
+    parser.add_option('--stats', dest='statsPath', metavar='FILE',
+        help='store the duration and peak memory of each phase, the number of rows and the size of the output in FILE as JSON document')
+    parser.add_option('--progress', dest='progressInterval', metavar='SECONDS', type='float',
+        help='log progress of outermost loops each time this many seconds have passed; 0 means never (default: %s)'
+        % _DefaultProgressInterval)
+    parser.add_option('--shard-rows', dest='shardRowCount', metavar='NUMBER', type='int',
+        help='split the output into files holding at most this many rows of the shard loop each')
+    parser.add_option('--shard-bytes', dest='shardByteCount', metavar='NUMBER', type='int',
+        help='split the output into files holding at most this many bytes before compression each')
+    parser.add_option('--shard-by', dest='shardKeyColumn', metavar='COLUMN',
+        help='split the output into files holding only consecutive rows of the shard loop with the same value in COLUMN')
+    parser.add_option('--shard-loop', dest='shardLoopRider', metavar='NAME',
+        help='name of the data source whose loop splits the output into shards (default: the first loop not nested in another loop)')
+    parser.add_option('--delta', dest='deltaKeyColumns', metavar='NAME:COLUMN', action='append',
+        help='only write rows of data source NAME that are new or changed since the previous conversion, identifying rows by their value in COLUMN; requires --delta-store')
+    parser.add_option('--delta-store', dest='deltaStorePath', metavar='FILE',
+        help='file where to keep fingerprints of rows to compare the next conversion with --delta with')
+    parser.add_option('--deleted', dest='deletedKeysPath', metavar='FILE',
+        help='store the keys of rows removed since the previous conversion with --delta in FILE as JSON document')
+    _addSniffOptions(parser)
 
     options, others = parser.parse_args(arguments)
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1 but is: %d' % options.jobs)
+    if options.profileJsonPath is not None:
+        options.isProfile = True
+    if (options.progressInterval is not None) and (options.progressInterval < 0):
+        parser.error('--progress must be at least 0 but is: %s' % options.progressInterval)
+    for optionName, value in (('--shard-rows', options.shardRowCount), ('--shard-bytes', options.shardByteCount)):
+        if (value is not None) and (value < 1):
+            parser.error('%s must be at least 1 but is: %d' % (optionName, value))
+    options.sharding = None
+    if (options.shardRowCount, options.shardByteCount, options.shardKeyColumn) != (None, None, None):
+        if options.outXmlPath == _StandardOutputPath:
+            parser.error('--output must be a file to split the output into shards')
+        options.sharding = Sharding(
+            options.shardRowCount, options.shardByteCount, options.shardKeyColumn, options.shardLoopRider
+        )
+    elif options.shardLoopRider is not None:
+        parser.error('--shard-loop requires --shard-rows, --shard-bytes or --shard-by')
+    options.deltaKeyColumnMap = {}
+    for deltaKeyColumn in options.deltaKeyColumns or []:
+        name, separator, keyColumn = deltaKeyColumn.partition(':')
+        if not (name and separator and keyColumn):
+            parser.error('--delta must be NAME:COLUMN but is: %r' % deltaKeyColumn)
+        if name in options.deltaKeyColumnMap:
+            parser.error('duplicate --delta for data source must be resolved: %s' % name)
+        options.deltaKeyColumnMap[name] = keyColumn
+    if options.deltaKeyColumnMap:
+        if options.deltaStorePath is None:
+            parser.error('--delta-store must be specified to compare rows with the previous conversion')
+    elif (options.deltaStorePath is not None) or (options.deletedKeysPath is not None):
+        parser.error('--delta-store and --deleted require --delta')
+    _validateSniffOptions(parser, options)
     if not others:
         parser.error('TEMPLATE to process must be specified')
     xscTemplatePath = others[0]
@@ -645,6 +4550,55 @@ def _parsedOptions(arguments):
         options.outXmlPath = baseXscTemplatePath + XmlSuffix
     return options, xscTemplatePath, dataSourceMap
 
+def _convertWithOptions(options, xscTemplatePath, dataSourceMap, warmCache=None):
+    """
+    Convert ``xscTemplatePath`` using ``dataSourceMap`` and ``options`` as obtained from
+    `_parsedOptions()`. With ``warmCache``, templates and interfaces are taken from this
+    `xsc_server._WarmCache`.
+    """
+    statistics = RunStatistics()
+    with statistics.phase('template'):
+        if warmCache is not None:
+            template = warmCache.template(xscTemplatePath, options.cacheFolderPath)
+        else:
+            template = XscTemplate(xscTemplatePath, options.cacheFolderPath)
+    if dataSourceMap:
+        if options.outXmlPath == _StandardOutputPath:
+            targetXmlFilePath = sys.stdout
+        else:
+            targetXmlFilePath = options.outXmlPath
+        profiler = TemplateProfiler() if options.isProfile else None
+        progressInterval = options.progressInterval
+        if progressInterval is None:
+            progressInterval = _DefaultProgressInterval
+        fingerprintStore = None
+        if options.deltaKeyColumnMap:
+            fingerprintStore = FingerprintStore(options.deltaStorePath, options.deltaKeyColumnMap)
+        convert(
+            template, dataSourceMap, targetXmlFilePath, engine=options.engine, jobs=options.jobs, writer=options.writer,
+            compression=options.compression,
+            cacheFolderPath=options.cacheFolderPath, sniffLineCount=options.sniffLineCount,
+            sniffByteCount=options.sniffByteCount, profiler=profiler, statistics=statistics,
+            progressInterval=progressInterval, warmCache=warmCache, sharding=options.sharding,
+            fingerprintStore=fingerprintStore
+        )
+        if options.deletedKeysPath is not None:
+            _log.info(u'write deleted keys "%s"', options.deletedKeysPath)
+            fingerprintStore.writeDeletedKeysJson(options.deletedKeysPath)
+        if options.statsPath is not None:
+            _log.info(u'write statistics "%s"', options.statsPath)
+            statistics.writeJson(options.statsPath)
+        if profiler is not None:
+            _log.info(u'slowest template nodes:')
+            for reportLine in profiler.reportLines(_ProfileReportEntryCount):
+                _log.info(u'%s', reportLine)
+            if options.profileJsonPath is not None:
+                _log.info(u'write profile "%s"', options.profileJsonPath)
+                profiler.writeJson(options.profileJsonPath)
+    else:
+        # No data source means: validate *.xsc without conversion.
+        pass
+
 def main(arguments=None):
     """
     Main function for command line call returning a tuple
@@ -660,12 +4614,7 @@ def main(arguments=None):
     exitError = None
     try:
         options, xscTemplatePath, dataSourceMap = _parsedOptions(actualArguments[1:])
-        template = XscTemplate(xscTemplatePath)
-        if dataSourceMap:
-            convert(template, dataSourceMap, options.outXmlPath)
-        else:
-            # No data source means: validate *.xsc without conversion.
-            pass
+        _convertWithOptions(options, xscTemplatePath, dataSourceMap)
         exitCode = 0
     except KeyboardInterrupt, error:
         _log.error('interrupted by user')
@@ -688,5 +4637,72 @@ def mainWithExit():
     logging.getLogger('cutplace').setLevel(logging.WARNING)
     sys.exit(main()[0])
 
+def _parsedBatchOptions(arguments):
+    usage = 'usage: %prog [options] MANIFEST'
+    epilog = 'MANIFEST is a text file where each line describes a conversion using the same options and arguments as xsc. For more information, visit <http://pypi.python.org/pypi/xsc/>.'
+    parser = optparse.OptionParser(usage=usage, description='run several xsc conversions at once', epilog=epilog, version=__version__)
+    parser.add_option('-j', '--jobs', dest='jobs', metavar='NUMBER', type='int', default=1,
+        help='number of processes to run conversions with (default: %default)')
+    parser.add_option('--cache', dest='cacheFolderPath', metavar='FOLDER',
+        help='folder where to cache validated data rows, sniffed interfaces and compiled templates for conversions that do not specify --cache')
+    _addSniffOptions(parser)
+
+    options, others = parser.parse_args(arguments)
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1 but is: %d' % options.jobs)
+    _validateSniffOptions(parser, options)
+    if not others:
+        parser.error('MANIFEST to process must be specified')
+    if len(others) > 1:
+        parser.error('only one MANIFEST must be specified but found: %s' % ' '.join(others))
+    return options, others[0]
+
+def batchMain(arguments=None):
+    """
+    Main function for command line call of batch conversions returning a tuple
+    ``(exitCode, error)`` similar to `main()`. If any conversion failed, the exit code
+    is 1 and ``error`` is ``None``.
+    """
+    if arguments == None:
+        actualArguments = sys.argv
+    else:
+        actualArguments = arguments
+
+    exitCode = 1
+    exitError = None
+    try:
+        options, manifestPath = _parsedBatchOptions(actualArguments[1:])
+        batchJobs = readBatchManifest(manifestPath)
+        failedJobs = convertBatch(
+            batchJobs, options.jobs, cacheFolderPath=options.cacheFolderPath, sniffLineCount=options.sniffLineCount,
+            sniffByteCount=options.sniffByteCount
+        )
+        if failedJobs:
+            _log.error(u'%d of %d batch jobs failed:', len(failedJobs), len(batchJobs))
+            for batchJob, errorMessage in failedJobs:
+                _log.error(u'  %s: %s', batchJob.targetXmlFilePath, errorMessage)
+        else:
+            _log.info(u'finished %d batch jobs', len(batchJobs))
+            exitCode = 0
+    except KeyboardInterrupt, error:
+        _log.error('interrupted by user')
+        exitError = error
+    except EnvironmentError, error:
+        _log.error(u'%s', error)
+        exitError = error
+    except Exception, error:
+        _log.exception(error)
+        exitError = error
+
+    return exitCode, exitError
+
+def batchMainWithExit():
+    """
+    Like `mainWithExit()` but for `batchMain()`.
+    """
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('cutplace').setLevel(logging.WARNING)
+    sys.exit(batchMain()[0])
+
 if __name__ == '__main__': # pragma: no cover
     mainWithExit()
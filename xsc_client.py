@@ -0,0 +1,157 @@
+"""
+Thin client for ``xsc-server``.
+
+Sends a conversion to an xsc server running on the same machine and waits for it to
+finish. It accepts the same options and arguments as ``xsc`` and exits with the same
+code, but only imports modules of the Python standard library, so it starts quickly::
+
+  $ xsc-client --output customers.xml customers.xsc customers:customers.csv
+
+The server listens on the Unix socket specified with ``--socket`` as first option, the
+environment variable ``XSC_SOCKET`` or `defaultSocketPath()`.
+"""
+# Copyright (C) 2011-2012 Thomas Aglassinger
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import getpass
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Environment variable with the path of the socket the server listens on.
+SocketPathVariable = 'XSC_SOCKET'
+
+# Option to specify the socket before the options and arguments passed on to the server.
+_SocketOption = '--socket'
+
+def defaultSocketPath():
+    """
+    Path of the Unix socket the server listens on unless specified otherwise, which is
+    located in a folder only the current user can access: ``$XDG_RUNTIME_DIR`` or, if it is
+    not set, a folder named after the user in the folder for temporary files, which the
+    server creates.
+    """
+    runtimeFolderPath = os.environ.get('XDG_RUNTIME_DIR')
+    if runtimeFolderPath:
+        result = os.path.join(runtimeFolderPath, 'xsc.socket')
+    else:
+        result = os.path.join(tempfile.gettempdir(), 'xsc-%s' % getpass.getuser(), 'xsc.socket')
+    return result
+
+def socketPath():
+    """
+    Path of the socket from the environment variable `SocketPathVariable` or
+    `defaultSocketPath()`.
+    """
+    return os.environ.get(SocketPathVariable) or defaultSocketPath()
+
+def sendLine(connectionFile, value):
+    """
+    Send ``value`` as JSON document in a single line.
+    """
+    assert connectionFile is not None
+    connectionFile.write(json.dumps(value) + '\n')
+    connectionFile.flush()
+
+def receivedLine(connectionFile):
+    """
+    Value received from a single line holding a JSON document.
+    """
+    assert connectionFile is not None
+    line = connectionFile.readline()
+    if not line:
+        raise EOFError('connection closed before a response was received')
+    return json.loads(line)
+
+def validateSocketOwner(socketPath):
+    """
+    Raise ``EnvironmentError`` if the socket at ``socketPath`` belongs to another user, who
+    then would receive the arguments and working folder of conversions.
+    """
+    assert socketPath is not None
+    if os.stat(socketPath).st_uid != os.getuid():
+        raise EnvironmentError(errno.EPERM, 'socket must belong to the current user', socketPath)
+
+def convert(arguments, workingFolderPath=None, serverSocketPath=None):
+    """
+    Let the server convert using the options and arguments in the list ``arguments``, where
+    relative paths refer to ``workingFolderPath`` (default: the current folder). The result
+    is a dictionary with the ``exitCode`` of the conversion, the ``log`` messages and any
+    ``output`` such as the help text.
+    """
+    assert arguments is not None
+    serverSocketPath = serverSocketPath or socketPath()
+    validateSocketOwner(serverSocketPath)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(serverSocketPath)
+        connectionFile = connection.makefile('r+b')
+        try:
+            sendLine(connectionFile, {
+                'arguments': list(arguments),
+                'workingFolder': workingFolderPath or os.getcwd(),
+            })
+            result = receivedLine(connectionFile)
+        finally:
+            connectionFile.close()
+    finally:
+        connection.close()
+    return result
+
+def main(arguments=None):
+    """
+    Main function for command line call returning a tuple ``(exitCode, error)`` like
+    ``xsc.main()``.
+    """
+    if arguments is None:
+        actualArguments = sys.argv
+    else:
+        actualArguments = arguments
+
+    serverArguments = list(actualArguments[1:])
+    serverSocketPath = None
+    if serverArguments and serverArguments[0].startswith(_SocketOption + '='):
+        serverSocketPath = serverArguments.pop(0)[len(_SocketOption) + 1:]
+    elif serverArguments[:1] == [_SocketOption] and (len(serverArguments) >= 2):
+        serverSocketPath = serverArguments[1]
+        del serverArguments[:2]
+    serverSocketPath = serverSocketPath or socketPath()
+
+    exitCode = 1
+    exitError = None
+    try:
+        response = convert(serverArguments, serverSocketPath=serverSocketPath)
+        for logLine in response['log']:
+            sys.stderr.write(logLine.encode('utf-8') + '\n')
+        sys.stdout.write(response['output'].encode('utf-8'))
+        exitCode = response['exitCode']
+    except KeyboardInterrupt, error:
+        sys.stderr.write('interrupted by user\n')
+        exitError = error
+    except (EnvironmentError, EOFError, ValueError, KeyError), error:
+        sys.stderr.write('cannot convert using xsc server at "%s": %s\n' % (serverSocketPath, error))
+        exitError = error
+    return exitCode, exitError
+
+def mainWithExit():
+    """
+    Main function for command line call using ``sys.exit()``.
+    """
+    sys.exit(main()[0])
+
+if __name__ == '__main__': # pragma: no cover
+    mainWithExit()
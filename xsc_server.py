@@ -0,0 +1,359 @@
+"""
+Server for ``xsc-client``.
+
+Runs conversions sent by ``xsc_client`` in a pool of worker processes, each of which keeps
+templates and interfaces in memory, so many small conversions need not start Python and
+read them again each time::
+
+  $ xsc-server --jobs 4 --cache ~/.xsc-cache
+"""
+# Copyright (C) 2011-2012 Thomas Aglassinger
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import logging
+import multiprocessing
+import optparse
+import os
+import signal
+import socket
+import SocketServer
+import StringIO
+import sys
+
+import xsc
+import xsc_client
+
+_log = logging.getLogger('xsc.server')
+
+class _RecentlyUsedMap(object):
+    """
+    Map holding at most ``maxCount`` items, where adding another one removes the item used
+    least recently.
+    """
+    def __init__(self, maxCount):
+        assert maxCount >= 1
+        self.maxCount = maxCount
+        self._keyToValueMap = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        The value stored for ``key`` or ``None`` if there is none.
+        """
+        result = self._keyToValueMap.pop(key, None)
+        if result is not None:
+            # Move the item to the end, which holds the items used most recently.
+            self._keyToValueMap[key] = result
+        return result
+
+    def __setitem__(self, key, value):
+        self._keyToValueMap.pop(key, None)
+        self._keyToValueMap[key] = value
+        if len(self._keyToValueMap) > self.maxCount:
+            self._keyToValueMap.popitem(last=False)
+
+    def __len__(self):
+        return len(self._keyToValueMap)
+
+class _WarmCache(object):
+    """
+    Templates and interfaces a worker process of `ConversionServer` keeps in memory, so
+    conversions using the same files need not read them again as long as they remain
+    unchanged. It holds at most `MaxTemplateCount` templates and `MaxInterfaceCount`
+    interfaces, so a long running worker does not keep those of files that changed or are
+    no longer used forever.
+    """
+    MaxTemplateCount = 100
+    MaxInterfaceCount = 1000
+
+    def __init__(self):
+        self._templateKeyToTemplateMap = _RecentlyUsedMap(_WarmCache.MaxTemplateCount)
+        self._interfaceKeyToInterfaceMap = _RecentlyUsedMap(_WarmCache.MaxInterfaceCount)
+
+    def template(self, xscFilePath, cacheFolderPath=None):
+        """
+        The `XscTemplate` read from ``xscFilePath``.
+        """
+        assert xscFilePath is not None
+        key = xsc._templateKey(xscFilePath)
+        result = self._templateKeyToTemplateMap.get(key)
+        if result is None:
+            result = xsc.XscTemplate(xscFilePath, cacheFolderPath)
+            self._templateKeyToTemplateMap[key] = result
+        else:
+            _log.info('use template "%s" from memory', xscFilePath)
+        return result
+
+    def interface(self, dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount=xsc.DefaultSniffLineCount,
+            sniffByteCount=0, dataCache=None):
+        """
+        Like `xsc._readInterface()` but using the interface read before if the interface file or,
+        for sniffed interfaces, the data file remained unchanged.
+        """
+        assert dataFilePath is not None
+        if interfaceFilePath:
+            key = ('cid', xsc._fileKey(interfaceFilePath))
+        else:
+            key = ('sniffed', xsc._fileKey(dataFilePath), autoDataEncoding, sniffLineCount, sniffByteCount)
+        result = self._interfaceKeyToInterfaceMap.get(key)
+        if result is None:
+            result = xsc._readInterface(dataFilePath, interfaceFilePath, autoDataEncoding, sniffLineCount, sniffByteCount, dataCache)
+            self._interfaceKeyToInterfaceMap[key] = result
+        else:
+            _log.info('  use interface from memory')
+        return result
+
+class _ServerJobExit(Exception):
+    """
+    Exception raised by `_ServerJobOptionParser` instead of exiting.
+    """
+    def __init__(self, status, message):
+        super(_ServerJobExit, self).__init__(message)
+        self.status = status
+        self.message = message
+
+class _ServerJobOptionParser(optparse.OptionParser):
+    """
+    Option parser for the arguments of a conversion sent to `ConversionServer` that raises
+    `_ServerJobExit` instead of exiting the worker process.
+    """
+    def __init__(self, **keywords):
+        keywords.setdefault('prog', 'xsc-client')
+        optparse.OptionParser.__init__(self, **keywords)
+
+    def exit(self, status=0, msg=None):
+        raise _ServerJobExit(status, msg)
+
+    def error(self, msg):
+        self.exit(2, '%s%s: error: %s' % (self.get_usage(), self.get_prog_name(), msg))
+
+class _CapturingLogHandler(logging.Handler):
+    """
+    Log handler collecting formatted messages in ``lines``.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.lines = []
+
+    def emit(self, record):
+        line = self.format(record)
+        if not isinstance(line, unicode):
+            line = line.decode('utf-8', 'replace')
+        self.lines.append(line)
+
+# `_WarmCache` of a worker process of `ConversionServer`.
+_serverWarmCache = None
+
+def _initializeServerWorker():
+    global _serverWarmCache
+    _serverWarmCache = _WarmCache()
+    # Leave it to the server to stop on Control-C, but let the pool terminate workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def _runServerJob(workingFolderPath, arguments, cacheFolderPath):
+    """
+    Dictionary with the ``exitCode``, ``log`` messages and ``output`` of the conversion
+    described by the command line ``arguments`` where relative paths refer to
+    ``workingFolderPath``. Conversions without ``--cache`` use ``cacheFolderPath``. This runs
+    in a worker process of `ConversionServer`.
+    """
+    assert _serverWarmCache is not None
+    assert workingFolderPath is not None
+    assert arguments is not None
+    exitCode = 1
+    logHandler = _CapturingLogHandler()
+    rootLogger = logging.getLogger()
+    rootLogger.addHandler(logHandler)
+    output = StringIO.StringIO()
+    oldStdout = sys.stdout
+    try:
+        os.chdir(workingFolderPath)
+        # Options like --help and --version print to standard output.
+        sys.stdout = output
+        try:
+            options, xscTemplatePath, dataSourceMap = xsc._parsedOptions(arguments, _ServerJobOptionParser)
+        finally:
+            sys.stdout = oldStdout
+        if options.outXmlPath == xsc._StandardOutputPath:
+            raise xsc.XscSyntaxError(u'--output must be a file because the server cannot write to standard output of the client')
+        if options.jobs > 1:
+            _log.warning(u'ignored --jobs=%d because the server runs each conversion in a single process', options.jobs)
+            options.jobs = 1
+        if options.cacheFolderPath is None:
+            options.cacheFolderPath = cacheFolderPath
+        xsc._convertWithOptions(options, xscTemplatePath, dataSourceMap, _serverWarmCache)
+        exitCode = 0
+    except _ServerJobExit, error:
+        exitCode = error.status
+        if error.message:
+            logHandler.lines.extend(unicode(error.message).rstrip(u'\n').split(u'\n'))
+    except EnvironmentError, error:
+        _log.error(u'%s', error)
+    except Exception, error:
+        _log.exception(error)
+    finally:
+        rootLogger.removeHandler(logHandler)
+    return {'exitCode': exitCode, 'log': logHandler.lines, 'output': output.getvalue().decode('utf-8')}
+
+class _ConversionRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handler for a single conversion sent by ``xsc_client``.
+    """
+    def handle(self):
+        try:
+            request = xsc_client.receivedLine(self.rfile)
+            arguments = request['arguments']
+            workingFolderPath = request['workingFolder']
+            _log.info(u'convert in "%s": %s', workingFolderPath, u' '.join(arguments))
+            response = self.server.convert(workingFolderPath, arguments)
+        except (EOFError, ValueError, KeyError, TypeError), error:
+            _log.warning(u'ignored broken request: %s', error)
+            response = {'exitCode': 1, 'log': [u'cannot process request: %s' % error], 'output': u''}
+        xsc_client.sendLine(self.wfile, response)
+
+def _removeStaleSocket(socketPath):
+    """
+    Remove the socket at ``socketPath`` left behind by a server that did not stop properly.
+    """
+    assert socketPath is not None
+    if os.path.exists(socketPath):
+        if os.stat(socketPath).st_uid != os.getuid():
+            raise xsc.XscError(u'socket "%s" must be removed because it belongs to another user' % socketPath)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socketPath)
+        except socket.error:
+            _log.info(u'remove stale socket "%s"', socketPath)
+            os.remove(socketPath)
+        else:
+            raise xsc.XscError(u'server using socket "%s" must be stopped before another one can be started' % socketPath)
+        finally:
+            probe.close()
+
+class ConversionServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Server listening on the Unix socket ``socketPath`` for conversions sent by ``xsc_client``
+    and running them in a pool of ``jobs`` worker processes. Each worker keeps templates and
+    interfaces in memory, so conversions only pay for reading and writing data. Conversions
+    that do not specify ``--cache`` use ``cacheFolderPath``.
+    """
+    daemon_threads = True
+
+    def __init__(self, socketPath, jobs=1, cacheFolderPath=None):
+        assert socketPath is not None
+        assert jobs >= 1
+        self.socketPath = socketPath
+        self.cacheFolderPath = cacheFolderPath
+        socketFolderPath = os.path.dirname(socketPath)
+        if socketFolderPath and not os.path.exists(socketFolderPath):
+            # Other users must not be able to replace the socket.
+            os.makedirs(socketFolderPath, 0700)
+        _removeStaleSocket(socketPath)
+        # Fork workers before listening so they do not inherit the socket.
+        self._pool = multiprocessing.Pool(jobs, _initializeServerWorker)
+        try:
+            # Only the current user may connect because templates can run any Python code.
+            oldUmask = os.umask(0077)
+            try:
+                SocketServer.UnixStreamServer.__init__(self, socketPath, _ConversionRequestHandler)
+            finally:
+                os.umask(oldUmask)
+        except:
+            self._pool.terminate()
+            self._pool.join()
+            raise
+        _log.info(u'listen on socket "%s" using %d processes', socketPath, jobs)
+
+    def convert(self, workingFolderPath, arguments):
+        """
+        Run the conversion described by the command line ``arguments`` as described in
+        `_runServerJob()`.
+        """
+        return self._pool.apply(_runServerJob, (workingFolderPath, arguments, self.cacheFolderPath))
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self._pool.close()
+        self._pool.join()
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+def _parsedServerOptions(arguments):
+    usage = 'usage: %prog [options]'
+    epilog = 'Conversions are sent to the server using xsc-client, which accepts the same options and arguments as xsc. For more information, visit <http://pypi.python.org/pypi/xsc/>.'
+    parser = optparse.OptionParser(usage=usage, description='run xsc conversions sent by xsc-client in processes that keep templates and interfaces in memory', epilog=epilog, version=xsc.__version__)
+    parser.add_option('--socket', dest='socketPath', metavar='FILE', default=xsc_client.socketPath(),
+        help='Unix socket to listen on (default: $%s or %%default)' % xsc_client.SocketPathVariable)
+    parser.add_option('-j', '--jobs', dest='jobs', metavar='NUMBER', type='int', default=1,
+        help='number of processes to run conversions with (default: %default)')
+    parser.add_option('--cache', dest='cacheFolderPath', metavar='FOLDER',
+        help='folder where to cache validated data rows, sniffed interfaces and compiled templates for conversions that do not specify --cache')
+
+    options, others = parser.parse_args(arguments)
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1 but is: %d' % options.jobs)
+    if others:
+        parser.error('arguments must be removed: %s' % ' '.join(others))
+    return options
+
+def _interruptServer(signalNumber, frame):
+    raise KeyboardInterrupt()
+
+def serverMain(arguments=None):
+    """
+    Main function for command line call of the conversion server returning a tuple
+    ``(exitCode, error)`` similar to `xsc.main()`. The server runs until it is interrupted or
+    terminated.
+    """
+    if arguments == None:
+        actualArguments = sys.argv
+    else:
+        actualArguments = arguments
+
+    exitCode = 1
+    exitError = None
+    try:
+        options = _parsedServerOptions(actualArguments[1:])
+        if not hasattr(socket, 'AF_UNIX'): # pragma: no cover
+            raise xsc.XscError(u'server cannot be started because Unix sockets are not available on this platform')
+        server = ConversionServer(options.socketPath, options.jobs, options.cacheFolderPath)
+        signal.signal(signal.SIGTERM, _interruptServer)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            _log.info('stop server')
+            exitCode = 0
+        finally:
+            server.server_close()
+    except EnvironmentError, error:
+        _log.error(u'%s', error)
+        exitError = error
+    except Exception, error:
+        _log.exception(error)
+        exitError = error
+
+    return exitCode, exitError
+
+def serverMainWithExit():
+    """
+    Like `xsc.mainWithExit()` but for `serverMain()`.
+    """
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('cutplace').setLevel(logging.WARNING)
+    sys.exit(serverMain()[0])
+
+if __name__ == '__main__': # pragma: no cover
+    serverMainWithExit()